@@ -7,6 +7,8 @@ cd "$SCRIPT_DIR" || { echo "Failed to change to script directory"; exit 1; }
 # Initialize variables
 SILENT=false
 LOG_FILE="$SCRIPT_DIR/dl-adblock.log"
+# Feeds to download, with their mirrors, intervals and limits
+MANIFEST="$SCRIPT_DIR/adblock-feeds.json"
 
 # Process command line arguments
 for arg in "$@"; do
@@ -15,10 +17,14 @@ for arg in "$@"; do
       SILENT=true
       shift
       ;;
+    --manifest=*)
+      MANIFEST="${arg#*=}"
+      shift
+      ;;
     *)
       # Unknown option
       echo "Unknown option: $arg"
-      echo "Usage: $0 [--silent]"
+      echo "Usage: $0 [--silent] [--manifest=FILE]"
       exit 1
       ;;
   esac
@@ -68,66 +74,16 @@ else
   log "Running in verbose mode. Output displayed and logged to $LOG_FILE"
 fi
 
-# Function to check file and move it safely
-download_and_check() {
-    local url="$1"
-    local temp_file="$2"
-    local dest_file="$3"
-
-    log "Downloading from $url to $temp_file..."
-
-    # Download to temporary file
-    if ! execute_cmd "wget -q \"$url\" -O \"$temp_file\""; then
-        log "ERROR: Failed to download $url"
-        return 1
-    fi
-
-    # Check file exists
-    if ! execute_cmd "[ -f \"$temp_file\" ]"; then
-        log "ERROR: Downloaded file $temp_file does not exist"
-        return 1
-    fi
-
-    # Check file size is greater than 0
-    if ! execute_cmd "[ -s \"$temp_file\" ]"; then
-        log "ERROR: Downloaded file $temp_file is empty"
-        execute_cmd "rm -f \"$temp_file\""
-        return 1
-    fi
-
-    # Move file to destination
-    log "Moving $temp_file to $dest_file..."
-    if ! execute_cmd "sudo mv -f \"$temp_file\" \"$dest_file\""; then
-        log "ERROR: Failed to move $temp_file to $dest_file"
-        execute_cmd "rm -f \"$temp_file\""
-        return 1
-    fi
-
-    log "Successfully processed $dest_file"
-    return 0
-}
-
 # Make sure script exits if a command fails
 set -e
 
-# Define temporary and destination files
-TEMP_1HOSTS="$SCRIPT_DIR/1hosts-lite.rpz.tmp"
-TEMP_OISD="$SCRIPT_DIR/oisd.rpz.tmp"
-DEST_DIR="/etc/knot-resolver"
+RPZ_ROOT="/etc/knot-resolver/rpz"
 
-# Download and process 1hosts-lite.rpz
-if download_and_check "https://o0.pages.dev/Lite/rpz.txt" "$TEMP_1HOSTS" "$DEST_DIR/1hosts-lite.rpz"; then
-    log "1hosts-lite.rpz successfully updated"
-else
-    log "Failed to update 1hosts-lite.rpz"
-    exit 1
-fi
-
-# Download and process oisd.rpz
-if download_and_check "https://small.oisd.nl/rpz" "$TEMP_OISD" "$DEST_DIR/oisd.rpz"; then
-    log "oisd.rpz successfully updated"
-else
-    log "Failed to update oisd.rpz"
+# Fetch the feeds that are due in parallel, then swap all changed zones in at once, reload Knot Resolver
+# once, and roll back if it isn't healthy afterwards. A feed that fails keeps its installed zone.
+log "Updating RPZ feeds from $MANIFEST into $RPZ_ROOT..."
+if ! execute_cmd "sudo python3 \"$SCRIPT_DIR/knotstats-rpz.py\" --root \"$RPZ_ROOT\" update --manifest \"$MANIFEST\""; then
+    log "Failed to update some RPZ feeds; see above"
     exit 1
 fi
 
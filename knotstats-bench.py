@@ -0,0 +1,500 @@
+# /// script
+# dependencies = [
+#     "requests>=2.20",
+# ]
+# ///
+#
+# ################################################################################
+# # Knot Resolver Stats Dashboard - Load & Latency Benchmark
+# ################################################################################
+#
+# Benchmarks the knotstats backends against a local fake Knot Resolver, so
+# changes to the backend can be compared without a real resolver.
+#
+# The harness:
+#
+# - starts a fake metrics server that serves `/metrics/json` (v6 layout, N
+#   instances x M metrics) and `/stats` (flat v5 layout) with configurable latency,
+# - launches the backend under test pointed at the fake server,
+# - runs concurrent simulated dashboards polling `/api/stats` and `/api/hosts`,
+# - reports throughput, tail latency and the backend's resident memory.
+#
+# ## Usage
+#
+# ```
+# uv run knotstats-bench.py --dashboards 50 --duration 30
+# uv run knotstats-bench.py --instances 32 --metrics 400 --upstream-latency 20
+# uv run knotstats-bench.py --closed-loop --dashboards 16 --json bench.json
+# uv run knotstats-bench.py --target knotstats.py --hosts-ratio 0
+# uv run knotstats-bench.py --startup 10 -- --serve prod --workers 4
+# ```
+#
+# `--startup` measures restarts instead of load: how long the backend takes
+# to serve the page and the first stats, once with an empty cache directory
+# and then reusing it as a restart would.
+#
+# Arguments after `--` are passed to the backend, e.g. `-- --serve prod --workers 4`.
+#
+# The fake server also accepts alert webhooks at `/alerts` and prints them, so
+# alert rules can be tried with `-- --alert-rules rules.json`.
+#
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Sections and keys the dashboards chart, as fractions of an instance's answer rate so
+# that totals, rcodes, latency buckets and cache counters stay consistent with each
+# other. Filler metrics are added to reach --metrics.
+BASE_METRICS = {
+    'answer': {'total': 1.0, 'noerror': 0.8, 'nodata': 0.05, 'nxdomain': 0.13, 'servfail': 0.02,
+               'cached': 0.7, 'stale': 0.01,
+               '1ms': 0.65, '10ms': 0.1, '50ms': 0.12, '100ms': 0.06, '250ms': 0.04, '500ms': 0.015,
+               '1000ms': 0.008, '1500ms': 0.004, 'slow': 0.003},
+    'request': {'total': 1.0, 'udp': 0.9, 'tcp': 0.06, 'dot': 0.03, 'doh': 0.01, 'internal': 0.0, 'xdp': 0.0},
+    'cache': {'lookup': 1.2, 'hit': 0.84, 'miss': 0.36, 'insert': 0.3, 'delete': 0.2, 'clear': 0.0},
+    'worker': {'udp': 0.9, 'tcp': 0.1, 'ipv4': 0.8, 'ipv6': 0.2},
+}
+
+
+# --- Fake Knot Resolver ---
+
+class FakeResolver:
+    """Generates monotonically increasing counters for N instances x M metrics."""
+
+    def __init__(self, instances, metrics, qps=1000.0):
+        self.started = time.monotonic()
+        self.scrapes = 0
+        self.alerts = []
+        self.instance_ids = [f"kresd:kresd{i}" for i in range(instances)]
+        self.keys = [(section, key) for section, keys in BASE_METRICS.items() for key in keys]
+        base_count = len(self.keys)
+        for i in range(max(0, metrics - base_count)):
+            self.keys.append(('query', f"metric_{i:04d}"))
+        rng = random.Random(42)
+        # Per-instance answer rate so instances differ from each other, scaled per metric.
+        self.rates = {}
+        for instance in self.instance_ids:
+            instance_qps = qps * rng.uniform(0.5, 1.5)
+            fractions = [BASE_METRICS[section][key] for section, key in self.keys[:base_count]]
+            fractions += [rng.uniform(0.01, 1.0) for _ in self.keys[base_count:]]
+            self.rates[instance] = [instance_qps * fraction for fraction in fractions]
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        data = {}
+        for instance in self.instance_ids:
+            sections = {}
+            for (section, key), rate in zip(self.keys, self.rates[instance]):
+                sections.setdefault(section, {})[key] = int(rate * elapsed)
+            # Gauges
+            sections['worker']['concurrent'] = 10
+            sections['worker']['rss'] = 64 * 1024 * 1024
+            data[instance] = sections
+        return data
+
+    def flat_snapshot(self):
+        instance_data = self.snapshot()[self.instance_ids[0]]
+        return {f"{section}.{key}": value
+                for section, values in instance_data.items() for key, value in values.items()}
+
+
+def start_fake_server(resolver, latency_ms, jitter_ms):
+    """Starts the fake metrics server on a free local port and returns it."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            resolver.scrapes += 1
+            delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+            if delay:
+                time.sleep(delay / 1000.0)
+            if self.path.startswith('/metrics/json'):
+                body = json.dumps(resolver.snapshot()).encode()
+            elif self.path.startswith('/stats'):
+                body = json.dumps(resolver.flat_snapshot()).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # Local sink for alert webhooks, e.g. {"webhook": "http://127.0.0.1:<port>/alerts"}
+            if not self.path.startswith('/alerts'):
+                self.send_error(404)
+                return
+            event = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            resolver.alerts.append(event)
+            print(f"Alert received: {event.get('rule')} {event.get('state')}: {event.get('message')}", flush=True)
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- Backend under test ---
+
+def write_hosts_file(path, entries):
+    with open(path, 'w') as file:
+        for i in range(entries):
+            file.write(f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255} host{i}.example.lan\n")
+
+
+def backend_command(target, stats_url, port, hosts_file, extra_args):
+    cmd = [sys.executable, target, '--stats-url', stats_url, '--host', '127.0.0.1', '--port', str(port)]
+    if hosts_file:
+        cmd += ['--hosts-file', hosts_file]
+    return cmd + extra_args
+
+
+def start_backend(target, stats_url, port, hosts_file, extra_args):
+    """Launches the backend script and waits until it accepts requests."""
+    cmd = backend_command(target, stats_url, port, hosts_file, extra_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {proc.returncode}: {' '.join(cmd)}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=0.5)
+            return proc
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Backend did not start within 30 seconds.")
+
+
+def wait_for(url, proc, deadline):
+    """Polls url until it answers 200; returns the time it did."""
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {proc.returncode}")
+        try:
+            if requests.get(url, timeout=0.5).status_code == 200:
+                return time.monotonic()
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f"{url} did not answer within 30 seconds.")
+
+
+def measure_startup(cmd, port):
+    """Launches the backend once; returns seconds until it served the page and until it served stats."""
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        page = wait_for(f"http://127.0.0.1:{port}/", proc, started + 30)
+        stats = wait_for(f"http://127.0.0.1:{port}/api/stats", proc, started + 30)
+        return page - started, stats - started
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def run_startup_benchmark(args, stats_url, hosts_file, cache_dir):
+    """Restarts the backend --startup times against one cache directory; the first start is cold."""
+    extra_args = args.backend_args
+    if '--cache-dir' not in extra_args:
+        extra_args = extra_args + ['--cache-dir', cache_dir]
+    runs = []
+    for _ in range(args.startup):
+        port = free_port()
+        runs.append(measure_startup(backend_command(args.target, stats_url, port, hosts_file, extra_args), port))
+    report = {'target': os.path.basename(args.target), 'runs': len(runs)}
+    for phase, samples in (('cold', runs[:1]), ('warm', runs[1:])):
+        if not samples:
+            continue
+        page, stats = sorted(run[0] for run in samples), sorted(run[1] for run in samples)
+        report[phase] = {
+            'page_p50_ms': round(percentile(page, 50) * 1000, 1), 'page_max_ms': round(page[-1] * 1000, 1),
+            'stats_p50_ms': round(percentile(stats, 50) * 1000, 1), 'stats_max_ms': round(stats[-1] * 1000, 1),
+        }
+    return report
+
+
+def print_startup_report(report):
+    print(f"\nStartup of {report['target']}, {report['runs']} runs (time until the first answer)")
+    print(f"{'start':<6} {'page p50 ms':>12} {'page max ms':>12} {'stats p50 ms':>13} {'stats max ms':>13}")
+    for phase in ('cold', 'warm'):
+        if phase in report:
+            row = report[phase]
+            print(f"{phase:<6} {row['page_p50_ms']:>12} {row['page_max_ms']:>12} "
+                  f"{row['stats_p50_ms']:>13} {row['stats_max_ms']:>13}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss(pid):
+    """Returns the summed RSS in bytes of pid and its children, or None if unavailable."""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids += [int(child) for child in file.read().split()]
+    except OSError:
+        pass
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            if p == pid:
+                return None
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Samples the backend's RSS in the background, keeping the peak and last values."""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.last = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.last = rss
+                self.peak = max(self.peak or 0, rss)
+            self.stopped.wait(self.interval)
+
+
+# --- Simulated dashboards ---
+
+class Recorder:
+    """Collects per-endpoint latency samples from all dashboard threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def record(self, endpoint, seconds, ok, size):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            self.bytes[endpoint] = self.bytes.get(endpoint, 0) + size
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def run_dashboard(base_url, recorder, stop_at, interval, hosts_ratio, closed_loop, rng, stats_query=''):
+    """Polls like the dashboard page does: /api/stats every interval, /api/hosts now and then."""
+    session = requests.Session()
+    # Stagger start so dashboards don't all fire on the same tick.
+    if not closed_loop:
+        time.sleep(rng.uniform(0, interval))
+    while time.monotonic() < stop_at:
+        tick = time.monotonic()
+        endpoint = '/api/hosts' if rng.random() < hosts_ratio else '/api/stats'
+        started = time.perf_counter()
+        try:
+            response = session.get(base_url + endpoint + (stats_query if endpoint == '/api/stats' else ''), timeout=10)
+            ok = response.status_code == 200
+            size = len(response.content)
+        except requests.exceptions.RequestException:
+            ok, size = False, 0
+        recorder.record(endpoint, time.perf_counter() - started, ok, size)
+        if not closed_loop:
+            remaining = interval - (time.monotonic() - tick)
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100.0) - 1))
+    return sorted_values[rank]
+
+
+def summarize(recorder, elapsed, rss, upstream_scrapes):
+    report = {'duration_s': round(elapsed, 3), 'upstream_scrapes_per_s': round(upstream_scrapes / elapsed, 2),
+              'endpoints': {}}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        samples.sort()
+        report['endpoints'][endpoint] = {
+            'requests': len(samples),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+            'avg_bytes': int(recorder.bytes.get(endpoint, 0) / len(samples)) if samples else 0,
+            'p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'p90_ms': round(percentile(samples, 90) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            'max_ms': round(samples[-1] * 1000, 3) if samples else 0.0,
+        }
+    if rss is not None:
+        report['rss_peak_bytes'] = rss.peak
+        report['rss_last_bytes'] = rss.last
+    return report
+
+
+def print_report(report, args):
+    print(f"\nDashboards: {args.dashboards} ({'closed loop' if args.closed_loop else f'every {args.interval}s'}), "
+          f"instances: {args.instances}, metrics: {args.metrics}, "
+          f"upstream latency: {args.upstream_latency}ms, duration: {report['duration_s']}s")
+    print(f"{'endpoint':<12} {'reqs':>8} {'errs':>6} {'req/s':>9} {'bytes':>9} "
+          f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for endpoint, row in report['endpoints'].items():
+        print(f"{endpoint:<12} {row['requests']:>8} {row['errors']:>6} {row['throughput_rps']:>9} "
+              f"{row['avg_bytes']:>9} {row['p50_ms']:>9} {row['p90_ms']:>9} {row['p99_ms']:>9} {row['max_ms']:>9}")
+    print(f"Upstream scrapes: {report['upstream_scrapes_per_s']}/s")
+    if report.get('rss_peak_bytes'):
+        print(f"Backend RSS: peak {report['rss_peak_bytes'] / 1048576:.1f} MB, "
+              f"last {report['rss_last_bytes'] / 1048576:.1f} MB")
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    backend_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, backend_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the knotstats backends.")
+    parser.add_argument('--target', default=os.path.join(SCRIPT_DIR, 'knotstats-v6.py'),
+                        help="Backend script to launch (default: %(default)s)")
+    parser.add_argument('--url', help="Benchmark an already running backend instead of launching one")
+    parser.add_argument('--instances', type=int, default=4, help="Fake kresd instances (default: %(default)s)")
+    parser.add_argument('--metrics', type=int, default=100, help="Metrics per instance (default: %(default)s)")
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help="Fake resolver response latency in ms (default: %(default)s)")
+    parser.add_argument('--upstream-jitter', type=float, default=0.0,
+                        help="Extra random latency in ms, uniform 0..N (default: %(default)s)")
+    parser.add_argument('--dashboards', type=int, default=10, help="Concurrent simulated dashboards (default: %(default)s)")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds between polls per dashboard, as in the page (default: %(default)s)")
+    parser.add_argument('--closed-loop', action='store_true',
+                        help="Poll back-to-back without waiting, to find maximum throughput")
+    parser.add_argument('--duration', type=float, default=20.0, help="Benchmark duration in seconds (default: %(default)s)")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Seconds to run before measuring (default: %(default)s)")
+    parser.add_argument('--stats-format', choices=['json', 'columnar'], default='json',
+                        help="Wire format requested from /api/stats (default: %(default)s)")
+    parser.add_argument('--hosts-ratio', type=float, default=0.05,
+                        help="Fraction of polls that hit /api/hosts (default: %(default)s)")
+    parser.add_argument('--hosts-entries', type=int, default=1000,
+                        help="Entries in the generated hosts file (default: %(default)s)")
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help="Instead of the load benchmark, start the backend RUNS times and report how long each "
+                             "took to serve the page and the first stats; the first start has an empty cache")
+    parser.add_argument('--json', dest='json_path', help="Also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    args.backend_args = backend_args
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    resolver = FakeResolver(args.instances, args.metrics)
+    fake = start_fake_server(resolver, args.upstream_latency, args.upstream_jitter)
+    fake_base = f"http://127.0.0.1:{fake.server_address[1]}"
+    stats_path = '/stats' if os.path.basename(args.target) == 'knotstats.py' else '/metrics/json'
+
+    backend = None
+    rss = None
+    tmpdir = tempfile.TemporaryDirectory(prefix='knotstats-bench-')
+    try:
+        if args.startup:
+            hosts_file = os.path.join(tmpdir.name, 'hosts.local')
+            write_hosts_file(hosts_file, args.hosts_entries)
+            report = run_startup_benchmark(args, fake_base + stats_path,
+                                           hosts_file if stats_path == '/metrics/json' else None,
+                                           os.path.join(tmpdir.name, 'cache'))
+            print_startup_report(report)
+            if args.json_path:
+                with open(args.json_path, 'w') as file:
+                    json.dump(report, file, indent=2)
+            return
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            hosts_file = os.path.join(tmpdir.name, 'hosts.local')
+            write_hosts_file(hosts_file, args.hosts_entries)
+            port = free_port()
+            hosts_arg = hosts_file if stats_path == '/metrics/json' else None
+            backend = start_backend(args.target, fake_base + stats_path, port, hosts_arg, args.backend_args)
+            base_url = f"http://127.0.0.1:{port}"
+            rss = RssSampler(backend.pid)
+            rss.start()
+        print(f"Fake resolver at {fake_base}{stats_path}, backend at {base_url}")
+
+        # Warm up with the same load, then measure with a fresh recorder.
+        for phase, duration in (('warmup', args.warmup), ('measure', args.duration)):
+            if phase == 'warmup' and duration <= 0:
+                continue
+            recorder = Recorder()
+            scrapes_before = resolver.scrapes
+            stop_at = time.monotonic() + duration
+            threads = [
+                threading.Thread(target=run_dashboard, daemon=True,
+                                 args=(base_url, recorder, stop_at, args.interval, args.hosts_ratio,
+                                       args.closed_loop, random.Random(i),
+                                       '?format=columnar' if args.stats_format == 'columnar' else ''))
+                for i in range(args.dashboards)
+            ]
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+
+        report = summarize(recorder, elapsed, rss, resolver.scrapes - scrapes_before)
+        print_report(report, args)
+        if args.json_path:
+            with open(args.json_path, 'w') as file:
+                json.dump(report, file, indent=2)
+    finally:
+        if rss is not None:
+            rss.stopped.set()
+        if backend is not None:
+            backend.terminate()
+            try:
+                backend.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                backend.kill()
+        fake.shutdown()
+        tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+# /// script
+# dependencies = []
+# ///
+#
+# ################################################################################
+# # Knot Resolver RPZ Installer
+# ################################################################################
+#
+# Installs a set of RPZ zones as one release, with a single reload and a
+# health gate, instead of moving each zone into place on its own.
+#
+# ## Layout
+#
+# ```
+# /etc/knot-resolver/rpz/releases/20260101T040000/oisd.rpz
+# /etc/knot-resolver/rpz/releases/20260101T040000/1hosts-lite.rpz
+# /etc/knot-resolver/rpz/current -> releases/20260101T040000
+# ```
+#
+# Point kresd at the zones through `current`, without watching the files, so
+# it only loads them on the reload this script triggers:
+#
+# ```kresd.conf
+# policy.add(policy.rpz(policy.DENY, '/etc/knot-resolver/rpz/current/oisd.rpz', false))
+# policy.add(policy.rpz(policy.DENY, '/etc/knot-resolver/rpz/current/1hosts-lite.rpz', false))
+# ```
+#
+# ## Usage
+#
+# ```
+# sudo python3 knotstats-rpz.py install oisd.rpz 1hosts-lite.rpz --check doubleclick.net=NXDOMAIN
+# sudo python3 knotstats-rpz.py update --manifest adblock-feeds.json
+# sudo python3 knotstats-rpz.py rollback
+# ```
+#
+# `update` fetches the feeds of a manifest that are due (see
+# `knotstats_feeds.py`) and installs the ones that changed as one release, as
+# `install` does. Feeds that failed keep their installed zone; the state of
+# each feed is kept in `feeds.state.json` under `--root`.
+#
+# `install` validates each zone (see `knotstats_names.py`), copies them into a
+# new release directory, carrying over unchanged any zone of the current
+# release that wasn't given, and flips `current` to it with an atomic rename.
+# It then reloads Knot Resolver once and runs the health gate: every
+# `--check` query must be answered with the expected rcode within
+# `--max-latency`, and of the answers kresd counts meanwhile, no more than
+# `--max-slow` may take over a second. Until the gate passes, or
+# `--settle` seconds run out, the checks are repeated; if it fails, `current`
+# is flipped back and Knot Resolver reloaded again. The newest `--keep`
+# releases are kept for `rollback`.
+#
+
+import argparse
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from knotstats_feeds import ManifestError, fetch_feeds, load_manifest
+from knotstats_names import check_file
+
+RCODES = ('NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED')
+# Latency buckets kresd counts answers in, as `answer.<bucket>` keys; those over a second are "slow"
+ANSWER_KEY_RE = re.compile(r'(?:^|\.)answer\.(total|1000ms|1500ms|slow)$')
+SLOW_BUCKETS = ('1000ms', '1500ms', 'slow')
+# Under --root: what each feed was last fetched as, for conditional requests and intervals
+FEED_STATE_FILE = 'feeds.state.json'
+
+
+class HealthCheckFailed(Exception):
+    pass
+
+
+def query(server, port, qname, timeout):
+    """Sends a recursive A query; returns (rcode name, seconds taken)."""
+    query_id = random.randrange(1 << 16)
+    labels = [] if qname == '.' else qname.rstrip('.').split('.')
+    wire = b''.join(bytes([len(label)]) + label.encode('idna') for label in labels) + b'\0'
+    packet = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + wire + struct.pack('>HH', 1, 1)
+    family = socket.AF_INET6 if ':' in server else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        started = time.monotonic()
+        sock.sendto(packet, (server, port))
+        deadline = started + timeout
+        while True:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            data = sock.recv(4096)
+            if len(data) >= 4 and struct.unpack_from('>H', data)[0] == query_id:
+                rcode = data[3] & 0x0f
+                return RCODES[rcode] if rcode < len(RCODES) else f"RCODE{rcode}", time.monotonic() - started
+
+
+def answer_counts(stats_url, timeout):
+    """Returns {bucket: count} of kresd's answer latency counters, summed over its instances."""
+    with urllib.request.urlopen(stats_url, timeout=timeout) as response:
+        stats = json.load(response)
+    counts = dict.fromkeys(('total', *SLOW_BUCKETS), 0)
+
+    def walk(node, path):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                walk(value, f"{path}{key}.")
+            elif (match := ANSWER_KEY_RE.search(f"{path}{key}")) and isinstance(value, (int, float)):
+                counts[match.group(1)] += value
+
+    walk(stats, '')
+    return counts
+
+
+class Release:
+    """The release directories under `root` and the `current` symlink choosing one of them."""
+
+    def __init__(self, root):
+        self.root = root
+        self.releases = os.path.join(root, 'releases')
+        self.current = os.path.join(root, 'current')
+
+    def current_name(self):
+        try:
+            return os.path.basename(os.readlink(self.current))
+        except FileNotFoundError:
+            return None
+
+    def names(self):
+        """Returns the release names, oldest first."""
+        try:
+            return sorted(name for name in os.listdir(self.releases) if not name.startswith('.'))
+        except FileNotFoundError:
+            return []
+
+    def stage(self, files):
+        """Copies the zones into a new release, with any others from the current release; returns its name."""
+        stamp = name = time.strftime('%Y%m%dT%H%M%S')
+        suffix = 0
+        while os.path.exists(os.path.join(self.releases, name)):
+            suffix += 1
+            name = f"{stamp}-{suffix}"
+        staging = os.path.join(self.releases, f".{name}.tmp")
+        os.makedirs(staging)
+        try:
+            sources = {os.path.basename(path): path for path in files}
+            current = self.current_name()
+            if current:
+                for zone in os.listdir(os.path.join(self.releases, current)):
+                    if zone not in sources:
+                        print(f"Keeping {zone} from release {current}")
+                        sources[zone] = os.path.join(self.releases, current, zone)
+            for zone, source in sources.items():
+                with open(source, 'rb') as src, open(os.path.join(staging, zone), 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.chmod(os.path.join(staging, zone), 0o644)
+            os.rename(staging, os.path.join(self.releases, name))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return name
+
+    def activate(self, name):
+        """Points `current` at a release; the rename makes the switch atomic for every zone at once."""
+        link = f"{self.current}.tmp"
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.join('releases', name), link)
+        os.replace(link, self.current)
+        directory = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def prune(self, keep):
+        """Removes all but the newest `keep` releases, never the current one."""
+        current = self.current_name()
+        for name in self.names()[:-keep] if keep > 0 else []:
+            if name != current:
+                shutil.rmtree(os.path.join(self.releases, name), ignore_errors=True)
+
+
+def reload_resolver(command):
+    print(f"Reloading: {command}")
+    subprocess.run(shlex.split(command), check=True)
+
+
+def health_check(args):
+    """Runs the checks until they pass or --settle seconds run out; raises HealthCheckFailed."""
+    deadline = time.monotonic() + args.settle
+    while True:
+        try:
+            before = answer_counts(args.stats_url, args.timeout) if args.stats_url else None
+            for check in args.check:
+                qname, _, expected = check.partition('=')
+                try:
+                    rcode, seconds = query(args.server, args.port, qname, args.timeout)
+                except OSError as e:
+                    raise HealthCheckFailed(f"{qname}: {e or 'no answer'}")
+                if rcode != (expected.upper() or 'NOERROR'):
+                    raise HealthCheckFailed(f"{qname}: {rcode}, expected {expected.upper() or 'NOERROR'}")
+                if seconds * 1000 > args.max_latency:
+                    raise HealthCheckFailed(f"{qname}: answered in {seconds * 1000:.0f} ms")
+            if before is not None:
+                time.sleep(args.window)
+                after = answer_counts(args.stats_url, args.timeout)
+                total = after['total'] - before['total']
+                slow = sum(after[bucket] - before[bucket] for bucket in SLOW_BUCKETS)
+                if total > 0 and slow / total > args.max_slow:
+                    raise HealthCheckFailed(f"{slow} of {total} answers took over a second")
+            return
+        except (HealthCheckFailed, urllib.error.URLError, OSError, ValueError) as e:
+            if time.monotonic() >= deadline:
+                raise HealthCheckFailed(str(e)) from None
+            print(f"Not healthy yet: {e}")
+            time.sleep(1)
+
+
+def install_release(args, zones):
+    """Installs validated zones as a new release and runs the health gate; returns False if it was rolled back."""
+    release = Release(args.root)
+    previous = release.current_name()
+    name = release.stage(zones)
+    release.activate(name)
+    print(f"Activated release {name}" + (f" (was {previous})" if previous else ""))
+    try:
+        reload_resolver(args.reload_cmd)
+        health_check(args)
+    except (HealthCheckFailed, subprocess.SubprocessError, OSError) as e:
+        print(f"Release {name} failed: {e}", file=sys.stderr)
+        if previous:
+            release.activate(previous)
+            shutil.rmtree(os.path.join(release.releases, name), ignore_errors=True)
+            print(f"Rolled back to release {previous}", file=sys.stderr)
+            try:
+                reload_resolver(args.reload_cmd)
+            except (subprocess.SubprocessError, OSError) as e:
+                print(f"Reloading after the rollback failed too: {e}", file=sys.stderr)
+        return False
+    release.prune(args.keep)
+    print(f"Release {name} is healthy")
+    return True
+
+
+def install(args):
+    for path in args.zones:
+        entries, invalid, errors = check_file(path, 'rpz')
+        for error in errors:
+            print(f"{path}: {error}", file=sys.stderr)
+        if not entries or invalid > entries * args.max_invalid:
+            sys.exit(f"{path}: {entries} entries, {invalid} invalid; not installing")
+    if not install_release(args, args.zones):
+        sys.exit(1)
+
+
+def update(args):
+    try:
+        feeds = load_manifest(args.manifest, args.source_dir)
+    except (ManifestError, OSError) as e:
+        sys.exit(str(e))
+    release = Release(args.root)
+    state_path = os.path.join(args.root, FEED_STATE_FILE)
+    try:
+        with open(state_path) as file:
+            states = json.load(file)
+    except (FileNotFoundError, ValueError):
+        states = {}
+    current = release.current_name()
+    installed_dir = current and os.path.join(release.releases, current)
+    staging = os.path.join(args.root, f".feeds.{os.getpid()}.tmp")
+    os.makedirs(staging)
+    try:
+        results = fetch_feeds(feeds, staging, states, installed_dir, force=args.force)
+        failed = False
+        for feed in feeds:
+            if feed.name not in results:
+                continue
+            path, state, error = results[feed.name]
+            if error:
+                failed = True
+                print(f"{feed.name}: failed, keeping the installed zone: {error}", file=sys.stderr)
+            else:
+                print(f"{feed.name}: {'updated' if path else 'unchanged'} from {state['url']}")
+        changed = {name: result for name, result in results.items() if result[0]}
+        # Record changed feeds only once they're installed, so a rolled back release is fetched again
+        states.update((name, state) for name, (path, state, error) in results.items() if not path and not error)
+        if changed:
+            if install_release(args, [path for path, _, _ in changed.values()]):
+                states.update((name, state) for name, (_, state, _) in changed.items())
+            else:
+                failed = True
+        elif results:
+            print("Nothing to install")
+        os.makedirs(args.root, exist_ok=True)
+        with open(f"{state_path}.tmp", 'w') as file:
+            json.dump(states, file, indent=1)
+        os.replace(f"{state_path}.tmp", state_path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+def rollback(args):
+    release = Release(args.root)
+    current = release.current_name()
+    older = [name for name in release.names() if current is None or name < current]
+    if not older:
+        sys.exit("No earlier release to roll back to")
+    release.activate(older[-1])
+    reload_resolver(args.reload_cmd)
+    print(f"Rolled back from release {current} to {older[-1]}")
+
+
+def add_release_arguments(parser):
+    """Adds the options of installing a release and its health gate."""
+    parser.add_argument('--keep', type=int, default=3, help="Releases to keep (default: %(default)s)")
+    parser.add_argument('--server', default='127.0.0.1', help="Resolver address (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=53, help="Resolver port (default: %(default)s)")
+    parser.add_argument('--check', action='append', metavar='NAME[=RCODE]', default=None,
+                        help="Test query and the rcode it must get, NOERROR unless given; repeatable "
+                             "(default: the root zone)")
+    parser.add_argument('--max-latency', type=float, default=500,
+                        help="Milliseconds each test query may take (default: %(default)s)")
+    parser.add_argument('--stats-url', default='http://127.0.0.1:8453/stats',
+                        help="kresd stats, for the share of slow answers; '' to skip (default: %(default)s)")
+    parser.add_argument('--max-slow', type=float, default=0.05,
+                        help="Share of answers that may take over a second (default: %(default)s)")
+    parser.add_argument('--window', type=float, default=5,
+                        help="Seconds of kresd's answers to check (default: %(default)s)")
+    parser.add_argument('--settle', type=float, default=30,
+                        help="Seconds to wait for the resolver to pass the checks (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=2, help="Seconds to wait for each answer (default: %(default)s)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Install RPZ zones atomically, with one reload and a health gate.")
+    parser.add_argument('--root', default='/etc/knot-resolver/rpz',
+                        help="Directory holding the releases and the `current` symlink (default: %(default)s)")
+    parser.add_argument('--reload-cmd', default='/usr/bin/sudo /usr/bin/systemctl reload knot-resolver',
+                        help="Command that reloads Knot Resolver (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    install_parser = commands.add_parser('install', help="Install zones as a new release")
+    install_parser.add_argument('zones', nargs='+', help="Zone files, installed under their own names")
+    install_parser.add_argument('--max-invalid', type=float, default=0.01,
+                                help="Fraction of invalid records to tolerate in a zone (default: %(default)s)")
+    add_release_arguments(install_parser)
+    install_parser.set_defaults(func=install)
+
+    update_parser = commands.add_parser('update', help="Fetch the feeds of a manifest and install those that changed")
+    update_parser.add_argument('--manifest', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adblock-feeds.json'),
+                               help="Feed manifest (default: %(default)s)")
+    update_parser.add_argument('--source-dir', help="Read each feed from DIR/<name> instead of its URLs, e.g. to test offline")
+    update_parser.add_argument('--force', action='store_true', help="Fetch every feed, even those not due yet")
+    add_release_arguments(update_parser)
+    update_parser.set_defaults(func=update)
+
+    rollback_parser = commands.add_parser('rollback', help="Go back to the previous release")
+    rollback_parser.set_defaults(func=rollback)
+    args = parser.parse_args(argv)
+    if args.command in ('install', 'update') and not args.check:
+        args.check = ['.']
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
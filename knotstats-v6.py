@@ -2,6 +2,9 @@
 # dependencies = [
 #     "flask>=2.0",
 #     "requests>=2.20",
+#     "gunicorn>=21.2",
+#     "brotli>=1.0",
+#     "lmdb>=1.4",
 # ]
 # ///
 #
@@ -23,26 +26,69 @@
 # http.config({})
 # ```
 #
+# Alternatively, `--control-socket '/run/knot-resolver/control/*'` reads stats
+# straight from each kresd worker's control socket, without the HTTP module.
+#
 # ## Usage
 #
 # 1. Install uv: https://docs.astral.sh/uv/guides/scripts/
 # 2. Run the dashboard: `uv run knotstats.py`
 # 3. Open http://127.0.0.1:5001 in your browser
 #
+# To serve many viewers, run it under gunicorn with several worker processes:
+# `uv run knotstats-v6.py --serve prod --workers 4`. Only one worker scrapes
+# Knot Resolver; the others read its results from a shared on-disk cache.
+#
 
-import requests
+import argparse
+import hashlib
 import json
 import os
 import subprocess
-from flask import Flask, render_template_string, jsonify
+import sys
+import threading
+import time
+from array import array
+from flask import Flask, Response, jsonify, request
+
+from knotstats_alerts import AlertEngine
+from knotstats_cache import CacheInspector
+from knotstats_dnstap import DnstapIngester
+from knotstats_federation import FederationCollector, FederationPublisher
+from knotstats_history import HistoryRecorder, HistoryReplay
+from knotstats_hosts import HostsFile, HostsImport, VersionConflict, validate_entry
+from knotstats_lookup import LookupIndex
+from knotstats_querylog import QueryLogIngester, TopPublisher, WindowedTop
+from knotstats_selfmetrics import register_self_metrics
+from knotstats_common import (ControlSocketCollector, Poller, SharedCache, StaticAssets, add_serve_arguments, default_cache_dir,
+                              entry_response, error_body, fetch_vendor_assets, looks_like_json_object, serve)
 
 # --- Configuration ---
 KNOT_RESOLVER_STATS_URL = "http://192.168.1.22:8888/metrics/json"
 HOSTS_FILE_PATH = "/etc/knot-resolver/hosts.local"
+# RPZ zones indexed for /api/lookup: the releases of knotstats-rpz.py, and zones installed directly
+RPZ_PATTERNS = ["/etc/knot-resolver/rpz/current/*.rpz", "/etc/knot-resolver/*.rpz"]
+# Directory holding kresd's LMDB cache (data.mdb), sampled by the Cache tab
+RESOLVER_CACHE_PATH = "/var/cache/knot-resolver"
+# Serve an inline scrape instead of the cached one once it is this old (seconds)
+STATS_MAX_AGE = 5.0
+# Lua evaluated on each worker by --control-socket
+CONTROL_EXPRESSION = "tojson({stats = stats.list(), worker = worker.stats(), cache = cache.stats()})"
+# Wire format the page requests from /api/stats: 'json' or 'columnar'
+STATS_WIRE_FORMAT = 'json'
+# Seconds of history kept for the live rate and latency percentile charts
+RATES_WINDOW = 300
+
+# Sample the resolver cache again once the last sample is this old (seconds)
+CACHE_SAMPLE_MAX_AGE = 30.0
+
+# Questions recorded by knotstats-warm.py, replayed after each reload (--warm-file)
+WARM_FILE = None
+WARM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'knotstats-warm.py')
 # --- Flask App ---
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 
-# --- HTML Template with Tailwind CSS, Chart.js, and JavaScript ---
+# --- HTML Template with Tailwind CSS, Chart.js, and JavaScript (served from static/) ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -50,14 +96,11 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Knot Resolver Stats Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
+    <link rel="stylesheet" href="{{ tailwind_css_url }}">
+    <script src="{{ chart_js_url }}"></script>
     <style>
         body {
-            font-family: 'Inter', sans-serif;
+            font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', Roboto, sans-serif;
             background-color: #f7fafc; /* gray-100 */
         }
         /* Custom card styling */
@@ -221,6 +264,42 @@ HTML_TEMPLATE = """
             border-radius: 0.375rem;
         }
 
+        /* Worker balance heatmap */
+        .heatmap-table {
+            border-collapse: separate;
+            border-spacing: 2px;
+            font-size: 0.75rem;
+        }
+        .heatmap-table th {
+            font-weight: 600;
+            color: #4a5568; /* text-gray-700 */
+            padding: 0.25rem 0.5rem;
+            text-align: left;
+            white-space: nowrap;
+        }
+        .heatmap-cell {
+            min-width: 3.5rem;
+            padding: 0.25rem 0.5rem;
+            text-align: center;
+            border-radius: 0.25rem;
+            color: #2d3748; /* text-gray-800 */
+        }
+        .heatmap-cell.flagged {
+            font-weight: 700;
+            outline: 2px solid #2d3748;
+        }
+        /* Top talkers tables */
+        .top-table td {
+            padding: 0.25rem 0.5rem;
+            border-bottom: 1px solid #edf2f7;
+            font-size: 0.875rem;
+            word-break: break-all;
+        }
+        .top-table td.top-count {
+            text-align: right;
+            white-space: nowrap;
+            color: #4a5568; /* text-gray-700 */
+        }
         /* Navigation tabs */
         .navigation-tabs {
             display: flex;
@@ -254,6 +333,8 @@ HTML_TEMPLATE = """
         <div class="navigation-tabs mt-4">
             <button id="dashboard-tab" class="nav-tab active">Dashboard</button>
             <button id="hosts-tab" class="nav-tab">Hosts Editor</button>
+            <button id="top-tab" class="nav-tab">Top Talkers</button>
+            <button id="cache-tab" class="nav-tab">Cache</button>
         </div>
     </header>
 
@@ -266,12 +347,39 @@ HTML_TEMPLATE = """
         </div>
 
         <div id="dashboard-content" style="display: none;">
+            <div id="alerts-banner" class="hosts-status-error p-3 mb-4" style="display: none;"></div>
+
             <div class="instance-selector">
                 <label for="instance-select" class="sr-only">Select Instance:</label>
                 <select id="instance-select" class="instance-select">
                     </select>
             </div>
 
+            <h2 class="section-title">Live (All Instances)</h2>
+            <div class="charts-grid">
+                <div class="chart-card">
+                    <div class="chart-title">Queries per Second</div>
+                    <canvas id="qpsChart"></canvas>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Cache Hit Rate (%)</div>
+                    <canvas id="cacheHitChart"></canvas>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Answer Latency Percentiles (ms)</div>
+                    <canvas id="latencyPercentileChart"></canvas>
+                </div>
+            </div>
+
+            <div id="imbalance-section" class="chart-card" style="display: none;">
+                <div class="chart-title">Worker Balance (load as a multiple of fair share)</div>
+                <div class="overflow-x-auto">
+                    <table id="imbalance-table" class="heatmap-table"></table>
+                </div>
+                <div id="imbalance-flags" class="mt-4 text-gray-700"></div>
+            </div>
+
+            <h2 class="section-title">Totals Since Start</h2>
             <div class="charts-grid">
                 <div class="chart-card">
                     <div class="chart-title">Answer Status Distribution</div>
@@ -300,10 +408,27 @@ HTML_TEMPLATE = """
             <h2 class="section-title">Hosts Editor</h2>
             <div class="hosts-editor-container">
                 <div class="p-4 mb-4 bg-white rounded-xl shadow-md">
-                    <div class="flex justify-between mb-4">
-                        <button id="add-host-btn" class="px-4 py-2 bg-blue-600 text-white rounded hover:bg-blue-700 transition">
-                            Add Host
+                    <form id="lookup-form" class="flex gap-2">
+                        <label for="lookup-name" class="sr-only">Name to look up</label>
+                        <input id="lookup-name" type="text" placeholder="Why is this name blocked? e.g. ads.example.com"
+                               class="flex-1 px-3 py-2 border border-gray-300 rounded">
+                        <button type="submit" class="px-4 py-2 bg-blue-600 text-white rounded hover:bg-blue-700 transition">
+                            Look Up
                         </button>
+                    </form>
+                    <div id="lookup-result" class="mt-2 text-sm text-gray-700"></div>
+                </div>
+                <div class="p-4 mb-4 bg-white rounded-xl shadow-md">
+                    <div class="flex justify-between mb-4">
+                        <div>
+                            <button id="add-host-btn" class="px-4 py-2 bg-blue-600 text-white rounded hover:bg-blue-700 transition">
+                                Add Host
+                            </button>
+                            <button id="import-hosts-btn" class="px-4 py-2 bg-gray-600 text-white rounded hover:bg-gray-700 transition">
+                                Import File
+                            </button>
+                            <input id="import-hosts-file" type="file" accept=".txt,.csv,.hosts,text/plain,text/csv" class="hidden">
+                        </div>
                         <button id="save-hosts-btn" class="px-4 py-2 bg-green-600 text-white rounded hover:bg-green-700 transition">
                             Save Changes
                         </button>
@@ -328,10 +453,61 @@ HTML_TEMPLATE = """
                 </div>
             </div>
         </div>
+
+        <div id="top-section" style="display: none;">
+            <h2 class="section-title">Top Talkers</h2>
+            <div class="instance-selector">
+                <label for="top-range-select" class="sr-only">Time range:</label>
+                <select id="top-range-select" class="instance-select">
+                    <option value="60">Last minute</option>
+                    <option value="300" selected>Last 5 minutes</option>
+                    <option value="900">Last 15 minutes</option>
+                </select>
+            </div>
+            <div id="top-summary" class="text-center text-gray-500 mb-4"></div>
+            <div class="charts-grid">
+                <div class="chart-card">
+                    <div class="chart-title">Query Names</div>
+                    <table class="min-w-full top-table"><tbody id="top-qname"></tbody></table>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Clients</div>
+                    <table class="min-w-full top-table"><tbody id="top-client"></tbody></table>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Query Types</div>
+                    <table class="min-w-full top-table"><tbody id="top-qtype"></tbody></table>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Response Codes</div>
+                    <table class="min-w-full top-table"><tbody id="top-rcode"></tbody></table>
+                </div>
+            </div>
+        </div>
+
+        <div id="cache-section" style="display: none;">
+            <h2 class="section-title">Resolver Cache</h2>
+            <div id="cache-summary" class="text-center text-gray-500 mb-4"></div>
+            <div class="charts-grid">
+                <div class="chart-card">
+                    <div class="chart-title">Size by RR Type</div>
+                    <table class="min-w-full top-table"><tbody id="cache-types"></tbody></table>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">TTL Remaining</div>
+                    <table class="min-w-full top-table"><tbody id="cache-ttl"></tbody></table>
+                </div>
+                <div class="chart-card">
+                    <div class="chart-title">Biggest Domains</div>
+                    <table class="min-w-full top-table"><tbody id="cache-domains"></tbody></table>
+                </div>
+            </div>
+        </div>
     </main>
 
     <footer>
-        Auto-refreshing every second.
+        Auto-refreshing every {{ '%g' % (refresh_ms / 1000) }}s.
+        {% if replay %}Replaying {{ replay }}.{% endif %}
     </footer>
 
     <script>
@@ -343,6 +519,7 @@ HTML_TEMPLATE = """
         const instanceSelect = document.getElementById('instance-select');
         const statsTitle = document.getElementById('stats-title');
         const statsApiUrl = '/api/stats';
+        const statsWireFormat = '{{ stats_wire_format }}'; // 'json' or 'columnar'
 
         let currentInstanceId = 'All'; // Default to 'All'
         let allStats = {}; // Will hold all instances stats
@@ -352,6 +529,9 @@ HTML_TEMPLATE = """
         let requestTypeChart = null;
         let answerLatencyChart = null;
         let answerSourceChart = null;
+        let qpsChart = null;
+        let cacheHitChart = null;
+        let latencyPercentileChart = null;
 
         // Chart configuration helper
         const chartColors = {
@@ -396,6 +576,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -424,6 +605,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -449,6 +631,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -481,6 +664,35 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
+                    plugins: { legend: { position: 'top' } }
+                }
+            });
+        }
+
+        // Line chart over the sliding window served by /api/rates
+        function initRateChart(ctx, datasets, suggestedMax) {
+            return new Chart(ctx, {
+                type: 'line',
+                data: {
+                    labels: [],
+                    datasets: datasets.map(dataset => ({
+                        label: dataset.label,
+                        data: [],
+                        borderColor: dataset.color,
+                        backgroundColor: dataset.color,
+                        borderWidth: 2,
+                        pointRadius: 0,
+                        tension: 0.2
+                    }))
+                },
+                options: {
+                    responsive: true,
+                    animation: false,
+                    scales: {
+                        x: { ticks: { maxTicksLimit: 6 } },
+                        y: { beginAtZero: true, suggestedMax: suggestedMax }
+                    },
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -488,10 +700,50 @@ HTML_TEMPLATE = """
 
         // --- Data Update Functions ---
 
+        // Charts changed while handling a response are redrawn together in the next animation
+        // frame, which browsers also hold back while the tab is hidden
+        const pendingCharts = new Set();
+        let chartFrame = null;
+
+        function scheduleChartUpdate(chart) {
+            pendingCharts.add(chart);
+            if (chartFrame === null) {
+                chartFrame = requestAnimationFrame(() => {
+                    chartFrame = null;
+                    pendingCharts.forEach(pending => pending.update('none'));
+                    pendingCharts.clear();
+                });
+            }
+        }
+
+        function updateRateCharts(rates) {
+            if (!qpsChart) {
+                qpsChart = initRateChart(document.getElementById('qpsChart').getContext('2d'),
+                    [{ label: 'QPS', color: chartColors.blue }]);
+                cacheHitChart = initRateChart(document.getElementById('cacheHitChart').getContext('2d'),
+                    [{ label: 'Hit %', color: chartColors.emerald }], 100);
+                latencyPercentileChart = initRateChart(document.getElementById('latencyPercentileChart').getContext('2d'), [
+                    { label: 'p50', color: chartColors.green },
+                    { label: 'p90', color: chartColors.amber },
+                    { label: 'p99', color: chartColors.red }
+                ]);
+            }
+            const labels = rates.t.map(t => new Date(t * 1000).toLocaleTimeString());
+            [
+                [qpsChart, [rates.qps]],
+                [cacheHitChart, [rates.cache_hit_percent]],
+                [latencyPercentileChart, [rates.p50_ms, rates.p90_ms, rates.p99_ms]]
+            ].forEach(([chart, series]) => {
+                chart.data.labels = labels;
+                series.forEach((data, i) => { chart.data.datasets[i].data = data; });
+                scheduleChartUpdate(chart);
+            });
+        }
+
         function updateChartData(chart, newData) {
             if (chart) {
                 chart.data.datasets[0].data = newData;
-                chart.update('none'); // 'none' prevents animation on update
+                scheduleChartUpdate(chart);
             }
         }
 
@@ -518,7 +770,21 @@ HTML_TEMPLATE = """
         }
 
         // Function to populate the instance selector dropdown
+        // Instances of a federated view are named site/instance
+        function siteOf(instance) {
+            const slash = instance.indexOf('/');
+            return slash > 0 ? instance.slice(0, slash) : null;
+        }
+
+        // Function to populate the instance selector dropdown
+        let instanceListKey = null;
         function populateInstanceSelector(instances) {
+            // Rebuilding hundreds of options every tick is wasteful; only do it when the list changes
+            const listKey = instances.join('\n');
+            if (listKey === instanceListKey) {
+                return;
+            }
+            instanceListKey = listKey;
             const previouslySelected = instanceSelect.value || currentInstanceId; // Remember what was selected
             instanceSelect.innerHTML = ''; // Clear existing options
 
@@ -528,12 +794,32 @@ HTML_TEMPLATE = """
             allOption.textContent = 'All Instances (Aggregated)';
             instanceSelect.appendChild(allOption);
 
-            // Add individual instance options
+            // Add individual instance options, grouped by site with a per-site aggregate when federated
+            const groups = new Map();
             instances.forEach(instance => {
-                const option = document.createElement('option');
-                option.value = instance;
-                option.textContent = instance;
-                instanceSelect.appendChild(option);
+                const site = siteOf(instance);
+                if (!groups.has(site)) {
+                    groups.set(site, []);
+                }
+                groups.get(site).push(instance);
+            });
+            groups.forEach((members, site) => {
+                let parent = instanceSelect;
+                if (site !== null) {
+                    parent = document.createElement('optgroup');
+                    parent.label = site;
+                    const siteOption = document.createElement('option');
+                    siteOption.value = `site:${site}`;
+                    siteOption.textContent = `${site} (Aggregated, ${members.length} instances)`;
+                    parent.appendChild(siteOption);
+                    instanceSelect.appendChild(parent);
+                }
+                members.forEach(instance => {
+                    const option = document.createElement('option');
+                    option.value = instance;
+                    option.textContent = instance;
+                    parent.appendChild(option);
+                });
             });
 
             // Try to re-select the previously selected option
@@ -665,14 +951,8 @@ HTML_TEMPLATE = """
             loadingState.style.display = 'none';
             errorState.style.display = 'none';
 
-            // Only show dashboard content if we're on the dashboard tab
-            if (activeTab === 'dashboard') {
-                dashboardContent.style.display = 'block';
-                hostsEditorSection.style.display = 'none';
-            } else {
-                dashboardContent.style.display = 'none';
-                // Don't change hostsEditorSection visibility - let the tab handler manage it
-            }
+            // Only show dashboard content if we're on the dashboard tab; showTab() manages the others
+            dashboardContent.style.display = activeTab === 'dashboard' ? 'block' : 'none';
 
             allStats = allInstancesData; // Store the latest full data
             const instanceIds = Object.keys(allInstancesData);
@@ -686,6 +966,11 @@ HTML_TEMPLATE = """
             if (currentInstanceId === 'All') {
                 dataToDisplay = aggregateStats(allInstancesData);
                 titleSuffix = ' (Aggregated)';
+            } else if (currentInstanceId.startsWith('site:')) {
+                const site = currentInstanceId.slice('site:'.length);
+                const siteData = Object.fromEntries(instanceIds.filter(id => siteOf(id) === site).map(id => [id, allInstancesData[id]]));
+                dataToDisplay = aggregateStats(siteData);
+                titleSuffix = ` (${site}, Aggregated)`;
             } else {
                 dataToDisplay = allInstancesData[currentInstanceId];
                 if (!dataToDisplay) {
@@ -778,19 +1063,152 @@ HTML_TEMPLATE = """
             console.error("Error fetching/processing stats:", error);
         }
 
-        // Function to fetch stats from the Flask backend
-        async function fetchStats() {
+        // Build an Error from a failed response, using the backend's JSON error message if present
+        async function responseError(response) {
+            let errorDetails = `HTTP error! Status: ${response.status}`;
             try {
-                const response = await fetch(statsApiUrl);
+                const errorData = await response.json();
+                if (errorData && errorData.error) { errorDetails = errorData.error; }
+            } catch (parseError) { /* Ignore if response is not JSON */ }
+            return new Error(errorDetails);
+        }
+
+        // Columnar stats: a cached key dictionary plus one Float64Array of values per fetch
+        let columnarDictionary = null;
+
+        async function fetchColumnarStats() {
+            const response = await fetch(`${statsApiUrl}?format=columnar`);
+            if (!response.ok) {
+                throw await responseError(response);
+            }
+            const dictionaryId = response.headers.get('X-Stats-Dictionary');
+            if (!dictionaryId) {
+                return await response.json(); // Backend fell back to JSON
+            }
+            const values = new Float64Array(await response.arrayBuffer());
+            if (!columnarDictionary || columnarDictionary.id !== dictionaryId) {
+                const dictionaryResponse = await fetch(`/api/stats/dictionary/${dictionaryId}`);
+                if (!dictionaryResponse.ok) {
+                    throw await responseError(dictionaryResponse);
+                }
+                columnarDictionary = await dictionaryResponse.json();
+                columnarDictionary.id = dictionaryId;
+            }
+            return decodeColumnarStats(columnarDictionary, values);
+        }
+
+        // Rebuild the {instance: {section: {key: value}}} structure from the dictionary and values
+        function decodeColumnarStats(dictionary, values) {
+            const keys = dictionary.keys;
+            const data = {};
+            dictionary.instances.forEach((instance, row) => {
+                const instanceData = {};
+                const offset = row * keys.length;
+                for (let i = 0; i < keys.length; i++) {
+                    const value = values[offset + i];
+                    if (Number.isNaN(value)) continue;
+                    const path = keys[i];
+                    let node = instanceData;
+                    for (let depth = 0; depth < path.length - 1; depth++) {
+                        node = node[path[depth]] || (node[path[depth]] = {});
+                    }
+                    node[path[path.length - 1]] = value;
+                }
+                data[instance] = instanceData;
+            });
+            return data;
+        }
+
+        async function fetchRates() {
+            try {
+                const response = await fetch('/api/rates');
                 if (!response.ok) {
-                    let errorDetails = `HTTP error! Status: ${response.status}`;
-                    try {
-                        const errorData = await response.json();
-                        if (errorData && errorData.error) { errorDetails = errorData.error; }
-                    } catch (parseError) { /* Ignore if response is not JSON */ }
-                    throw new Error(errorDetails);
+                    throw await responseError(response);
                 }
-                const data = await response.json();
+                updateRateCharts(await response.json());
+            } catch (error) {
+                console.error("Error fetching rates:", error); // Keep showing the stats even if rates fail
+            }
+        }
+
+        // --- Worker Balance Heatmap ---
+        const imbalanceSection = document.getElementById('imbalance-section');
+        const imbalanceTable = document.getElementById('imbalance-table');
+        const imbalanceFlags = document.getElementById('imbalance-flags');
+
+        // Blue below the fair share, red above it; full colour at 0x and 2x
+        function heatmapColor(ratio) {
+            if (ratio === null) return '#edf2f7';
+            const intensity = Math.min(1, Math.abs(ratio - 1)).toFixed(2);
+            return ratio >= 1 ? `rgba(239, 68, 68, ${intensity})` : `rgba(59, 130, 246, ${intensity})`;
+        }
+
+        function renderImbalance(report) {
+            if (report.instances.length < 2) {
+                imbalanceSection.style.display = 'none'; // Nothing to compare with a single worker
+                return;
+            }
+            imbalanceSection.style.display = 'block';
+            const flagged = new Set(report.flags.map(flag => `${flag.instance}|${flag.metric}`));
+            let html = '<tr><th>Instance</th>' + report.metrics.map(metric => `<th>${metric}</th>`).join('') + '</tr>';
+            report.instances.forEach((instance, row) => {
+                html += `<tr><th>${instance}</th>`;
+                report.metrics.forEach((metric, col) => {
+                    const ratio = report.ratio[row][col];
+                    const cellClass = flagged.has(`${instance}|${metric}`) ? 'heatmap-cell flagged' : 'heatmap-cell';
+                    html += `<td class="${cellClass}" style="background-color: ${heatmapColor(ratio)}"
+                        title="${report.rate[row][col].toLocaleString()}/s">${ratio === null ? '-' : ratio.toFixed(2)}</td>`;
+                });
+                html += '</tr>';
+            });
+            imbalanceTable.innerHTML = html;
+            imbalanceFlags.textContent = report.flags.length === 0 ? 'No hot or cold workers.' :
+                report.flags.map(flag => `${flag.instance} is ${flag.kind} on ${flag.metric} (${flag.ratio.toFixed(2)}x)`).join('; ');
+        }
+
+        async function fetchImbalance() {
+            try {
+                const response = await fetch('/api/imbalance');
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                renderImbalance(await response.json());
+            } catch (error) {
+                console.error("Error fetching worker balance:", error);
+            }
+        }
+
+        // --- Alerts ---
+        const alertsBanner = document.getElementById('alerts-banner');
+
+        async function fetchAlerts() {
+            try {
+                const response = await fetch('/api/alerts');
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                const firing = (await response.json()).rules.filter(rule => rule.firing);
+                alertsBanner.style.display = firing.length ? 'block' : 'none';
+                alertsBanner.innerHTML = firing.map(rule =>
+                    `<div><span class="font-semibold">${rule.name}</span> firing since
+                    ${new Date(rule.since * 1000).toLocaleTimeString()}: ${rule.message}</div>`).join('');
+            } catch (error) {
+                console.error("Error fetching alerts:", error);
+            }
+        }
+
+        async function fetchJsonStats() {
+            const response = await fetch(statsApiUrl);
+            if (!response.ok) {
+                throw await responseError(response);
+            }
+            return await response.json();
+        }
+
+        // Function to fetch stats from the Flask backend
+        async function fetchStats() {
+            try {
+                const data = statsWireFormat === 'columnar' ? await fetchColumnarStats() : await fetchJsonStats();
                 if (data.error) {
                     throw new Error(data.error);
                 }
@@ -799,6 +1217,9 @@ HTML_TEMPLATE = """
                     throw new Error("Received empty or invalid data structure from backend.");
                 }
                 updateDashboard(data); // Call the main update function
+                fetchRates();
+                fetchImbalance();
+                fetchAlerts();
             } catch (error) {
                 showError(error.message);
             }
@@ -819,52 +1240,146 @@ HTML_TEMPLATE = """
         // Track which tab is active
         let activeTab = 'dashboard';
 
-        // Modified fetchStats function that only updates UI when dashboard tab is active
-        function fetchStatsIfActive() {
-            if (activeTab === 'dashboard') {
-                fetchStats();
-            }
-        }
-
         // Fetch stats immediately on load
         fetchStats();
 
-        // Set interval to fetch stats every 1000ms (1 second)
-        setInterval(fetchStatsIfActive, 1000);
-
         // --- Hosts Editor Functionality ---
         const hostsEditorSection = document.getElementById('hosts-editor-section');
-        const dashboardTab = document.getElementById('dashboard-tab');
-        const hostsTab = document.getElementById('hosts-tab');
         const hostsTableBody = document.getElementById('hosts-table-body');
         const addHostBtn = document.getElementById('add-host-btn');
         const saveHostsBtn = document.getElementById('save-hosts-btn');
+        const importHostsBtn = document.getElementById('import-hosts-btn');
+        const importHostsFile = document.getElementById('import-hosts-file');
         const hostsStatus = document.getElementById('hosts-status');
+        // Rows rendered at once; imported block lists can hold hundreds of thousands
+        const hostsRenderLimit = 1000;
 
         let currentHosts = [];
         let hostsChanged = false;
+        // The entries and version as loaded; saving sends only the difference, against that version
+        let loadedHosts = [];
+        let hostsVersion = '';
 
-        // Tab navigation
-        dashboardTab.addEventListener('click', function() {
-            activeTab = 'dashboard';
-            dashboardContent.style.display = 'block';
-            hostsEditorSection.style.display = 'none';
-            dashboardTab.classList.add('active');
-            hostsTab.classList.remove('active');
+        // --- Top Talkers ---
+        const topSection = document.getElementById('top-section');
+        const topRangeSelect = document.getElementById('top-range-select');
+        const topSummary = document.getElementById('top-summary');
+        const topRows = 15;
 
-            // Fetch fresh stats when switching back to dashboard
-            fetchStats();
-        });
+        async function fetchTop() {
+            try {
+                const response = await fetch(`/api/top?range=${topRangeSelect.value}`);
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                renderTop(await response.json());
+            } catch (error) {
+                topSummary.textContent = error.message;
+                ['qname', 'client', 'qtype', 'rcode'].forEach(field => {
+                    document.getElementById(`top-${field}`).innerHTML = '';
+                });
+            }
+        }
+
+        function renderTop(report) {
+            topSummary.textContent = `${report.queries.toLocaleString()} queries in the last ${report.seconds / 60} min` +
+                (report.bad_lines ? ` (${report.bad_lines.toLocaleString()} unparseable log lines so far)` : '');
+            ['qname', 'client', 'qtype', 'rcode'].forEach(field => {
+                const tbody = document.getElementById(`top-${field}`);
+                const rows = report.top[field].slice(0, topRows);
+                if (rows.length === 0) {
+                    tbody.innerHTML = '<tr><td class="text-center text-gray-500">No queries yet.</td></tr>';
+                    return;
+                }
+                // Counts are exact unless an error bound is shown, from bounded-memory summaries
+                const error = report.error[field];
+                tbody.innerHTML = rows.map(([value, count]) => {
+                    const cell = document.createElement('td');
+                    cell.textContent = value; // Names come from the network; never inject them as HTML
+                    const percent = report.queries ? ` (${(count / report.queries * 100).toFixed(1)}%)` : '';
+                    return `<tr>${cell.outerHTML}<td class="top-count">${count.toLocaleString()}${error ? ` ±${error.toLocaleString()}` : ''}${percent}</td></tr>`;
+                }).join('');
+            });
+        }
+
+        topRangeSelect.addEventListener('change', fetchTop);
+
+        // --- Resolver Cache ---
+        const cacheSection = document.getElementById('cache-section');
+        const cacheSummary = document.getElementById('cache-summary');
+
+        async function fetchCache() {
+            try {
+                const response = await fetch('/api/cache');
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                renderCache(await response.json());
+            } catch (error) {
+                cacheSummary.textContent = error.message;
+                ['types', 'ttl', 'domains'].forEach(table => {
+                    document.getElementById(`cache-${table}`).innerHTML = '';
+                });
+            }
+        }
 
-        hostsTab.addEventListener('click', function() {
-            activeTab = 'hosts';
-            dashboardContent.style.display = 'none';
-            hostsEditorSection.style.display = 'block';
-            dashboardTab.classList.remove('active');
-            hostsTab.classList.add('active');
+        function cacheRow(label, entries, bytes) {
+            const cell = document.createElement('td');
+            cell.textContent = label;
+            return `<tr>${cell.outerHTML}<td class="top-count">~${entries.toLocaleString()} entries</td>` +
+                (bytes === undefined ? '' : `<td class="top-count">~${formatValue('bytes', bytes)}</td>`) + '</tr>';
+        }
 
-            // Load hosts data when switching to this tab
-            fetchHosts();
+        function renderCache(report) {
+            const sampledAt = new Date(report.t * 1000).toLocaleTimeString();
+            cacheSummary.textContent = `${report.entries.toLocaleString()} entries, ${formatValue('bytes', report.used_bytes)} ` +
+                `used of ${formatValue('bytes', report.map_bytes)}. Estimated from ${report.sampled.toLocaleString()} ` +
+                `sampled entries at ${sampledAt}.`;
+            document.getElementById('cache-types').innerHTML =
+                report.types.map(([type, entries, bytes]) => cacheRow(type, entries, bytes)).join('');
+            document.getElementById('cache-ttl').innerHTML =
+                report.ttl.map(([bucket, entries]) => cacheRow(bucket, entries)).join('');
+            document.getElementById('cache-domains').innerHTML =
+                report.domains.map(([domain, entries, bytes]) => cacheRow(domain, entries, bytes)).join('');
+        }
+
+        // --- Tab Navigation ---
+        // Each tab's button, section, what to load when it's shown and how often to reload it.
+        // The cache backend samples at most every 30 seconds however often the Cache tab asks.
+        const tabs = {
+            dashboard: { button: document.getElementById('dashboard-tab'), section: dashboardContent, onShow: fetchStats,
+                         refreshMs: {{ refresh_ms }} },
+            hosts: { button: document.getElementById('hosts-tab'), section: hostsEditorSection, onShow: fetchHosts },
+            top: { button: document.getElementById('top-tab'), section: topSection, onShow: fetchTop, refreshMs: 2000 },
+            cache: { button: document.getElementById('cache-tab'), section: cacheSection, onShow: fetchCache, refreshMs: 10000 },
+        };
+
+        function showTab(name) {
+            activeTab = name;
+            Object.entries(tabs).forEach(([tabName, tab]) => {
+                tab.section.style.display = tabName === name ? 'block' : 'none';
+                tab.button.classList.toggle('active', tabName === name);
+            });
+            if (name !== 'dashboard') {
+                loadingState.style.display = 'none';
+                errorState.style.display = 'none';
+            }
+            tabs[name].onShow();
+        }
+
+        Object.entries(tabs).forEach(([name, tab]) => tab.button.addEventListener('click', () => showTab(name)));
+
+        // Only the shown tab of a visible page polls. A page left in a background browser tab
+        // stops loading the browser and the backend, and catches up as soon as it's shown again.
+        Object.entries(tabs).forEach(([name, tab]) => {
+            if (tab.refreshMs) {
+                setInterval(() => { if (!document.hidden && activeTab === name) tab.onShow(); }, tab.refreshMs);
+            }
+        });
+        document.addEventListener('visibilitychange', () => {
+            if (!document.hidden && tabs[activeTab].refreshMs) {
+                tabs[activeTab].onShow();
+            }
         });
 
         // Fetch hosts from the API
@@ -879,10 +1394,16 @@ HTML_TEMPLATE = """
 
                 const data = await response.json();
                 currentHosts = data.hosts || [];
+                loadedHosts = currentHosts.slice();
+                hostsVersion = data.version || '';
+                hostsChanged = false;
                 renderHostsTable();
 
                 if (data.message) {
                     showHostsStatus(data.message, 'info');
+                } else if (data.invalid && data.invalid.length) {
+                    showHostsStatus(`${data.invalid.length} invalid line(s) in the hosts file are not shown and will be ignored or misread by Knot Resolver: ` +
+                        data.invalid.slice(0, 5).map(line => `line ${line.line}: ${line.error}`).join('; '), 'error');
                 }
             } catch (error) {
                 console.error('Error fetching hosts:', error);
@@ -902,7 +1423,7 @@ HTML_TEMPLATE = """
                 return;
             }
 
-            currentHosts.forEach((host, index) => {
+            currentHosts.slice(0, hostsRenderLimit).forEach((host, index) => {
                 const row = document.createElement('tr');
                 row.className = 'hosts-table-row';
                 row.innerHTML = `
@@ -915,6 +1436,10 @@ HTML_TEMPLATE = """
                 `;
                 hostsTableBody.appendChild(row);
             });
+            if (currentHosts.length > hostsRenderLimit) {
+                hostsTableBody.insertAdjacentHTML('beforeend', `<tr><td colspan="3" class="py-4 text-center text-gray-500">
+                    Showing the first ${hostsRenderLimit.toLocaleString()} of ${currentHosts.length.toLocaleString()} entries.</td></tr>`);
+            }
 
             // Add event listeners to the new buttons
             document.querySelectorAll('.host-edit-btn').forEach(btn => {
@@ -997,23 +1522,44 @@ HTML_TEMPLATE = """
             }
         }
 
-        // Save all hosts changes
+        // Entries in `hosts` that aren't in `other`, counting duplicates
+        function hostsMissingFrom(hosts, other) {
+            const counts = new Map();
+            other.forEach(host => {
+                const key = `${host.ip} ${host.hostname}`;
+                counts.set(key, (counts.get(key) || 0) + 1);
+            });
+            return hosts.filter(host => {
+                const key = `${host.ip} ${host.hostname}`;
+                const count = counts.get(key) || 0;
+                counts.set(key, count - 1);
+                return count <= 0;
+            });
+        }
+
+        // Save all hosts changes as a patch against the version they were loaded at
         async function saveAllHosts() {
             try {
                 const response = await fetch('/api/hosts', {
-                    method: 'POST',
+                    method: 'PATCH',
                     headers: {
                         'Content-Type': 'application/json'
                     },
-                    body: JSON.stringify({ hosts: currentHosts })
+                    body: JSON.stringify({
+                        version: hostsVersion,
+                        add: hostsMissingFrom(currentHosts, loadedHosts),
+                        remove: hostsMissingFrom(loadedHosts, currentHosts)
+                    })
                 });
 
                 const data = await response.json();
 
                 if (response.ok) {
+                    // Reload to pick up the entries as written, e.g. lowercased, and the new version
+                    await fetchHosts();
                     showHostsStatus(data.message || 'Hosts file updated successfully', 'success');
-                    hostsChanged = false;
                 } else {
+                    // On a conflict the edits stay on the page; reloading the tab shows the other changes
                     throw new Error(data.error || 'Failed to update hosts file');
                 }
             } catch (error) {
@@ -1022,6 +1568,32 @@ HTML_TEMPLATE = """
             }
         }
 
+        // Import a hosts or CSV file. The browser streams the file as the request body
+        // and the backend parses, validates and writes it, so nothing big runs on this page.
+        async function importHosts(file) {
+            if (hostsChanged && !confirm('Importing reloads the hosts list and discards your unsaved changes. Continue?')) {
+                return;
+            }
+            showHostsStatus(`Importing ${file.name} (${formatValue('bytes', file.size)})...`, 'info');
+            try {
+                const response = await fetch(`/api/hosts/import?version=${encodeURIComponent(hostsVersion)}`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'text/plain' },
+                    body: file
+                });
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                const report = await response.json();
+                hostsChanged = false;
+                await fetchHosts();
+                showHostsStatus(report.message + (report.errors.length ? ` First problems: ${report.errors.join('; ')}` : ''),
+                    report.invalid ? 'error' : 'success');
+            } catch (error) {
+                showHostsStatus(`Failed to import ${file.name}: ${error.message}`, 'error');
+            }
+        }
+
         // Show status message
         function showHostsStatus(message, type) {
             hostsStatus.textContent = message;
@@ -1043,9 +1615,68 @@ HTML_TEMPLATE = """
             }, 5000);
         }
 
+        // Look up which RPZ feed or hosts entry matches a name
+        const lookupForm = document.getElementById('lookup-form');
+        const lookupName = document.getElementById('lookup-name');
+        const lookupResult = document.getElementById('lookup-result');
+
+        async function lookupHost(name) {
+            lookupResult.textContent = `Looking up ${name}...`;
+            try {
+                const response = await fetch(`/api/lookup?name=${encodeURIComponent(name)}`);
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+                const result = await response.json();
+                lookupResult.innerHTML = '';
+                const summary = document.createElement('div');
+                summary.className = 'font-semibold mb-2';
+                summary.textContent = result.matched ?
+                    `${result.name} matches ${result.matches.length} rule(s):` :
+                    `${result.name} matches no rule in ${Object.keys(result.sources).join(', ') || 'any source'}.`;
+                lookupResult.appendChild(summary);
+                if (result.pending.length) {
+                    const note = document.createElement('div');
+                    note.className = 'mb-2 text-gray-500';
+                    note.textContent = `Still indexing ${result.pending.join(', ')}; try again shortly.`;
+                    lookupResult.appendChild(note);
+                }
+                result.matches.forEach(match => {
+                    const line = document.createElement('div');
+                    line.className = 'font-mono';
+                    line.textContent = `${match.action}  ${match.source}:${match.line}  ${match.rule}`;
+                    lookupResult.appendChild(line);
+                });
+                const below = Object.entries(result.below);
+                if (below.length) {
+                    const note = document.createElement('div');
+                    note.className = 'mt-2 text-gray-500';
+                    note.textContent = `Rules for names below ${result.name}: ` +
+                        below.map(([source, count]) => `${count.toLocaleString()} in ${source}`).join(', ') + '.';
+                    lookupResult.appendChild(note);
+                }
+            } catch (error) {
+                lookupResult.textContent = `Lookup failed: ${error.message}`;
+            }
+        }
+
+        lookupForm.addEventListener('submit', (event) => {
+            event.preventDefault();
+            if (lookupName.value.trim()) {
+                lookupHost(lookupName.value.trim());
+            }
+        });
+
         // Add event listeners
         addHostBtn.addEventListener('click', addHost);
         saveHostsBtn.addEventListener('click', saveAllHosts);
+        importHostsBtn.addEventListener('click', () => importHostsFile.click());
+        importHostsFile.addEventListener('change', () => {
+            if (importHostsFile.files.length) {
+                importHosts(importHostsFile.files[0]);
+                importHostsFile.value = '';
+            }
+        });
 
         // Check for unsaved changes when leaving the page
         window.addEventListener('beforeunload', (event) => {
@@ -1062,119 +1693,731 @@ HTML_TEMPLATE = """
 
 # --- Flask Routes ---
 
+# Set up in __main__; the page is rendered once at startup
+assets = None
+
+def render_index():
+    """Renders the main HTML page into the asset cache, or reuses the last rendering with the same settings."""
+    assets.render_page(app, '/', HTML_TEMPLATE, knot_resolver_url=KNOT_RESOLVER_STATS_URL,
+                       refresh_ms=round(poller.interval * 1000),
+                       replay=f"{replay.path} at {replay.speed:g}x speed" if replay else None,
+                       stats_wire_format=STATS_WIRE_FORMAT,
+                       tailwind_css_url=assets.url('tailwind.css'),
+                       chart_js_url=assets.vendor_url('vendor/chart.umd.min.js'))
+
 @app.route('/')
 def index():
-    """Renders the main HTML page."""
-    return render_template_string(HTML_TEMPLATE, knot_resolver_url=KNOT_RESOLVER_STATS_URL)
+    """Serves the pre-rendered main HTML page."""
+    return assets.page_response('/')
+
+# Set up in __main__ once the cache directory and scrape interval are known
+poller = None
+
+# Set up in __main__ from --control-socket; stats come from the metrics URL without it
+collector = None
+# Set up in __main__ from --federate; replaces scraping Knot Resolver with pulling other dashboards
+federation = None
+# Set up in __main__ from --replay; replaces scraping Knot Resolver with an exported history
+replay = None
+# Set up in __main__ unless --history-interval is 0
+history = None
+
+def fetch_control_stats():
+    """Collects stats from all kresd workers' control sockets in the /metrics/json layout; returns (status, JSON body)."""
+    workers, errors = collector.collect()
+    if errors:
+        app.logger.warning(f"Control socket errors: {errors}")
+    if not workers:
+        return 503, error_body(f"No Knot Resolver control sockets answered at {collector.pattern}.")
+    instances = {}
+    for worker, reply in workers.items():
+        # Empty Lua tables encode as [], hence the isinstance checks
+        sections = {name: dict(reply[name]) for name in ('worker', 'cache') if isinstance(reply.get(name), dict)}
+        stats = reply.get('stats')
+        for key, value in (stats.items() if isinstance(stats, dict) else ()):
+            section, _, name = key.partition('.')
+            sections.setdefault(section, {})[name] = value
+        instances[f"kresd:{worker}"] = sections
+    return 200, json.dumps(instances, separators=(',', ':')).encode()
+
+def fetch_stats():
+    """Fetches stats from Knot Resolver; returns (status, JSON body) for the scrape cache."""
+    if replay is not None:
+        return replay.fetch()
+    if federation is not None:
+        return federation.fetch()
+    if collector is not None:
+        return fetch_control_stats()
+    import requests  # Deferred to the first scrape, to keep startup fast
 
-@app.route('/api/stats')
-def get_stats():
-    """Fetches stats from Knot Resolver and returns as JSON."""
     try:
         response = requests.get(KNOT_RESOLVER_STATS_URL, timeout=0.5) # Short timeout for responsiveness
         response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-        stats_data = response.json()
 
-        # Basic validation: Check if it's a dictionary (expected format)
-        if not isinstance(stats_data, dict):
+        # Basic validation: Check it's a JSON object (expected format) without parsing it;
+        # the upstream bytes are passed through to clients unchanged
+        if not looks_like_json_object(response.content):
              app.logger.warning(f"Received non-dictionary data from {KNOT_RESOLVER_STATS_URL}")
-             return jsonify({"error": "Received unexpected data format from Knot Resolver."}), 500
+             return 500, error_body("Received unexpected data format from Knot Resolver.")
 
-        return jsonify(stats_data)
+        return 200, response.content
 
     except requests.exceptions.ConnectionError:
         app.logger.error(f"Connection refused to {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": f"Connection refused. Is Knot Resolver webmgmt running at {KNOT_RESOLVER_STATS_URL}?"}), 503 # Service Unavailable
+        return 503, error_body(f"Connection refused. Is Knot Resolver webmgmt running at {KNOT_RESOLVER_STATS_URL}?") # Service Unavailable
     except requests.exceptions.Timeout:
         app.logger.warning(f"Request timed out for {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": "Request timed out fetching stats from Knot Resolver."}), 504 # Gateway Timeout
+        return 504, error_body("Request timed out fetching stats from Knot Resolver.") # Gateway Timeout
     except requests.exceptions.HTTPError as e:
          app.logger.error(f"HTTP error fetching stats: {e}")
-         return jsonify({"error": f"HTTP error {e.response.status_code} from Knot Resolver: {e.response.reason}"}), e.response.status_code if e.response.status_code >= 500 else 500
+         return (e.response.status_code if e.response.status_code >= 500 else 500,
+                 error_body(f"HTTP error {e.response.status_code} from Knot Resolver: {e.response.reason}"))
     except requests.exceptions.RequestException as e:
         app.logger.error(f"General request error fetching stats: {e}")
-        return jsonify({"error": f"Failed to fetch stats: {str(e)}"}), 500 # Internal Server Error
-    except json.JSONDecodeError:
-        app.logger.error(f"Failed to decode JSON from {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": "Failed to decode JSON response from Knot Resolver."}), 500 # Internal Server Error
+        return 500, error_body(f"Failed to fetch stats: {str(e)}") # Internal Server Error
     except Exception as e:
         app.logger.error(f"Unexpected error in /api/stats: {e}", exc_info=True) # Log traceback for unexpected errors
-        return jsonify({"error": f"An unexpected server error occurred."}), 500 # Internal Server Error
+        return 500, error_body("An unexpected server error occurred.") # Internal Server Error
+
+def numeric_paths(value, path=()):
+    """Yields (path, number) for every numeric leaf of a nested stats dict."""
+    for key, item in value.items():
+        if isinstance(item, dict):
+            yield from numeric_paths(item, path + (key,))
+        elif isinstance(item, (int, float)) and not isinstance(item, bool):
+            yield path + (key,), item
+
+def encode_columnar(stats_data):
+    """Stores the scrape in the columnar wire format.
+
+    The dictionary lists the instances and the key paths of all numeric stats.
+    The values are one little-endian float64 per (instance, key), row-major by
+    instance, with NaN where an instance lacks a key. Non-numeric stats are
+    not included. The dictionary only changes when instances or keys do, so
+    clients fetch it once and then decode each scrape directly into a
+    Float64Array.
+    """
+    instances = sorted(stats_data)
+    rows = {instance: dict(numeric_paths(stats_data[instance])) if isinstance(stats_data[instance], dict) else {}
+            for instance in instances}
+    keys = sorted(set().union(*rows.values())) if rows else []
+    dictionary = json.dumps({"instances": instances, "keys": keys}, separators=(',', ':')).encode()
+    dictionary_id = hashlib.sha256(dictionary).hexdigest()[:16]
+    nan = float('nan')
+    values = array('d', (rows[instance].get(key, nan) for instance in instances for key in keys))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    poller.cache.put('stats.dictionary', dictionary, status=200, id=dictionary_id)
+    poller.cache.put('stats.columnar', values.tobytes(), status=200, dictionary=dictionary_id)
+
+# --- Rates Derived From Counter Deltas ---
+
+# kresd's answer latency histogram: (key, lower bound ms, upper bound ms); 'slow' is open-ended
+LATENCY_BUCKETS = [
+    ('1ms', 0, 1), ('10ms', 1, 10), ('50ms', 10, 50), ('100ms', 50, 100), ('250ms', 100, 250),
+    ('500ms', 250, 500), ('1000ms', 500, 1000), ('1500ms', 1000, 1500), ('slow', 1500, None),
+]
+
+class CounterDeltas:
+    """Per-instance deltas of kresd's cumulative counters between consecutive scrapes.
+
+    A counter that goes backwards means its worker restarted and counts from
+    zero again, so its current value is taken as the delta. Instances and
+    counters seen for the first time contribute nothing until their second
+    scrape, and counters that disappear are left out of the deltas.
+    """
+
+    def __init__(self):
+        self.previous = {}  # instance -> (time, {path: value})
+
+    def update(self, stats_data, now):
+        """Returns (elapsed seconds, {instance: {path: delta}}); elapsed is None on the first scrape.
+
+        The scrape's values stay available as {instance: (time, {path: value})} in `previous`.
+        """
+        deltas = {}
+        elapsed = None
+        previous, self.previous = self.previous, {}
+        for instance, instance_data in stats_data.items():
+            if not isinstance(instance_data, dict):
+                continue
+            current = dict(numeric_paths(instance_data))
+            self.previous[instance] = (now, current)
+            if instance not in previous:
+                continue
+            previous_time, previous_values = previous[instance]
+            elapsed = max(elapsed or 0.0, now - previous_time)
+            # A counter the instance didn't report last time (a module loaded, kresd upgraded)
+            # is only a baseline for now, like a new instance
+            deltas[instance] = {
+                path: value - previous_values[path] if value >= previous_values[path] else value
+                for path, value in current.items() if path in previous_values
+            }
+        return elapsed, deltas
+
+def histogram_percentile(counts, pct):
+    """Estimates the pct-th percentile in ms from LATENCY_BUCKETS counts, interpolating within a bucket."""
+    total = sum(counts)
+    if total <= 0:
+        return None
+    target = total * pct / 100.0
+    cumulative = 0
+    for (_, low, high), count in zip(LATENCY_BUCKETS, counts):
+        if count > 0 and cumulative + count >= target:
+            if high is None:
+                return low # Can't interpolate in the open-ended bucket
+            return round(low + (high - low) * (target - cumulative) / count, 3)
+        cumulative += count
+    return LATENCY_BUCKETS[-1][1]
+
+class RateTracker:
+    """Keeps a sliding window of QPS, cache hit rate and latency percentiles across all instances."""
+
+    SERIES = ('t', 'qps', 'cache_hit_percent', 'p50_ms', 'p90_ms', 'p99_ms')
+
+    def __init__(self, window):
+        self.window = window
+        self.series = None
+
+    def update(self, now, elapsed, deltas, current):
+        if self.series is None:
+            # Continue the window a previous scraper left in the shared cache
+            entry = poller.cache.get('stats.rates')
+            self.series = json.loads(entry.body) if entry else {name: [] for name in self.SERIES}
+        totals = {}
+        for instance_deltas in deltas.values():
+            for path, delta in instance_deltas.items():
+                totals[path] = totals.get(path, 0) + delta
+        answers = totals.get(('answer', 'total'), 0)
+        lookups = totals.get(('cache', 'lookup'), 0)
+        latency_counts = [totals.get(('answer', key), 0) for key, _, _ in LATENCY_BUCKETS]
+        point = {
+            't': round(now, 3),
+            'qps': round(answers / elapsed, 3),
+            'cache_hit_percent': round(totals.get(('cache', 'hit'), 0) / lookups * 100, 3) if lookups else None,
+            'p50_ms': histogram_percentile(latency_counts, 50),
+            'p90_ms': histogram_percentile(latency_counts, 90),
+            'p99_ms': histogram_percentile(latency_counts, 99),
+        }
+        for name in self.SERIES:
+            self.series[name].append(point[name])
+        # Drop points that have slid out of the window
+        expired = 0
+        while expired < len(self.series['t']) and self.series['t'][expired] < now - self.window:
+            expired += 1
+        if expired:
+            for name in self.SERIES:
+                del self.series[name][:expired]
+        poller.cache.put('stats.rates', json.dumps(self.series, separators=(',', ':')).encode(), status=200)
+
+class ImbalanceDetector:
+    """Flags kresd workers taking far more or less than their fair share of the load.
+
+    Each interval, every instance's share of each metric's rate is expressed as
+    a ratio to the fair share (1.0 = exactly 1/N of the total) and smoothed
+    with an EWMA. Ratios at or above `hot` or at or below `cold` are flagged,
+    as long as the metric's total rate is at least `min_rate` per second.
+    The metrics are every request.* and answer.* counter the instances report,
+    plus the workers' CPU time.
+    """
+
+    METRIC_GROUPS = ('request', 'answer')
+    CPU_METRICS = [('worker', 'usertime'), ('worker', 'systime')]
+
+    def __init__(self, hot=1.5, cold=0.5, min_rate=1.0, alpha=0.3):
+        self.hot = hot
+        self.cold = cold
+        self.min_rate = min_rate
+        self.alpha = alpha
+        self.ratios = {}  # (instance, metric) -> smoothed ratio
+
+    def update(self, now, elapsed, deltas, current):
+        instances = sorted(deltas)
+        # In the order kresd reports them, so latency buckets stay in order
+        reported = dict.fromkeys(path for instance in instances for path in deltas[instance])
+        metrics = ([path for path in reported if path[0] in self.METRIC_GROUPS]
+                   + [path for path in self.CPU_METRICS if path in reported])
+        ratios, rates, flags = [], [], []
+        smoothed = {}
+        totals = {path: sum(deltas[instance].get(path, 0) for instance in instances) for path in metrics}
+        for instance in instances:
+            ratio_row, rate_row = [], []
+            for path in metrics:
+                delta = deltas[instance].get(path, 0)
+                total_rate = totals[path] / elapsed
+                ratio = None
+                if len(instances) > 1 and totals[path] > 0:
+                    ratio = delta * len(instances) / totals[path]
+                    previous = self.ratios.get((instance, path))
+                    if previous is not None:
+                        ratio = previous + self.alpha * (ratio - previous)
+                    smoothed[(instance, path)] = ratio
+                    if total_rate >= self.min_rate and (ratio >= self.hot or ratio <= self.cold):
+                        flags.append({"instance": instance, "metric": '.'.join(path), "ratio": round(ratio, 3),
+                                      "kind": 'hot' if ratio >= self.hot else 'cold'})
+                ratio_row.append(None if ratio is None else round(ratio, 3))
+                rate_row.append(round(delta / elapsed, 3))
+            ratios.append(ratio_row)
+            rates.append(rate_row)
+        # Instances that went away start from scratch if they come back
+        self.ratios = smoothed
+        report = {
+            "t": round(now, 3), "instances": instances, "metrics": ['.'.join(path) for path in metrics],
+            "ratio": ratios, "rate": rates, "flags": flags, "hot": self.hot, "cold": self.cold,
+        }
+        poller.cache.put('stats.imbalance', json.dumps(report, separators=(',', ':')).encode(), status=200)
+
+class CounterTracker:
+    """Computes counter deltas once per scrape and feeds them to the rate, imbalance and alert consumers.
+
+    Consumers implement update(now, elapsed, deltas, current), where current is
+    {instance: {path: value}} for gauges.
+    """
+
+    def __init__(self, *consumers, clock=time.time):
+        self.deltas = CounterDeltas()
+        self.consumers = [consumer for consumer in consumers if consumer is not None]
+        self.clock = clock
+
+    def update(self, stats_data):
+        now = self.clock()
+        elapsed, deltas = self.deltas.update(stats_data, now)
+        if not elapsed:
+            return
+        current = {instance: values for instance, (_, values) in self.deltas.previous.items()}
+        for consumer in self.consumers:
+            consumer.update(now, elapsed, deltas, current)
+
+def start_poller():
+    """Starts the background scraper in this worker process."""
+    poller.start()
+
+@app.route('/api/stats')
+def get_stats():
+    """Returns the latest stats scraped from Knot Resolver as JSON, or columnar with ?format=columnar."""
+    try:
+        entry = poller.latest(STATS_MAX_AGE)
+        if entry.meta['status'] == 200 and request.args.get('format') == 'columnar':
+            columnar = poller.cache.get('stats.columnar')
+            if columnar is not None:
+                return entry_response(columnar, mimetype='application/octet-stream',
+                                      headers={'X-Stats-Dictionary': columnar.meta['dictionary']})
+        return entry_response(entry)
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /api/stats: {e}", exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+@app.route('/api/stats/dictionary/<dictionary_id>')
+def get_stats_dictionary(dictionary_id):
+    """Returns the key dictionary for columnar stats; immutable, since the id is its hash."""
+    entry = poller.cache.get('stats.dictionary')
+    if entry is None or entry.meta['id'] != dictionary_id:
+        return jsonify({"error": "Unknown or outdated stats dictionary."}), 404
+    return Response(entry.body, mimetype='application/json',
+                    headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+@app.route('/api/federation')
+def get_federation():
+    """Serves the latest federation snapshot to a central dashboard.
+
+    304 if ?base= is the latest version, the XOR against ?base= if that is the
+    previous version, otherwise the full snapshot; all zlib-compressed float64s.
+    """
+    poller.note_client()
+    full = poller.cache.get('federation.full')
+    if full is None:
+        return jsonify({"error": "No federation snapshot published yet."}), 404
+    headers = {'X-Federation-Version': full.meta['version'], 'X-Federation-Time': str(full.meta['time']),
+               'X-Stats-Dictionary': full.meta['dictionary'], 'Cache-Control': 'no-cache'}
+    base = request.args.get('base')
+    if base == full.meta['version']:
+        return Response(status=304, headers=headers)
+    delta = poller.cache.get('federation.delta')
+    if base and delta is not None and delta.meta['version'] == full.meta['version'] and delta.meta['base'] == base:
+        return Response(delta.body, mimetype='application/octet-stream', headers={**headers, 'X-Federation-Base': base})
+    return Response(full.body, mimetype='application/octet-stream', headers=headers)
+
+@app.route('/api/federation/dictionary/<dictionary_id>')
+def get_federation_dictionary(dictionary_id):
+    """Returns the key dictionary of the latest federation snapshot; immutable, since the id is its hash."""
+    entry = poller.cache.get('federation.dictionary')
+    if entry is None or entry.meta['id'] != dictionary_id:
+        return jsonify({"error": "Unknown or outdated federation dictionary."}), 404
+    return Response(entry.body, mimetype='application/json',
+                    headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+@app.route('/api/export')
+def get_export():
+    """Exports the recorded history for --replay: ?hours= up to ?until= (default now), at most one snapshot per ?step= seconds."""
+    if history is None:
+        return jsonify({"error": "Stats history is disabled (--history-interval 0)."}), 404
+    try:
+        until = float(request.args.get('until', time.time()))
+        hours = float(request.args.get('hours', 1))
+        step = float(request.args.get('step', 0))
+    except ValueError:
+        return jsonify({"error": "hours, until and step must be numbers."}), 400
+    filename = time.strftime('knotstats-%Y%m%d-%H%M%S.ksnap', time.gmtime(until))
+    return Response(history.export(until - hours * 3600, until, step), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/api/rates')
+def get_rates():
+    """Returns the sliding window of QPS, cache hit rate and latency percentiles as columns."""
+    poller.latest(STATS_MAX_AGE)
+    entry = poller.cache.get('stats.rates')
+    if entry is None:
+        return jsonify({name: [] for name in RateTracker.SERIES}), 200
+    return entry_response(entry)
+
+@app.route('/api/imbalance')
+def get_imbalance():
+    """Returns each worker's load as a ratio to its fair share, with hot/cold outliers flagged."""
+    poller.latest(STATS_MAX_AGE)
+    entry = poller.cache.get('stats.imbalance')
+    if entry is None:
+        return jsonify({"instances": [], "metrics": [], "ratio": [], "rate": [], "flags": []}), 200
+    return entry_response(entry)
+
+@app.route('/api/alerts')
+def get_alerts():
+    """Returns the state of each alert rule and the recent firing/resolved events."""
+    poller.latest(STATS_MAX_AGE)
+    entry = poller.cache.get('stats.alerts')
+    if entry is None:
+        return jsonify({"rules": [], "events": []}), 200
+    return entry_response(entry)
+
+@app.route('/api/top')
+def get_top():
+    """Returns the top query names, clients, query types and rcodes from the query log over ?range= seconds."""
+    seconds = request.args.get('range', '300')
+    if seconds not in {str(r) for r in TopPublisher.RANGES}:
+        return jsonify({"error": f"range must be one of {', '.join(map(str, TopPublisher.RANGES))}"}), 400
+    entry = poller.cache.get(f"querylog.top.{seconds}")
+    if entry is None:
+        return jsonify({"error": "Query log ingestion is not enabled. Start the dashboard with --querylog."}), 404
+    return entry_response(entry)
+
+# Set up in __main__ from --resolver-cache
+cache_inspector = None
+
+@app.route('/api/cache')
+def get_cache():
+    """Returns estimated resolver cache contents, sampling the cache at most every CACHE_SAMPLE_MAX_AGE seconds."""
+    entry = poller.cache.get('resolver.cache')
+    if entry is None or time.time() - entry.meta['updated'] > CACHE_SAMPLE_MAX_AGE:
+        try:
+            report = cache_inspector.sample()
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 503
+        entry = poller.cache.put('resolver.cache', json.dumps(report, separators=(',', ':')).encode(), status=200)
+    return entry_response(entry)
+
+# Set up in __main__ from --rpz and --hosts-file
+lookup_index = None
+
+@app.route('/api/lookup')
+def lookup():
+    """Returns the RPZ rules and hosts entries matching ?name=, e.g. to see why a name is blocked."""
+    name = request.args.get('name', '')
+    try:
+        return jsonify(lookup_index.lookup(name)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+# Set up in __main__ from --hosts-file
+hosts_file = None
 
 @app.route('/api/hosts', methods=['GET'])
 def get_hosts():
-    """Fetch contents of the hosts file."""
+    """Fetch contents of the hosts file, with the version edits must be based on and any invalid lines."""
     try:
-        if not os.path.exists(HOSTS_FILE_PATH):
-            return jsonify({"hosts": [], "message": "Hosts file does not exist yet. It will be created when you add entries."}), 200
-
-        with open(HOSTS_FILE_PATH, 'r') as file:
-            content = file.read()
-
-        # Parse hosts file into structured data
-        hosts = []
-        for line in content.splitlines():
-            line = line.strip()
-            if line and not line.startswith('#'):
-                parts = line.split()
-                if len(parts) >= 2:
-                    hosts.append({
-                        "ip": parts[0],
-                        "hostname": parts[1]
-                    })
-
-        return jsonify({"hosts": hosts}), 200
+        version, hosts, invalid = hosts_file.read()
+        if version is None:
+            return jsonify({"hosts": [], "invalid": [], "version": "",
+                            "message": "Hosts file does not exist yet. It will be created when you add entries."}), 200
+        return jsonify({"hosts": hosts, "invalid": invalid, "version": version}), 200
     except Exception as e:
         app.logger.error(f"Error reading hosts file: {e}", exc_info=True)
         return jsonify({"error": f"Failed to read hosts file: {str(e)}"}), 500
 
+def version_conflict(e):
+    return jsonify({"error": f"{e}. Reload the hosts list to see their changes.", "version": e.current or ""}), 409
+
+def start_cache_warmer():
+    """Replays WARM_FILE through the resolver in the background so a reload doesn't leave it with a cold cache."""
+    try:
+        warmer = subprocess.Popen([sys.executable, WARM_SCRIPT, 'replay', WARM_FILE, '--wait', '30'],
+                                  stdout=subprocess.DEVNULL)
+    except OSError as e:
+        app.logger.warning(f"Failed to start the cache warmer: {e}")
+        return
+    # Reap it when it exits, so a long-running worker doesn't collect zombies
+    threading.Thread(target=warmer.wait, name='knotstats-warmer', daemon=True).start()
+
+def reload_knot_resolver():
+    """Reloads Knot Resolver to apply hosts changes, then warms its cache; returns False if the reload failed."""
+    try:
+        subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'reload', 'knot-resolver'], check=True)
+    except (subprocess.SubprocessError, FileNotFoundError) as e:
+        app.logger.warning(f"Failed to reload Knot Resolver: {e}")
+        return False
+    if WARM_FILE:
+        start_cache_warmer()
+    return True
+
+@app.route('/api/hosts/import', methods=['POST'])
+def import_hosts():
+    """Adds the entries of an uploaded hosts or CSV file, as the request body or a multipart 'file' field.
+
+    ?mode=replace replaces the hosts file instead; ?dry_run=1 only validates. With
+    ?version= the import only goes ahead if the file is still at that version.
+    """
+    try:
+        upload = request.files['file'].stream if 'file' in request.files else request.stream
+        dry_run = request.args.get('dry_run') in ('1', 'true')
+        started = time.monotonic()
+        report = HostsImport(hosts_file, replace=request.args.get('mode') == 'replace').run(
+            upload, request.args.get('version'), dry_run=dry_run)
+        report["version"] = hosts_file.version() or ""
+        reload_success = True
+        if report['added'] and not dry_run:
+            reload_success = reload_knot_resolver()
+        report["message"] = (f"{'Would add' if dry_run else 'Added'} {report['added']} entries in "
+                             f"{time.monotonic() - started:.1f}s; skipped {report['duplicates']} duplicates and "
+                             f"{report['invalid']} invalid lines." +
+                             ("" if reload_success else " Failed to reload Knot Resolver."))
+        report["success"] = True
+        return jsonify(report), 200
+    except VersionConflict as e:
+        return version_conflict(e)
+    except Exception as e:
+        app.logger.error(f"Error importing hosts: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to import hosts: {str(e)}"}), 500
+
+@app.route('/api/hosts', methods=['PATCH'])
+def patch_hosts():
+    """Applies {"version", "add": [...], "remove": [...]} of {"ip", "hostname"} entries to the hosts file.
+
+    409 with the current version if the file changed since `version`.
+    """
+    try:
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict) or 'version' not in changes:
+            return jsonify({"error": "Send the version the changes are based on, as returned by GET /api/hosts."}), 428
+        version, added, removed = hosts_file.patch(changes['version'] or '', changes.get('add', []), changes.get('remove', []))
+        reload_success = True
+        if added or removed:
+            reload_success = reload_knot_resolver()
+        return jsonify({
+            "success": True,
+            "version": version,
+            "message": f"Hosts file updated: {added} added, {removed} removed" +
+                       ("" if reload_success else " but failed to reload Knot Resolver")
+        }), 200
+    except VersionConflict as e:
+        return version_conflict(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Error updating hosts file: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to update hosts file: {str(e)}"}), 500
+
 @app.route('/api/hosts', methods=['POST'])
 def update_hosts():
-    """Update the hosts file with new content."""
+    """Replace the hosts file with {"version", "hosts": [...]}; 409 if it changed since `version`."""
     try:
-        from flask import request
-
-        hosts_data = request.json.get('hosts', [])
+        body = request.get_json(silent=True) or {}
+        hosts_data = body.get('hosts', [])
+        if 'version' not in body:
+            return jsonify({"error": "Send the version the hosts are based on, as returned by GET /api/hosts."}), 428
 
         # Validate the data
-        for host in hosts_data:
-            if 'ip' not in host or 'hostname' not in host:
-                return jsonify({"error": "Each host must have both IP and hostname"}), 400
+        if not isinstance(hosts_data, list):
+            return jsonify({"error": "hosts must be a list"}), 400
+        try:
+            entries = [validate_entry(host) for host in hosts_data]
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Format hosts data into file content
-        content = ""
-        for host in hosts_data:
-            content += f"{host['ip']} {host['hostname']}\n"
-
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(HOSTS_FILE_PATH), exist_ok=True)
+        content = "".join(f"{ip} {hostname}\n" for ip, hostname in entries)
 
-        # Write the content to the file
-        with open(HOSTS_FILE_PATH, 'w') as file:
-            file.write(content)
+        with hosts_file.locked(body['version'] or ''):
+            version = hosts_file.write(content)
 
         # Reload Knot Resolver to apply changes
-        try:
-            subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'reload', 'knot-resolver'], check=True)
-            reload_success = True
-        except (subprocess.SubprocessError, FileNotFoundError) as e:
-            app.logger.warning(f"Failed to reload Knot Resolver: {e}")
-            reload_success = False
+        reload_success = reload_knot_resolver()
 
         return jsonify({
             "success": True,
+            "version": version,
             "message": "Hosts file updated successfully" +
                        ("" if reload_success else " but failed to reload Knot Resolver")
         }), 200
 
+    except VersionConflict as e:
+        return version_conflict(e)
     except Exception as e:
         app.logger.error(f"Error updating hosts file: {e}", exc_info=True)
         return jsonify({"error": f"Failed to update hosts file: {str(e)}"}), 500
 
 # --- Main Execution ---
+def parse_args(argv=None):
+    """Parses command line options, defaulting to the configuration above."""
+    parser = argparse.ArgumentParser(description="Knot Resolver stats dashboard.")
+    parser.add_argument('--stats-url', default=KNOT_RESOLVER_STATS_URL,
+                        help="Knot Resolver /metrics/json URL (default: %(default)s)")
+    parser.add_argument('--control-socket', metavar='GLOB',
+                        help="Read stats from kresd control sockets matching GLOB, e.g. '/run/knot-resolver/control/*', "
+                             "instead of --stats-url")
+    parser.add_argument('--hosts-file', default=HOSTS_FILE_PATH,
+                        help="Hosts file edited by the hosts editor (default: %(default)s)")
+    parser.add_argument('--rpz', action='append', metavar='GLOB',
+                        help=f"RPZ zones to index for name lookups; repeatable (default: {' '.join(RPZ_PATTERNS)})")
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=5001, help="Port to listen on (default: %(default)s)")
+    parser.add_argument('--wire-format', choices=['json', 'columnar'], default=STATS_WIRE_FORMAT,
+                        help="Format the page fetches stats in; columnar sends Float64 values plus a cached key dictionary (default: %(default)s)")
+    parser.add_argument('--rates-window', type=int, default=RATES_WINDOW,
+                        help="Seconds of history in the live rate charts (default: %(default)s)")
+    parser.add_argument('--imbalance-hot', type=float, default=1.5,
+                        help="Flag a worker whose load is at least this multiple of its fair share (default: %(default)s)")
+    parser.add_argument('--imbalance-cold', type=float, default=0.5,
+                        help="Flag a worker whose load is at most this multiple of its fair share (default: %(default)s)")
+    parser.add_argument('--federate', action='append', metavar='NAME=URL',
+                        help="Show another site's dashboard, pulling its snapshots instead of scraping Knot Resolver; "
+                             "repeat for each site")
+    parser.add_argument('--federation-interval', type=float, default=10.0,
+                        help="Seconds between the snapshots this dashboard publishes for central ones; 0 disables "
+                             "(default: %(default)s)")
+    parser.add_argument('--history-interval', type=float, default=10.0,
+                        help="Seconds between the snapshots kept for /api/export; 0 disables (default: %(default)s)")
+    parser.add_argument('--history-retention', type=float, default=24.0,
+                        help="Hours of snapshots to keep (default: %(default)s)")
+    parser.add_argument('--history-dir',
+                        help="Directory for the snapshots (default: history/ in the cache directory)")
+    parser.add_argument('--export', metavar='FILE',
+                        help="Write the recorded snapshots of the dashboard using the same --cache-dir or --port to FILE "
+                             "and exit")
+    parser.add_argument('--export-hours', type=float, default=24.0,
+                        help="Hours of snapshots to --export, up to now (default: %(default)s)")
+    parser.add_argument('--export-step', type=float, default=0.0,
+                        help="Keep at most one snapshot per this many seconds in --export (default: all)")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="Show the snapshots in an export instead of scraping Knot Resolver")
+    parser.add_argument('--replay-speed', type=float, default=60.0,
+                        help="How many times faster than recorded to --replay (default: %(default)s)")
+    parser.add_argument('--resolver-cache', default=RESOLVER_CACHE_PATH,
+                        help="kresd cache directory sampled read-only by the Cache tab (default: %(default)s)")
+    parser.add_argument('--warm-file',
+                        help="Questions recorded with knotstats-warm.py record, replayed after the hosts editor reloads Knot Resolver")
+    parser.add_argument('--alert-rules',
+                        help="JSON file of alert rules evaluated on every scrape (see knotstats-alerts.example.json)")
+    parser.add_argument('--querylog',
+                        help="Query log to ingest for the Top Talkers tab: a file to follow, or unix:/path to listen on")
+    parser.add_argument('--querylog-format', choices=['text', 'json', 'dnstap'], default='text',
+                        help="text: '[timestamp] client qname qtype rcode' per line; json: one object per line; "
+                             "dnstap: Frame Streams from kresd's dnstap module, needs a unix: source (default: %(default)s)")
+    parser.add_argument('--querylog-processes', type=int, default=os.cpu_count(),
+                        help="Processes decoding dnstap (default: %(default)s)")
+    add_serve_arguments(parser)
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.fetch_assets:
+        fetch_vendor_assets()
+        raise SystemExit(0)
+    cache_dir = args.cache_dir or default_cache_dir(args.port)
+    history_dir = args.history_dir or os.path.join(cache_dir, 'history')
+    if args.export:
+        recorder = HistoryRecorder(None, history_dir, args.history_interval, args.history_retention * 3600)
+        with open(args.export, 'wb') as file:
+            file.write(recorder.export(time.time() - args.export_hours * 3600, time.time(), args.export_step))
+        print(f"Wrote {os.path.getsize(args.export)} bytes of snapshots from {history_dir} to {args.export}")
+        raise SystemExit(0)
+    KNOT_RESOLVER_STATS_URL = args.stats_url
+    if args.replay:
+        try:
+            replay = HistoryReplay(args.replay, args.replay_speed)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Can't replay {args.replay}: {e}")
+    if args.control_socket:
+        collector = ControlSocketCollector(args.control_socket, CONTROL_EXPRESSION)
+    if args.federate:
+        try:
+            federation = FederationCollector.from_args(args.federate)
+        except ValueError as e:
+            raise SystemExit(f"Invalid --federate: {e}")
+    HOSTS_FILE_PATH = args.hosts_file
+    hosts_file = HostsFile(HOSTS_FILE_PATH)
+    RPZ_PATTERNS = args.rpz or RPZ_PATTERNS
+    lookup_index = LookupIndex(RPZ_PATTERNS, HOSTS_FILE_PATH, os.path.join(cache_dir, 'lookup'))
+    WARM_FILE = args.warm_file
+    STATS_WIRE_FORMAT = args.wire_format
+    poller = Poller(SharedCache(cache_dir), fetch_stats,
+                    interval=args.scrape_interval, idle_interval=args.idle_interval, idle_after=args.idle_after,
+                    max_interval=args.max_interval, scrape_inline=replay is None)
+    poller.add_hook(encode_columnar)
+    if args.federation_interval:
+        poller.add_hook(FederationPublisher(poller.cache, args.federation_interval).update, every_scrape=True)
+    if args.history_interval and replay is None:
+        history = HistoryRecorder(poller.cache, history_dir, args.history_interval, args.history_retention * 3600)
+        poller.add_hook(history.update, every_scrape=True)
+        poller.add_leader_task(history.run)
+    alert_engine = None
+    if args.alert_rules:
+        try:
+            alert_engine = AlertEngine.from_file(args.alert_rules, poller.cache)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Failed to load alert rules from {args.alert_rules}: {e}")
+        print(f"Loaded {len(alert_engine.rules)} alert rules from {args.alert_rules}")
+        if args.idle_interval == 0:
+            # Alert rules must keep seeing scrapes while nobody is watching
+            poller.idle_interval = 30.0
+            print("Alert rules are loaded; scraping every 30s instead of suspending when idle")
+    counter_tracker = CounterTracker(RateTracker(args.rates_window),
+                                     ImbalanceDetector(hot=args.imbalance_hot, cold=args.imbalance_cold),
+                                     alert_engine, clock=replay.clock if replay else time.time)
+    if replay is not None:
+        # Rates from a previous run would be on another clock
+        try:
+            os.unlink(poller.cache.path('stats.rates'))
+        except FileNotFoundError:
+            pass
+        replay.start(poller.cache)
+    # An unchanged federated view or replay means no new snapshot yet, not an idle resolver,
+    # so it mustn't count as zero deltas
+    poller.add_hook(counter_tracker.update, every_scrape=federation is None and replay is None)
+    if alert_engine is not None:
+        poller.add_failure_hook(alert_engine.scrape_failed)
+    poller.add_leader_task(lookup_index.run)
+    if args.querylog:
+        top_talkers = WindowedTop()
+        if args.querylog_format == 'dnstap':
+            try:
+                ingester = DnstapIngester(args.querylog, top_talkers, args.querylog_processes)
+            except ValueError as e:
+                raise SystemExit(f"Can't read dnstap from {args.querylog}: {e}")
+        else:
+            ingester = QueryLogIngester(args.querylog, args.querylog_format, top_talkers)
+        poller.add_leader_task(ingester.run)
+        poller.add_leader_task(TopPublisher(top_talkers, poller.cache).run)
+    cache_inspector = CacheInspector(args.resolver_cache)
+    assets = StaticAssets(cache=poller.cache)
+    assets.register(app)
+    register_self_metrics(app, poller.cache, profiling=args.profiling)
+    render_index()
     print("Starting Flask server for Knot Resolver Stats UI...")
-    print(f"Fetching stats from: {KNOT_RESOLVER_STATS_URL}")
-    print("Access the UI at: http://127.0.0.1:5001")
-    # Use waitress or gunicorn for production instead of Flask's development server
-    app.run(host='0.0.0.0', port=5001, debug=False) # Turn off debug for production/general use
+    if replay is not None:
+        print(f"Replaying {args.replay} at {args.replay_speed:g}x speed")
+    elif federation is not None:
+        print(f"Federating sites: {', '.join(f'{site.name} ({site.url})' for site in federation.sites)}")
+    else:
+        print(f"Fetching stats from: {args.control_socket or KNOT_RESOLVER_STATS_URL}")
+    print(f"Access the UI at: http://127.0.0.1:{args.port}")
+    if args.serve == 'prod':
+        print(f"Serving with gunicorn: {args.workers} workers x {args.threads} threads")
+    serve(app, args, start_poller)
@@ -0,0 +1,262 @@
+# /// script
+# dependencies = []
+# ///
+#
+# ################################################################################
+# # Knot Resolver Cache Warmer
+# ################################################################################
+#
+# Records the most popular (name, type) questions from a query log and replays
+# them through the resolver after a restart or reload, so its cache is warm
+# again within seconds instead of filling up from live traffic over minutes.
+#
+# ## Usage
+#
+# ```
+# uv run knotstats-warm.py record /var/log/knot-resolver/queries.log popular.gz --top 20000
+# uv run knotstats-warm.py record queries.log popular.gz --follow 600   # sample live traffic for 10 minutes
+# uv run knotstats-warm.py replay popular.gz --server 127.0.0.1 --rate 2000 --wait 30
+# ```
+#
+# Query logs use the same formats as `knotstats-v6.py --querylog`: text lines
+# `[timestamp] client qname qtype rcode`, or JSON objects with `qname` and
+# `qtype` (`--format json`).
+#
+# The recorded file is gzipped text, one `qname qtype count` line per question,
+# most popular first. Replay sends the questions over UDP at `--rate` per
+# second with up to `--concurrency` outstanding, and prints how they were
+# answered. `--wait` first waits for the resolver to answer at all, which suits
+# a systemd `ExecStartPost=`; `knotstats-v6.py --warm-file` replays after the
+# reloads the hosts editor triggers.
+#
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import struct
+import sys
+import time
+from collections import Counter, deque
+
+# Reading the query log
+READ_SIZE = 1 << 20
+
+QTYPES = {
+    'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28, 'SRV': 33,
+    'NAPTR': 35, 'DS': 43, 'DNSKEY': 48, 'TLSA': 52, 'SVCB': 64, 'HTTPS': 65, 'CAA': 257,
+}
+RCODES = ('NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED')
+
+FILE_HEADER = '# knotstats-warm v1'
+
+
+def count_questions(lines, fmt):
+    """Returns a Counter of (qname, qtype) for query log lines."""
+    questions = []
+    for line in lines:
+        if fmt == 'json':
+            try:
+                record = json.loads(line)
+                questions.append((str(record['qname']), str(record['qtype'])))
+            except (ValueError, KeyError, TypeError):
+                continue
+        else:
+            fields = line.split()
+            if len(fields) in (4, 5):
+                questions.append((fields[-3], fields[-2]))
+    counts = Counter()
+    for (qname, qtype), count in Counter(questions).items():
+        counts[(qname.rstrip('.').lower() or '.', qtype.upper())] += count
+    return counts
+
+
+def read_log(path, fmt, follow=0):
+    """Counts the questions in a query log; with follow, only those appended in the next `follow` seconds."""
+    counts = Counter()
+    pending = b''
+    with open(path, 'rb') as file:
+        if follow:
+            file.seek(0, os.SEEK_END)
+        deadline = time.monotonic() + follow
+        while True:
+            chunk = file.read(READ_SIZE)
+            if chunk:
+                complete, _, pending = (pending + chunk).rpartition(b'\n')
+                counts.update(count_questions(complete.decode('utf-8', 'replace').split('\n'), fmt))
+            elif follow and time.monotonic() < deadline:
+                time.sleep(0.2)
+            else:
+                return counts
+
+
+def write_questions(path, counts, top):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with gzip.open(tmp_path, 'wt') as file:
+        file.write(f"{FILE_HEADER} {int(time.time())}\n")
+        for (qname, qtype), count in counts.most_common(top):
+            file.write(f"{qname} {qtype} {count}\n")
+    os.replace(tmp_path, path)
+
+
+def read_questions(path, limit=None):
+    questions = []
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            if line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) >= 2:
+                questions.append((fields[0], fields[1]))
+                if limit and len(questions) == limit:
+                    break
+    return questions
+
+
+def encode_query(query_id, qname, qtype):
+    """Returns a recursive DNS query for qname/qtype in wire format; raises ValueError for names DNS can't carry."""
+    if qtype.startswith('TYPE') and qtype[4:].isdigit():
+        type_code = int(qtype[4:])
+    else:
+        type_code = QTYPES[qtype]
+    labels = [] if qname == '.' else (qname[:-1] if qname.endswith('.') else qname).split('.')
+    encoded = [label.encode('ascii') for label in labels]
+    if not all(0 < len(label) <= 63 for label in encoded):
+        raise ValueError(f"{qname!r} has an empty label or one over 63 bytes")
+    wire = b''.join(bytes([len(label)]) + label for label in encoded) + b'\0'
+    if len(wire) > 255:
+        raise ValueError(f"{qname!r} is over 255 bytes")
+    return struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + wire + struct.pack('>HH', type_code, 1)
+
+
+class ReplyProtocol(asyncio.DatagramProtocol):
+    """Resolves the pending query future matching each reply's ID."""
+
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 4:
+            future = self.pending.get(struct.unpack_from('>H', data)[0])
+            if future is not None and not future.done():
+                future.set_result(data[3] & 0x0f)
+
+
+async def wait_for_resolver(server, port, seconds):
+    """Sends a root NS query every second until it's answered; returns False if `seconds` run out."""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        results = await replay_questions([('.', 'NS')], server, port, rate=1, concurrency=1, timeout=1.0)
+        if results['answered']:
+            return True
+    return False
+
+
+async def replay_questions(questions, server, port, rate, concurrency, timeout):
+    """Sends the questions at `rate` per second; returns answer, rcode and timeout counts."""
+    loop = asyncio.get_running_loop()
+    pending = {}
+    transport, _ = await loop.create_datagram_endpoint(lambda: ReplyProtocol(pending), remote_addr=(server, port))
+    # Outstanding queries each hold a distinct ID; IDs are reused once answered or timed out
+    free_ids = deque(random.sample(range(1 << 16), 1 << 16))
+    slots = asyncio.Semaphore(min(concurrency, len(free_ids)))
+    results = {"sent": 0, "answered": 0, "timeouts": 0, "rcodes": Counter()}
+
+    async def ask(query_id, query):
+        future = loop.create_future()
+        pending[query_id] = future
+        try:
+            transport.sendto(query)
+            rcode = await asyncio.wait_for(future, timeout)
+            results["answered"] += 1
+            results["rcodes"][RCODES[rcode] if rcode < len(RCODES) else f"RCODE{rcode}"] += 1
+        except asyncio.TimeoutError:
+            results["timeouts"] += 1
+        finally:
+            del pending[query_id]
+            free_ids.append(query_id)
+            slots.release()
+
+    tasks = []
+    start = time.monotonic()
+    try:
+        for index, (qname, qtype) in enumerate(questions):
+            delay = start + index / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                query = encode_query(0, qname, qtype)
+            except (KeyError, UnicodeEncodeError, ValueError):
+                continue  # A type or name that can't be sent as recorded
+            await slots.acquire()
+            query_id = free_ids.popleft()
+            tasks.append(asyncio.create_task(ask(query_id, struct.pack('>H', query_id) + query[2:])))
+            results["sent"] += 1
+        await asyncio.gather(*tasks)
+    finally:
+        transport.close()
+    results["seconds"] = round(time.monotonic() - start, 3)
+    return results
+
+
+def record(args):
+    counts = read_log(args.querylog, args.format, args.follow)
+    write_questions(args.output, counts, args.top)
+    total = sum(counts.values())
+    kept = sum(count for _, count in counts.most_common(args.top))
+    print(f"Recorded {min(args.top, len(counts))} of {len(counts)} distinct questions to {args.output}, "
+          f"covering {kept / total * 100 if total else 0:.1f}% of {total} queries")
+
+
+def replay(args):
+    questions = read_questions(args.file, args.limit)
+    if args.wait and not asyncio.run(wait_for_resolver(args.server, args.port, args.wait)):
+        sys.exit(f"{args.server}:{args.port} didn't answer within {args.wait} seconds")
+    results = asyncio.run(replay_questions(questions, args.server, args.port, args.rate, args.concurrency,
+                                           args.timeout))
+    rcodes = ', '.join(f"{rcode} {count}" for rcode, count in results["rcodes"].most_common())
+    print(f"Replayed {results['sent']} questions in {results['seconds']}s: {results['answered']} answered "
+          f"({rcodes or 'none'}), {results['timeouts']} timed out")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Record popular questions and replay them to warm a resolver's cache.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help="Count questions in a query log and save the most popular")
+    record_parser.add_argument('querylog', help="Query log file")
+    record_parser.add_argument('output', help="File to write (gzipped text)")
+    record_parser.add_argument('--format', choices=['text', 'json'], default='text',
+                               help="Query log format, as for knotstats-v6.py --querylog-format (default: %(default)s)")
+    record_parser.add_argument('--top', type=int, default=20000, help="Questions to keep (default: %(default)s)")
+    record_parser.add_argument('--follow', type=float, default=0,
+                               help="Instead of reading the whole log, count what's appended over this many seconds")
+    record_parser.set_defaults(func=record)
+
+    replay_parser = commands.add_parser('replay', help="Send recorded questions to the resolver")
+    replay_parser.add_argument('file', help="File written by record")
+    replay_parser.add_argument('--server', default='127.0.0.1', help="Resolver address (default: %(default)s)")
+    replay_parser.add_argument('--port', type=int, default=53, help="Resolver port (default: %(default)s)")
+    replay_parser.add_argument('--rate', type=float, default=2000, help="Queries per second (default: %(default)s)")
+    replay_parser.add_argument('--concurrency', type=int, default=256,
+                               help="Most queries outstanding at once (default: %(default)s)")
+    replay_parser.add_argument('--timeout', type=float, default=3.0,
+                               help="Seconds to wait for each answer (default: %(default)s)")
+    replay_parser.add_argument('--limit', type=int, help="Replay only the most popular N questions")
+    replay_parser.add_argument('--wait', type=float, default=0,
+                               help="Wait up to this many seconds for the resolver to come up first")
+    replay_parser.set_defaults(func=replay)
+    args = parser.parse_args(argv)
+    if args.func is replay:
+        if not args.rate > 0:
+            parser.error("--rate must be more than 0")
+        if args.concurrency < 1:
+            parser.error("--concurrency must be at least 1")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
@@ -2,6 +2,8 @@
 # dependencies = [
 #   "flask>=2.0",
 #   "requests>=2.20",
+#   "gunicorn>=21.2",
+#   "brotli>=1.0",
 # ]
 # ///
 #
@@ -23,23 +25,38 @@
 # http.config({})
 # ```
 #
+# Alternatively, `--control-socket '/run/knot-resolver/control/*'` reads stats
+# straight from each kresd worker's control socket, without the HTTP module.
+#
 # ## Usage
 #
 # 1. Install uv: https://docs.astral.sh/uv/guides/scripts/
 # 2. Run the dashboard: `uv run knotstats.py`
 # 3. Open http://127.0.0.1:5001 in your browser
 #
+# To serve many viewers, run it under gunicorn with several worker processes:
+# `uv run knotstats.py --serve prod --workers 4`. Only one worker scrapes
+# Knot Resolver; the others read its results from a shared on-disk cache.
+#
 
-import requests
+import argparse
 import json
-from flask import Flask, render_template_string, jsonify
+from flask import Flask
+
+from knotstats_common import (ControlSocketCollector, Poller, SharedCache, StaticAssets, add_serve_arguments, default_cache_dir,
+                              entry_response, error_body, fetch_vendor_assets, looks_like_json_object, serve)
+from knotstats_selfmetrics import register_self_metrics
 
 # --- Configuration ---
 KNOT_RESOLVER_STATS_URL = "http://127.0.0.1:8453/stats"
+# Serve an inline scrape instead of the cached one once it is this old (seconds)
+STATS_MAX_AGE = 5.0
+# Lua evaluated on each worker by --control-socket
+CONTROL_EXPRESSION = "tojson(stats.list())"
 # --- Flask App ---
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 
-# --- HTML Template with Tailwind CSS, Chart.js, and JavaScript ---
+# --- HTML Template with Tailwind CSS, Chart.js, and JavaScript (served from static/) ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -47,14 +64,11 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Knot Resolver Stats Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
+    <link rel="stylesheet" href="{{ tailwind_css_url }}">
+    <script src="{{ chart_js_url }}"></script>
     <style>
         body {
-            font-family: 'Inter', sans-serif;
+            font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', Roboto, sans-serif;
             background-color: #f7fafc; /* gray-100 */
         }
         /* Custom card styling */
@@ -192,7 +206,7 @@ HTML_TEMPLATE = """
     </main>
 
     <footer>
-        Auto-refreshing every second.
+        Auto-refreshing every {{ '%g' % (refresh_ms / 1000) }}s.
     </footer>
 
     <script>
@@ -245,6 +259,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -271,6 +286,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     plugins: { legend: { position: 'top' } }
                 }
             });
@@ -303,6 +319,7 @@ HTML_TEMPLATE = """
                 data: chartData,
                 options: {
                     responsive: true,
+                    animation: false,
                     scales: { y: { beginAtZero: true, title: { display: true, text: 'Number of Queries' } } },
                     plugins: { legend: { display: false } } // Hide legend for bar chart if desired
                 }
@@ -311,10 +328,26 @@ HTML_TEMPLATE = """
 
         // --- Data Update Functions ---
 
+        // Charts changed while handling a response are redrawn together in the next animation
+        // frame, which browsers also hold back while the tab is hidden
+        const pendingCharts = new Set();
+        let chartFrame = null;
+
+        function scheduleChartUpdate(chart) {
+            pendingCharts.add(chart);
+            if (chartFrame === null) {
+                chartFrame = requestAnimationFrame(() => {
+                    chartFrame = null;
+                    pendingCharts.forEach(pending => pending.update('none'));
+                    pendingCharts.clear();
+                });
+            }
+        }
+
         function updateChartData(chart, newData) {
             if (chart) {
                 chart.data.datasets[0].data = newData;
-                chart.update();
+                scheduleChartUpdate(chart);
             }
         }
 
@@ -423,8 +456,10 @@ HTML_TEMPLATE = """
         // Fetch stats immediately on load
         fetchStats();
 
-        // Set interval to fetch stats every 1000ms (1 second)
-        setInterval(fetchStats, 1000);
+        // Poll only while the page is visible; a background browser tab stops loading the
+        // browser and the backend, and catches up as soon as it's shown again
+        setInterval(() => { if (!document.hidden) fetchStats(); }, {{ refresh_ms }});
+        document.addEventListener('visibilitychange', () => { if (!document.hidden) fetchStats(); });
     </script>
 </body>
 </html>
@@ -432,34 +467,104 @@ HTML_TEMPLATE = """
 
 # --- Flask Routes ---
 
+# Set up in __main__; the page is rendered once at startup
+assets = None
+
+def render_index():
+    """Renders the main HTML page into the asset cache, or reuses the last rendering with the same settings."""
+    assets.render_page(app, '/', HTML_TEMPLATE, knot_resolver_url=KNOT_RESOLVER_STATS_URL,
+                       refresh_ms=round(poller.interval * 1000),
+                       tailwind_css_url=assets.url('tailwind.css'),
+                       chart_js_url=assets.vendor_url('vendor/chart.umd.min.js'))
+
 @app.route('/')
 def index():
-    """Renders the main HTML page."""
-    return render_template_string(HTML_TEMPLATE, knot_resolver_url=KNOT_RESOLVER_STATS_URL)
+    """Serves the pre-rendered main HTML page."""
+    return assets.page_response('/')
+
+# Set up in __main__ once the cache directory and scrape interval are known
+poller = None
+# Set up in __main__ from --control-socket; stats come from the webmgmt URL without it
+collector = None
+
+def fetch_control_stats():
+    """Sums stats.list() over all kresd workers' control sockets; returns (status, JSON body)."""
+    workers, errors = collector.collect()
+    if errors:
+        app.logger.warning(f"Control socket errors: {errors}")
+    if not workers:
+        return 503, error_body(f"No Knot Resolver control sockets answered at {collector.pattern}.")
+    totals = {}
+    for stats in workers.values():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                totals[key] = totals.get(key, 0) + value
+    return 200, json.dumps(totals).encode()
+
+def fetch_stats():
+    """Fetches stats from Knot Resolver; returns (status, JSON body) for the scrape cache."""
+    if collector is not None:
+        return fetch_control_stats()
+    import requests  # Deferred to the first scrape, to keep startup fast
 
-@app.route('/api/stats')
-def get_stats():
-    """Fetches stats from Knot Resolver and returns as JSON."""
     try:
         response = requests.get(KNOT_RESOLVER_STATS_URL, timeout=0.5)
         response.raise_for_status()
-        stats_data = response.json()
-        return jsonify(stats_data)
+        # Forward the upstream bytes as-is; only check that they look like a JSON object
+        if not looks_like_json_object(response.content):
+            return 500, error_body("Failed to decode JSON response from Knot Resolver.")
+        return 200, response.content
     except requests.exceptions.ConnectionError:
-        return jsonify({"error": f"Connection refused. Is Knot Resolver running at {KNOT_RESOLVER_STATS_URL}?"}), 503
+        return 503, error_body(f"Connection refused. Is Knot Resolver running at {KNOT_RESOLVER_STATS_URL}?")
     except requests.exceptions.Timeout:
-        return jsonify({"error": "Request timed out."}), 504
+        return 504, error_body("Request timed out.")
     except requests.exceptions.RequestException as e:
-        return jsonify({"error": f"Failed to fetch stats: {str(e)}"}), 500
-    except json.JSONDecodeError:
-        return jsonify({"error": "Failed to decode JSON response from Knot Resolver."}), 500
+        return 500, error_body(f"Failed to fetch stats: {str(e)}")
     except Exception as e:
         app.logger.error(f"Unexpected error fetching stats: {e}", exc_info=True)
-        return jsonify({"error": f"An unexpected server error occurred: {str(e)}"}), 500
+        return 500, error_body(f"An unexpected server error occurred: {str(e)}")
+
+def start_poller():
+    """Starts the background scraper in this worker process."""
+    poller.start()
+
+@app.route('/api/stats')
+def get_stats():
+    """Returns the latest stats scraped from Knot Resolver as JSON."""
+    return entry_response(poller.latest(STATS_MAX_AGE))
 
 # --- Main Execution ---
+def parse_args(argv=None):
+    """Parses command line options, defaulting to the configuration above."""
+    parser = argparse.ArgumentParser(description="Knot Resolver stats dashboard.")
+    parser.add_argument('--stats-url', default=KNOT_RESOLVER_STATS_URL,
+                        help="Knot Resolver /stats URL (default: %(default)s)")
+    parser.add_argument('--control-socket', metavar='GLOB',
+                        help="Read stats from kresd control sockets matching GLOB, e.g. '/run/knot-resolver/control/*', "
+                             "instead of --stats-url")
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=5001, help="Port to listen on (default: %(default)s)")
+    add_serve_arguments(parser)
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.fetch_assets:
+        fetch_vendor_assets()
+        raise SystemExit(0)
+    KNOT_RESOLVER_STATS_URL = args.stats_url
+    if args.control_socket:
+        collector = ControlSocketCollector(args.control_socket, CONTROL_EXPRESSION)
+    poller = Poller(SharedCache(args.cache_dir or default_cache_dir(args.port)), fetch_stats,
+                    interval=args.scrape_interval, idle_interval=args.idle_interval, idle_after=args.idle_after,
+                    max_interval=args.max_interval)
+    assets = StaticAssets(cache=poller.cache)
+    assets.register(app)
+    register_self_metrics(app, poller.cache, profiling=args.profiling)
+    render_index()
     print("Starting Flask server for Knot Resolver Stats UI...")
-    print(f"Fetching stats from: {KNOT_RESOLVER_STATS_URL}")
-    print("Access the UI at: http://127.0.0.1:5001")
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    print(f"Fetching stats from: {args.control_socket or KNOT_RESOLVER_STATS_URL}")
+    print(f"Access the UI at: http://127.0.0.1:{args.port}")
+    if args.serve == 'prod':
+        print(f"Serving with gunicorn: {args.workers} workers x {args.threads} threads")
+    serve(app, args, start_poller)
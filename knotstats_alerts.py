@@ -0,0 +1,288 @@
+################################################################################
+# Knot Resolver Stats Dashboard - alerting
+################################################################################
+#
+# Evaluates alert rules against every scrape taken by `knotstats-v6.py` and
+# notifies webhooks or local commands when a rule starts or stops firing.
+#
+# Rules live in a JSON file passed with `--alert-rules`; see
+# `knotstats-alerts.example.json`. Each rule has an expression over the
+# counters kresd exports, summed across instances:
+#
+# - `rate('answer.servfail')`  per-second rate over the rule's window
+# - `delta('answer.total')`    increase over the rule's window
+# - `value('worker.rss')`      current value, for gauges
+# - `value('scrape.age')`      seconds since the last successful scrape
+#
+# combined with numbers and `+ - * /`. A rule either compares the expression
+# with a fixed threshold (`"op": ">", "threshold": 5`) or flags anomalies
+# against its own EWMA baseline (`"anomaly": {"sigma": 3, "direction": "below"}`).
+#
+# Everything is incremental: each rule keeps running sums over its window and
+# an EWMA mean and variance, so no history is re-scanned on a scrape.
+#
+# Failed scrapes are evaluated too, as an interval in which nothing was
+# counted, so a rule like `rate('answer.total') <= 0` fires while kresd is
+# unreachable and `value('scrape.age') > 30` flags failing scrapes. The next
+# successful scrape's counters cover that time, and replace the stand-in.
+#
+
+import ast
+import json
+import logging
+import math
+import operator
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+# Events kept for /api/alerts
+EVENT_HISTORY = 50
+
+
+class RuleError(ValueError):
+    """Raised for an invalid rule definition."""
+
+
+class AlertExpression:
+    """A rule expression, checked against a small whitelist of syntax when loaded."""
+
+    FUNCTIONS = ('rate', 'delta', 'value')
+    BINARY_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div)
+
+    def __init__(self, source):
+        self.source = source
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError as e:
+            raise RuleError(f"Invalid expression {source!r}: {e.msg}")
+        self.metrics = set()  # (function, path)
+        self._check(tree.body)
+        self.code = compile(tree, '<alert rule>', 'eval')
+
+    def _check(self, node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, self.BINARY_OPERATORS):
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            self._check(node.operand)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            pass
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.FUNCTIONS
+              and len(node.args) == 1 and not node.keywords
+              and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)):
+            self.metrics.add((node.func.id, tuple(node.args[0].value.split('.'))))
+        else:
+            raise RuleError(f"Unsupported syntax in expression {self.source!r}: {ast.dump(node)[:60]}")
+
+    def evaluate(self, window_deltas, window_elapsed, current):
+        """Returns the expression's value, or None if it can't be computed (e.g. division by zero)."""
+        functions = {
+            'rate': lambda path: window_deltas.get(tuple(path.split('.')), 0) / window_elapsed,
+            'delta': lambda path: window_deltas.get(tuple(path.split('.')), 0),
+            'value': lambda path: current.get(tuple(path.split('.')), 0),
+        }
+        try:
+            return float(eval(self.code, {'__builtins__': {}}, functions))
+        except ZeroDivisionError:
+            return None
+
+
+class AlertRule:
+    """One rule: an expression over a sliding window, tested against a threshold or an EWMA baseline."""
+
+    def __init__(self, config):
+        try:
+            self.name = config['name']
+            self.expression = AlertExpression(config['expr'])
+        except KeyError as e:
+            raise RuleError(f"Rule is missing {e}: {config}")
+        self.window = float(config.get('window', 0))
+        self.description = config.get('description', '')
+        self.notify = config.get('notify')
+        self.anomaly = config.get('anomaly')
+        if self.anomaly is None:
+            if config.get('op') not in OPERATORS or 'threshold' not in config:
+                raise RuleError(f"Rule {self.name!r} needs 'op' ({', '.join(OPERATORS)}) and 'threshold', or 'anomaly'")
+            self.op = config['op']
+            self.threshold = float(config['threshold'])
+        else:
+            self.sigma = float(self.anomaly.get('sigma', 3))
+            self.direction = self.anomaly.get('direction', 'both')
+            if self.direction not in ('above', 'below', 'both'):
+                raise RuleError(f"Rule {self.name!r}: anomaly direction must be above, below or both")
+            self.alpha = float(self.anomaly.get('alpha', 0.05))
+            self.warmup = int(self.anomaly.get('warmup', 30))
+            self.samples = 0
+            self.mean = 0.0
+            self.variance = 0.0
+        self.paths = {path for function, path in self.expression.metrics if function != 'value'}
+        self.intervals = deque()  # (time, elapsed, {path: delta})
+        self.window_deltas = {path: 0 for path in self.paths}
+        self.window_elapsed = 0.0
+        self.firing = False
+        self.since = None
+        self.value = None
+        self.message = ''
+
+    def _slide(self, now, elapsed, deltas, stand_in):
+        """Adds this interval to the window's running sums and drops intervals older than the window.
+
+        A stand_in interval, for scrapes that failed, is replaced by the next interval added.
+        """
+        if self.intervals and self.intervals[-1][3]:
+            self.window_elapsed -= self.intervals.pop()[1]
+        interval = {path: deltas.get(path, 0) for path in self.paths}
+        self.intervals.append((now, elapsed, interval, stand_in))
+        self.window_elapsed += elapsed
+        for path, delta in interval.items():
+            self.window_deltas[path] += delta
+        while len(self.intervals) > 1 and self.intervals[0][0] <= now - self.window:
+            _, old_elapsed, old_interval, _ = self.intervals.popleft()
+            self.window_elapsed -= old_elapsed
+            for path, delta in old_interval.items():
+                self.window_deltas[path] -= delta
+
+    def evaluate(self, now, elapsed, deltas, current, stand_in=False):
+        """Updates the rule with one interval; returns True if its firing state changed."""
+        self._slide(now, elapsed, deltas, stand_in)
+        value = self.expression.evaluate(self.window_deltas, self.window_elapsed, current)
+        if value is None:
+            return False
+        self.value = value
+        if self.anomaly is None:
+            breached = OPERATORS[self.op](value, self.threshold)
+            message = f"{self.expression.source} = {value:.4g} ({self.op} {self.threshold:g})"
+        else:
+            breached, message = self._check_anomaly(value)
+        if breached != self.firing:
+            self.firing = breached
+            self.since = now
+            self.message = message
+            return True
+        if breached:
+            self.message = message
+        return False
+
+    def _check_anomaly(self, value):
+        """Compares value with the EWMA baseline, then folds it into the baseline."""
+        deviation = math.sqrt(self.variance)
+        lower = self.mean - self.sigma * deviation
+        upper = self.mean + self.sigma * deviation
+        breached = False
+        if self.samples >= self.warmup:
+            breached = ((self.direction in ('below', 'both') and value < lower) or
+                        (self.direction in ('above', 'both') and value > upper))
+        message = (f"{self.expression.source} = {value:.4g}, baseline {self.mean:.4g} "
+                   f"± {self.sigma:g}σ ({lower:.4g}..{upper:.4g})")
+        # Don't let an ongoing anomaly drag the baseline along with it
+        if not breached:
+            if self.samples == 0:
+                self.mean = value
+            else:
+                diff = value - self.mean
+                increment = self.alpha * diff
+                self.mean += increment
+                self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+            self.samples += 1
+        return breached, message
+
+    def state(self):
+        return {"name": self.name, "description": self.description, "firing": self.firing,
+                "since": self.since, "value": self.value, "message": self.message}
+
+
+class Notifier:
+    """Delivers alert events to webhooks and commands from a background thread, in order."""
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def send(self, event, targets=None):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='knotstats-alerts', daemon=True)
+            self.thread.start()
+        self.queue.put((event, targets if targets is not None else self.targets))
+
+    def _run(self):
+        import requests  # Deferred to the first alert, to keep startup fast
+
+        while True:
+            event, targets = self.queue.get()
+            for target in targets:
+                try:
+                    if 'webhook' in target:
+                        requests.post(target['webhook'], json=event, timeout=target.get('timeout', 5)).raise_for_status()
+                    elif 'command' in target:
+                        subprocess.run(target['command'], input=json.dumps(event).encode(), check=True,
+                                       timeout=target.get('timeout', 30))
+                except (requests.exceptions.RequestException, subprocess.SubprocessError, OSError) as e:
+                    logger.warning(f"Failed to deliver alert {event['rule']} to {target}: {e}")
+
+
+class AlertEngine:
+    """Evaluates all rules on each scrape interval and publishes their state to the shared cache."""
+
+    def __init__(self, rules, notifier, cache):
+        self.rules = rules
+        self.notifier = notifier
+        self.cache = cache
+        self.events = None
+        self.succeeded = None  # Time of the last successful scrape
+        self.current_totals = {}
+
+    @classmethod
+    def from_file(cls, path, cache):
+        with open(path) as file:
+            config = json.load(file)
+        rules = [AlertRule(rule) for rule in config.get('rules', [])]
+        names = [rule.name for rule in rules]
+        if len(set(names)) != len(names):
+            raise RuleError("Alert rule names must be unique")
+        return cls(rules, Notifier(config.get('notify', [])), cache)
+
+    def update(self, now, elapsed, deltas, current):
+        totals, current_totals = {}, {}
+        for instance_deltas in deltas.values():
+            for path, delta in instance_deltas.items():
+                totals[path] = totals.get(path, 0) + delta
+        for instance_values in current.values():
+            for path, value in instance_values.items():
+                current_totals[path] = current_totals.get(path, 0) + value
+        current_totals[('scrape', 'age')] = 0.0
+        self.succeeded, self.current_totals = now, current_totals
+        self._evaluate(now, elapsed, totals, current_totals, False)
+
+    def scrape_failed(self, status):
+        """Evaluates the rules for the time since the last successful scrape, with nothing counted in it."""
+        now = time.time()
+        if self.succeeded is None:
+            # Nothing to measure from before the first successful scrape
+            self.succeeded = now
+        age = now - self.succeeded
+        current_totals = {**self.current_totals, ('scrape', 'age'): age}
+        self._evaluate(now, age, {}, current_totals, True)
+
+    def _evaluate(self, now, elapsed, totals, current_totals, stand_in):
+        if self.events is None:
+            # Keep the event history a previous scraper left in the shared cache
+            entry = self.cache.get('stats.alerts')
+            self.events = deque(json.loads(entry.body)['events'] if entry else [], maxlen=EVENT_HISTORY)
+        for rule in self.rules:
+            if rule.evaluate(now, elapsed, totals, current_totals, stand_in):
+                event = {"rule": rule.name, "state": 'firing' if rule.firing else 'resolved',
+                         "time": round(now, 3), "value": rule.value, "message": rule.message,
+                         "description": rule.description}
+                logger.warning(f"Alert {rule.name} {event['state']}: {rule.message}")
+                self.events.append(event)
+                self.notifier.send(event, rule.notify)
+        report = {"t": round(now, 3), "rules": [rule.state() for rule in self.rules], "events": list(self.events)}
+        self.cache.put('stats.alerts', json.dumps(report, separators=(',', ':')).encode(), status=200)
@@ -0,0 +1,201 @@
+################################################################################
+# Knot Resolver Stats Dashboard - cache inspector
+################################################################################
+#
+# Estimates what is in kresd's cache for the Cache tab of `knotstats-v6.py`:
+# size by RR type, remaining TTLs and the domains taking the most space.
+#
+# kresd keeps its cache in an LMDB database (`data.mdb` in the cache
+# directory, `--resolver-cache`). It is opened read-only; LMDB readers never
+# block kresd's writes. Rather than walking a cache that can be gigabytes, a
+# sample takes SEEKS short read transactions, each seeking to a random key and
+# reading RUN consecutive entries not sampled yet, and scales the counts up to the
+# entry count LMDB keeps in its header. The result is an estimate: keys after
+# sparse parts of the key space are somewhat over-represented.
+#
+# Keys are `<name, root label first, each label NUL-terminated>\0<tag>...`;
+# tag `E` is an exact name and type (16-bit, little-endian), `1` and `3`
+# hold NSEC and NSEC3 records for aggressive caching. Values start with the
+# time the entry was stored and its TTL, both 32-bit.
+#
+
+import random
+import struct
+import threading
+import time
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+SEEKS = 64
+RUN = 32
+
+TYPE_NAMES = {
+    1: 'A', 2: 'NS', 5: 'CNAME', 6: 'SOA', 12: 'PTR', 15: 'MX', 16: 'TXT', 28: 'AAAA', 33: 'SRV',
+    35: 'NAPTR', 39: 'DNAME', 43: 'DS', 48: 'DNSKEY', 52: 'TLSA', 64: 'SVCB', 65: 'HTTPS', 257: 'CAA',
+}
+# (upper bound in seconds, label) for remaining TTLs
+TTL_BUCKETS = [
+    (0, 'expired'), (60, '< 1m'), (300, '1-5m'), (3600, '5m-1h'), (6 * 3600, '1-6h'), (86400, '6-24h'),
+    (float('inf'), '> 1d'),
+]
+
+TOP_DOMAINS = 15
+
+
+def parse_key(key):
+    """Returns (name, kind) for a cache key, or None for keys that aren't records.
+
+    kind is an RR type name for exact entries, or NSEC/NSEC3.
+    """
+    if key[:1] == b'\0':
+        name_end = 0
+    else:
+        name_end = key.find(b'\0\0')
+        if name_end < 0:
+            return None
+        name_end += 1
+    tag = key[name_end + 1:name_end + 2]
+    labels = key[:name_end].split(b'\0')[:-1] if name_end else []
+    name = '.'.join(label.decode('ascii', 'backslashreplace') for label in reversed(labels)).lower() or '.'
+    if tag == b'E' and len(key) == name_end + 4:
+        rrtype = struct.unpack_from('<H', key, name_end + 2)[0]
+        return name, TYPE_NAMES.get(rrtype, f"TYPE{rrtype}")
+    if tag == b'1':
+        return name, 'NSEC'
+    if tag == b'3':
+        return name, 'NSEC3'
+    return None
+
+
+def remaining_ttl(kind, value, now):
+    """Seconds the entry has left, or None if the value is too short to tell."""
+    offset = 2 if kind == 'NS' else 0  # NS entries are prefixed with the apex's NSEC flags
+    if len(value) < offset + 8:
+        return None
+    stored, ttl = struct.unpack_from('<II', value, offset)
+    return stored + ttl - int(now)
+
+
+def domain_of(name):
+    """Groups names by their last two labels, e.g. www.example.com -> example.com."""
+    return '.'.join(name.split('.')[-2:])
+
+
+def ttl_bucket(ttl):
+    for bound, label in TTL_BUCKETS:
+        if ttl <= bound:
+            return label
+    return TTL_BUCKETS[-1][1]
+
+
+class CacheInspector:
+    """Samples a kresd LMDB cache read-only; keeps the environment open between samples."""
+
+    def __init__(self, path, seeks=SEEKS, run=RUN):
+        self.path = path
+        self.seeks = seeks
+        self.run = run
+        self.env = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if lmdb is None:
+            raise RuntimeError("The cache inspector needs the lmdb package")
+        if self.env is None:
+            try:
+                self.env = lmdb.open(self.path, readonly=True)
+            except lmdb.Error as e:
+                raise RuntimeError(f"Can't open kresd cache at {self.path}: {e}")
+        return self.env
+
+    def _key_range(self, txn):
+        """Returns the first and last keys as integers over their first 4 bytes, for random seeks."""
+        with txn.cursor() as cursor:
+            # Skip the root name's entries and kresd's version key, which start with NUL
+            if not cursor.set_range(b'\x01'):
+                return None
+            first = cursor.key()
+            cursor.last()
+            last = cursor.key()
+        return int.from_bytes(first[:4].ljust(4, b'\0'), 'big'), int.from_bytes(last[:4].ljust(4, b'\0'), 'big')
+
+    def _read(self, env):
+        """Returns (stat, info, {key: (size, value prefix)}) for a random sample of the cache's entries."""
+        stat, info = env.stat(), env.info()
+        with env.begin() as txn:
+            key_range = self._key_range(txn)
+        seen = {}
+        if key_range:
+            for _ in range(self.seeks):
+                seek = random.randint(*key_range).to_bytes(4, 'big')
+                # One short transaction per seek, so kresd's freed pages aren't pinned for long
+                with env.begin() as txn, txn.cursor() as cursor:
+                    if not cursor.set_range(seek):
+                        cursor.first()
+                    # Seeks into the same gap land on the same key; read on past keys already seen
+                    taken = 0
+                    for key, value in cursor:
+                        if key not in seen:
+                            seen[key] = (len(key) + len(value), value[:10])
+                            taken += 1
+                            if taken == self.run:
+                                break
+        return stat, info, seen
+
+    def sample(self):
+        """Returns a report of estimated entry counts and bytes by RR type, TTL and domain.
+
+        Raises RuntimeError if the cache can't be opened or read.
+        """
+        with self.lock:
+            env = self._open()
+            started = time.monotonic()
+            now = time.time()
+            try:
+                stat, info, seen = self._read(env)
+            except lmdb.Error as e:
+                # e.g. MapResizedError once kresd grows its cache: reopen it next time
+                env.close()
+                self.env = None
+                raise RuntimeError(f"Can't read kresd cache at {self.path}: {e}")
+        types, ttls, domains = {}, {}, {}
+        sampled = 0
+        for key, (size, value) in seen.items():
+            parsed = parse_key(key)
+            if parsed is None:
+                continue
+            name, kind = parsed
+            sampled += 1
+            for table, group in ((types, kind), (domains, domain_of(name))):
+                counts = table.setdefault(group, [0, 0])
+                counts[0] += 1
+                counts[1] += size
+            ttl = remaining_ttl(kind, value, now)
+            if ttl is not None:
+                label = ttl_bucket(ttl)
+                ttls[label] = ttls.get(label, 0) + 1
+        entries = stat['entries']
+        used_bytes = stat['psize'] * (stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'])
+        sampled_bytes = sum(size for size, _ in seen.values()) or 1
+        entry_scale = entries / sampled if sampled else 0
+        byte_scale = used_bytes / sampled_bytes
+
+        def estimate(table, limit=None):
+            rows = sorted(table.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+            return [[group, round(count * entry_scale), round(size * byte_scale)] for group, (count, size) in rows]
+
+        return {
+            "t": round(now, 3),
+            "path": self.path,
+            "entries": entries,
+            "used_bytes": used_bytes,
+            "map_bytes": info['map_size'],
+            "sampled": sampled,
+            "types": estimate(types),
+            "ttl": [[label, round(ttls.get(label, 0) * entry_scale)] for _, label in TTL_BUCKETS],
+            "domains": estimate(domains, TOP_DOMAINS),
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
@@ -0,0 +1,620 @@
+################################################################################
+# Knot Resolver Stats Dashboard - shared backend helpers
+################################################################################
+#
+# Used by `knotstats.py` and `knotstats-v6.py`; keep it next to them.
+#
+# - `SharedCache` stores the latest scrape on disk so every worker process on
+#   the host serves the same snapshot.
+# - `Poller` scrapes Knot Resolver on a background thread. Only the worker that
+#   holds the scraper lock polls, so N workers still mean one scraper.
+# - `ControlSocketCollector` reads stats from each kresd worker's control
+#   socket, for setups without the webmgmt HTTP listener.
+# - `entry_response()` forwards a cached scrape byte-for-byte, answering
+#   conditional requests from its content digest.
+# - `StaticAssets` serves the pre-rendered page and the files under `static/`
+#   precompressed (gzip, and brotli when installed) with ETags and cache headers.
+#   Rendered pages and compressed copies are kept in the shared cache, so a
+#   restart with the same template and settings skips both.
+# - `Poller` and `entry_response()` record their timings and cache hits in
+#   `knotstats_selfmetrics`, and every worker's poller thread comes with one
+#   that publishes them for `/api/self`.
+# - `serve()` runs the app on Flask's development server or, with
+#   `--serve prod`, under gunicorn with multiple worker processes.
+#
+
+import concurrent.futures
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from flask import Response, abort, has_request_context, render_template_string, request
+
+from knotstats_selfmetrics import self_metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Third-party files served from static/vendor/, fetched once with --fetch-assets
+# on a machine with internet access. Until then the page loads them from here.
+VENDOR_ASSETS = {
+    'vendor/chart.umd.min.js': 'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js',
+}
+
+# Content-Encoding: compressor, for the variants of each Asset
+COMPRESSORS = {'gzip': lambda body: gzip.compress(body, 9)}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+
+CacheEntry = namedtuple('CacheEntry', ['meta', 'body'])
+
+
+def content_digest(body):
+    """Returns a short content hash used for ETags and change detection."""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+def looks_like_json_object(body):
+    """Cheap check that body is a JSON object, looking only at its first and last bytes."""
+    return body[:64].lstrip()[:1] == b'{' and body[-64:].rstrip()[-1:] == b'}'
+
+
+def error_body(message):
+    return json.dumps({"error": message}).encode()
+
+
+def default_cache_dir(port):
+    """Returns a per-port cache directory, in shared memory where available."""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, f"knotstats-{port}")
+
+
+class SharedCache:
+    """File-backed key/value store shared by all worker processes.
+
+    Each entry is one file: a JSON metadata line followed by the raw body.
+    Writes go through a temporary file and `os.replace`, so readers always
+    see a complete entry. Reads are memoised on the file's mtime and size.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def put(self, name, body, **meta):
+        """Stores body with its metadata and returns the new CacheEntry."""
+        meta.setdefault('updated', time.time())
+        meta.setdefault('digest', content_digest(body))
+        meta.setdefault('name', name)
+        tmp_path = f"{self.path(name)}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as file:
+            file.write(json.dumps(meta).encode() + b'\n')
+            file.write(body)
+        os.replace(tmp_path, self.path(name))
+        return CacheEntry(meta, body)
+
+    def get(self, name):
+        """Returns the entry as a CacheEntry, or None if it has never been written."""
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            memo = self._memo.get(name)
+            if memo and memo[0] == key:
+                return memo[1]
+        try:
+            with open(self.path(name), 'rb') as file:
+                raw = file.read()
+        except FileNotFoundError:
+            return None
+        header, _, body = raw.partition(b'\n')
+        entry = CacheEntry(json.loads(header), body)
+        with self._lock:
+            self._memo[name] = (key, entry)
+        return entry
+
+
+class Poller:
+    """Runs `scrape()` every `interval` seconds in the one worker holding the scraper lock.
+
+    `scrape()` returns a `(status, body)` pair which is stored in the shared
+    cache under `name`, body untouched. Hooks added with `add_hook()` run with
+    the decoded JSON of each successful scrape whose content differs from the
+    one they last saw, to derive further cache entries; identical scrapes are
+    never parsed. Hooks added with `every_scrape=True` also run for identical
+    scrapes, reusing the previous decoded data, and hooks added with
+    `add_failure_hook()` run with the status of each failed scrape. Hooks run
+    only on the scraper's own thread, so they keep their state in memory
+    without locks. Workers that don't hold the lock keep retrying it, so
+    another worker takes over within one interval if the scraper exits.
+    Long-running jobs that must also run once per host, like log ingestion,
+    are registered with `add_leader_task()` and start with the leader.
+
+    The interval adapts. Every `latest()` call marks clients as active in the
+    shared cache; once none have asked for `idle_after` seconds the scraper
+    slows to `idle_interval`, or stops scraping if that is 0, and returns to
+    `interval` as soon as a client asks again (which gets an inline scrape
+    meanwhile, one per worker at a time, stored without running the hooks).
+    Failed scrapes double the interval, and slow ones stretch it to four times
+    the scrape's duration, up to `max_interval`; the scraper notes this in the
+    shared cache, and clients get the stored entry instead of inline scrapes
+    until it recovers. With `scrape_inline=False` clients always get the
+    stored entry, for scrapes that only the leader may make.
+    """
+
+    def __init__(self, cache, scrape, interval=1.0, name='stats', idle_interval=None, idle_after=60.0,
+                 max_interval=60.0, scrape_inline=True):
+        self.cache = cache
+        self.scrape = scrape
+        self.interval = interval
+        self.name = name
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.max_interval = max(max_interval, interval)
+        self.current_interval = interval
+        self.scrape_inline = scrape_inline
+        self._backoff = 1
+        self._backing_off = False
+        self._hooked_digest = None
+        self._inline_lock = threading.Lock()
+        self._noted_client = 0.0
+        self.hooks = []
+        self.failure_hooks = []
+        self.leader_tasks = []
+        self.last_data = None
+        self.is_leader = False
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the polling thread once per process; safe to call from every request."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.is_leader = False
+            threading.Thread(target=self._run, name='knotstats-poller', daemon=True).start()
+            threading.Thread(target=self_metrics.run_publisher, args=(self.cache,), name='knotstats-selfmetrics',
+                             daemon=True).start()
+
+    def add_leader_task(self, task):
+        """Registers task() to run on its own thread in whichever worker becomes the scraper."""
+        self.leader_tasks.append(task)
+
+    def add_hook(self, hook, every_scrape=False):
+        """Registers hook(data) to run after successful scrapes."""
+        self.hooks.append((hook, every_scrape))
+
+    def add_failure_hook(self, hook):
+        """Registers hook(status) to run after failed scrapes, on the scraper's thread like the others."""
+        self.failure_hooks.append(hook)
+
+    def scrape_once(self, run_hooks=True):
+        """Scrapes immediately and stores the result; returns the stored CacheEntry.
+
+        Only the scraper's thread runs the hooks; inline scrapes pass run_hooks=False.
+        """
+        with self_metrics.timer('stage_seconds', stage='fetch'):
+            status, body = self.scrape()
+        self_metrics.increment('scrapes_total', status=str(status))
+        digest = content_digest(body)
+        on_scraper_thread = run_hooks
+        run_hooks = run_hooks and status == 200 and self.hooks
+        changed = digest != self._hooked_digest or self.last_data is None
+        if run_hooks and changed:
+            try:
+                with self_metrics.timer('stage_seconds', stage='parse'):
+                    self.last_data = json.loads(body)
+            except ValueError:
+                logger.error("Failed to decode JSON response from Knot Resolver")
+                status, body = 500, error_body("Failed to decode JSON response from Knot Resolver.")
+                digest = content_digest(body)
+                run_hooks = False
+        with self_metrics.timer('stage_seconds', stage='store'):
+            entry = self.cache.put(self.name, body, status=status, digest=digest)
+        if run_hooks:
+            self._hooked_digest = digest
+            for hook, every_scrape in self.hooks:
+                if not (changed or every_scrape):
+                    continue
+                try:
+                    with self_metrics.timer('stage_seconds', stage='aggregate', hook=hook.__qualname__):
+                        hook(self.last_data)
+                except Exception as e:
+                    logger.error(f"Scrape hook {hook.__name__} failed: {e}", exc_info=True)
+        elif on_scraper_thread and status != 200:
+            for hook in self.failure_hooks:
+                try:
+                    hook(status)
+                except Exception as e:
+                    logger.error(f"Scrape failure hook {hook.__name__} failed: {e}", exc_info=True)
+        return entry
+
+    def note_client(self):
+        """Records that a client wants fresh stats; touches the shared marker at most once a second."""
+        now = time.time()
+        if now - self._noted_client >= 1.0:
+            self._noted_client = now
+            with open(self.cache.path('clients'), 'a'):
+                os.utime(self.cache.path('clients'))
+
+    def idle(self):
+        """True if no client has asked for stats within idle_after seconds."""
+        try:
+            return time.time() - os.stat(self.cache.path('clients')).st_mtime > self.idle_after
+        except FileNotFoundError:
+            return True
+
+    def _next_interval(self, idle, duration, ok):
+        self._backoff = 1 if ok else min(self._backoff * 2, 64)
+        interval, reason = self.interval * self._backoff, "backing off after a failed scrape" if not ok else ""
+        if duration * 4 > interval:
+            interval, reason = duration * 4, "Knot Resolver is answering slowly"
+        backing_off = bool(reason)
+        if idle and self.idle_interval and self.idle_interval > interval:
+            interval, reason = self.idle_interval, "no clients"
+        interval = round(min(interval, self.max_interval), 1)
+        if interval != self.current_interval:
+            logger.info("Scrape interval is now %.1fs%s", interval, f" ({reason})" if reason else "")
+            self.current_interval = interval
+        if backing_off or self._backing_off:
+            # Rewritten every scrape while backing off, so a dead scraper's note goes stale
+            self.cache.put(f"{self.name}.backoff", b'', backing_off=backing_off, interval=interval)
+            self._backing_off = backing_off
+        return interval
+
+    def backing_off(self):
+        """True if the scraper is backing off from a failing or slow Knot Resolver."""
+        entry = self.cache.get(f"{self.name}.backoff")
+        return (entry is not None and entry.meta['backing_off']
+                and time.time() - entry.meta['updated'] < entry.meta['interval'] + self.interval * 2)
+
+    def _sleep(self, seconds, idle):
+        """Sleeps, waking early if a client turns up while idle."""
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            time.sleep(min(remaining, self.interval))
+            if idle and not self.idle():
+                return
+
+    def latest(self, max_age):
+        """Returns the cached scrape, scraping inline if it is missing or older than max_age.
+
+        While the scraper backs off, or without scrape_inline, a stale entry is
+        returned as it is, and a missing one as a 503.
+        """
+        self.note_client()
+        entry = self.cache.get(self.name)
+        if entry is not None and time.time() - entry.meta.get('updated', 0) <= max_age:
+            count_cache_result(self.name, 'hit')
+            return entry
+        if not self.scrape_inline or entry is not None and self.backing_off():
+            count_cache_result(self.name, 'stale')
+            if entry is None:
+                body = error_body("No stats have been scraped yet.")
+                return CacheEntry({'status': 503, 'digest': content_digest(body), 'updated': 0}, body)
+            return entry
+        with self._inline_lock:
+            # Another request in this worker may have scraped while we waited
+            entry = self.cache.get(self.name)
+            if entry is not None and time.time() - entry.meta.get('updated', 0) <= max_age:
+                count_cache_result(self.name, 'hit')
+                return entry
+            count_cache_result(self.name, 'miss')
+            return self.scrape_once(run_hooks=False)
+
+    def _run(self):
+        with open(os.path.join(self.cache.directory, 'scraper.lock'), 'a') as lock_file:
+            while True:
+                if not self.is_leader:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        time.sleep(self.interval)
+                        continue
+                    self.is_leader = True
+                    logger.info("Worker %s is now the stats scraper", os.getpid())
+                    for task in self.leader_tasks:
+                        threading.Thread(target=task, name=f"knotstats-{task.__name__}", daemon=True).start()
+                idle = self.idle()
+                if idle and self.idle_interval == 0:
+                    if self.current_interval is not None:
+                        logger.info("No clients; scraping suspended")
+                        self.current_interval = None
+                    self._sleep(self.interval, idle)
+                    continue
+                started = time.monotonic()
+                ok = False
+                try:
+                    ok = self.scrape_once().meta['status'] == 200
+                except Exception as e:
+                    logger.error(f"Unexpected error while scraping: {e}", exc_info=True)
+                duration = time.monotonic() - started
+                self._sleep(max(0.0, self._next_interval(idle, duration, ok) - duration), idle)
+
+
+class ControlSocketCollector:
+    """Evaluates a Lua expression on every kresd worker through its control socket, in parallel.
+
+    Sockets are listed from the `pattern` glob on each collect, so restarted
+    workers are picked up. Connections stay open between collects and are
+    switched to kresd's binary mode, where each reply is a 4-byte big-endian
+    length followed by the output. The expression should return JSON, e.g.
+    `tojson(stats.list())`.
+    """
+
+    def __init__(self, pattern, expression, timeout=1.0):
+        self.pattern = pattern
+        self.command = f"{expression}\n".encode()
+        self.timeout = timeout
+        self.connections = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(16, thread_name_prefix='knotstats-control')
+        self._lock = threading.Lock()
+
+    def _receive(self, connection, size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("control socket closed")
+            data += chunk
+        return data
+
+    def _query(self, path):
+        connection = self.connections.get(path)
+        try:
+            if connection is None:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(self.timeout)
+                connection.connect(path)
+                connection.sendall(b'__binary\n')
+                self.connections[path] = connection
+            connection.sendall(self.command)
+            length = int.from_bytes(self._receive(connection, 4), 'big')
+            return json.loads(self._receive(connection, length))
+        except (OSError, ValueError):
+            # A reply may be half read; start the next collect on a fresh connection
+            self.connections.pop(path, None)
+            if connection is not None:
+                connection.close()
+            raise
+
+    def collect(self):
+        """Returns ({worker id: decoded reply}, {worker id: error}), keyed by socket file name."""
+        with self._lock:
+            paths = sorted(glob.glob(self.pattern))
+            for path in set(self.connections) - set(paths):
+                self.connections.pop(path).close()
+            futures = {os.path.basename(path): self.executor.submit(self._query, path) for path in paths}
+            results, errors = {}, {}
+            for worker, future in futures.items():
+                try:
+                    results[worker] = future.result()
+                except (OSError, ValueError) as e:
+                    errors[worker] = str(e) or type(e).__name__
+            return results, errors
+
+
+def count_cache_result(name, result):
+    """Counts a cache entry served to the current request, per endpoint and entry."""
+    endpoint = (request.endpoint or 'none') if has_request_context() else 'none'
+    self_metrics.increment('cache_results_total', endpoint=endpoint, entry=name, result=result)
+
+
+def entry_response(entry, mimetype='application/json', headers=None):
+    """Serves a cache entry's body as stored, or 304 if the client already has it."""
+    etag = entry.meta['digest']
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', **(headers or {})}
+    if request.if_none_match.contains(etag):
+        count_cache_result(entry.meta.get('name', 'none'), 'not_modified')
+        return Response(status=304, headers=headers)
+    return Response(entry.body, status=entry.meta['status'], mimetype=mimetype, headers=headers)
+
+
+class Asset:
+    """A response body prepared once: compressed variants plus a content-hash ETag.
+
+    With a SharedCache, the compressed variants are kept in it under the
+    body's hash, so a restart doesn't compress an unchanged page again.
+    """
+
+    def __init__(self, body, mimetype, cache_control, cache=None):
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        full_digest = hashlib.sha256(body).hexdigest()
+        self.digest = full_digest[:16]
+        self.variants = {'identity': body}
+        for encoding, compress in COMPRESSORS.items():
+            name = f"asset.{full_digest}.{encoding}"
+            entry = cache.get(name) if cache is not None else None
+            if entry is not None:
+                os.utime(cache.path(name))
+                self.variants[encoding] = entry.body
+                continue
+            self.variants[encoding] = compress(body)
+            if cache is not None:
+                cache.put(name, self.variants[encoding])
+
+    def response(self, request):
+        """Builds the response for a Flask request, honouring Accept-Encoding and If-None-Match."""
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in self.variants and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        etag = f"{self.digest}-{encoding}"
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(self.variants[encoding], mimetype=self.mimetype, headers=headers)
+
+
+class StaticAssets:
+    """Serves the files under static/ and pre-rendered pages from memory.
+
+    Asset URLs carry the content hash (`?v=...`), so they can be cached for a
+    year; pages are revalidated with their ETag on every load.
+    """
+
+    ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    PAGE_CACHE_CONTROL = 'no-cache'
+    # Rendered pages and compressed variants in the cache unused for this long (seconds) are deleted
+    CACHE_RETENTION = 30 * 86400
+
+    def __init__(self, directory=STATIC_DIR, cache=None):
+        self.files = {}
+        self.pages = {}
+        self.cache = cache
+        if cache is not None:
+            self._prune_cache()
+        for root, _, names in os.walk(directory):
+            for filename in names:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                with open(path, 'rb') as file:
+                    self.files[name] = Asset(file.read(), mimetype, self.ASSET_CACHE_CONTROL, cache)
+
+    def _prune_cache(self):
+        for path in glob.glob(self.cache.path('asset.*')) + glob.glob(self.cache.path('page.*')):
+            try:
+                if time.time() - os.stat(path).st_mtime > self.CACHE_RETENTION:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def url(self, name):
+        """Returns the cache-busting URL for a static file, or None if it isn't present."""
+        asset = self.files.get(name)
+        return f"/static/{name}?v={asset.digest}" if asset else None
+
+    def vendor_url(self, name):
+        """Returns the local URL for a vendored file, falling back to its upstream URL."""
+        url = self.url(name)
+        if url is None:
+            logger.warning(f"static/{name} is missing; loading it from {VENDOR_ASSETS[name]}. "
+                           "Run with --fetch-assets to serve it locally.")
+            return VENDOR_ASSETS[name]
+        return url
+
+    def render_page(self, app, path, template, **context):
+        """Renders a Jinja template string as the page at path.
+
+        A cached rendering of the same template and context is reused.
+        """
+        name = f"page.{hashlib.sha256(json.dumps([template, context], sort_keys=True).encode()).hexdigest()}"
+        entry = self.cache.get(name) if self.cache is not None else None
+        if entry is not None:
+            os.utime(self.cache.path(name))
+            html = entry.body
+        else:
+            with app.app_context():
+                html = render_template_string(template, **context).encode()
+            if self.cache is not None:
+                self.cache.put(name, html)
+        self.pages[path] = Asset(html, 'text/html', self.PAGE_CACHE_CONTROL, self.cache)
+
+    def register(self, app):
+        """Adds the /static/<name> route to app."""
+        def static_file(filename):
+            asset = self.files.get(filename)
+            if asset is None:
+                abort(404)
+            return asset.response(request)
+
+        app.add_url_rule('/static/<path:filename>', 'static_file', static_file)
+
+    def page_response(self, path):
+        return self.pages[path].response(request)
+
+
+def fetch_vendor_assets(directory=STATIC_DIR):
+    """Downloads VENDOR_ASSETS into directory so the dashboards work offline."""
+    import requests
+
+    for name, url in VENDOR_ASSETS.items():
+        path = os.path.join(directory, name)
+        print(f"Fetching {url} -> {path}")
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(response.content)
+
+
+def add_serve_arguments(parser):
+    """Adds the serving options shared by both dashboards to an argparse parser."""
+    parser.add_argument('--serve', choices=['dev', 'prod'], default='dev',
+                        help="dev: Flask development server; prod: gunicorn with multiple workers (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help="Worker processes in prod mode (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Threads per worker in prod mode (default: %(default)s)")
+    parser.add_argument('--scrape-interval', type=float, default=1.0,
+                        help="Seconds between scrapes of Knot Resolver while clients are connected (default: %(default)s)")
+    parser.add_argument('--idle-interval', type=float, default=30.0,
+                        help="Seconds between scrapes once no client has asked for --idle-after seconds; "
+                             "0 stops scraping until one does (default: %(default)s)")
+    parser.add_argument('--idle-after', type=float, default=60.0,
+                        help="Seconds without clients before scraping slows down (default: %(default)s)")
+    parser.add_argument('--max-interval', type=float, default=60.0,
+                        help="Longest interval when backing off from a slow or failing Knot Resolver (default: %(default)s)")
+    parser.add_argument('--cache-dir',
+                        help="Directory for the scrape cache shared by workers (default: per-port dir in /dev/shm)")
+    parser.add_argument('--profiling', action='store_true',
+                        help="Enable the sampling profiler at /api/self/profile")
+    parser.add_argument('--fetch-assets', action='store_true',
+                        help="Download the third-party JavaScript into static/vendor/ and exit")
+
+
+def serve(app, args, on_worker_start):
+    """Runs the app as selected by --serve, calling on_worker_start() in every worker process."""
+    if args.serve == 'dev':
+        on_worker_start()
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+        return
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("--serve prod requires gunicorn (pip install gunicorn).")
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{args.host}:{args.port}")
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('post_worker_init', lambda worker: on_worker_start())
+
+        def load(self):
+            return app
+
+    ProductionServer().run()
@@ -0,0 +1,292 @@
+################################################################################
+# Knot Resolver Stats Dashboard - dnstap ingestion
+################################################################################
+#
+# Feeds the Top Talkers tab of `knotstats-v6.py` from kresd's dnstap output
+# (`--querylog unix:/path --querylog-format dnstap`).
+#
+# kresd connects to the socket and speaks bidirectional Frame Streams: a
+# READY/ACCEPT/START handshake, length-prefixed data frames each holding one
+# protobuf-encoded dnstap message, and STOP/FINISH at the end. Only
+# CLIENT_RESPONSE messages are counted, so kresd must log responses.
+#
+# The socket is read in large chunks and complete data frames are passed on
+# in batches of about BATCH_SIZE bytes, undecoded. Protobuf and DNS decoding
+# happens in a pool of worker processes; each returns per-field counts for its
+# batch, which are merged into the same WindowedTop the text query log uses.
+#
+
+import concurrent.futures
+import ipaddress
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1 << 20
+BATCH_SIZE = 1 << 18
+# Hand a partial batch to the decoders after this many seconds
+BATCH_DELAY = 0.25
+
+CONTENT_TYPE = b'protobuf:dnstap.Dnstap'
+
+# Frame Streams control frame types and fields
+CONTROL_ACCEPT = 0x01
+CONTROL_START = 0x02
+CONTROL_STOP = 0x03
+CONTROL_READY = 0x04
+CONTROL_FINISH = 0x05
+CONTROL_FIELD_CONTENT_TYPE = 0x01
+
+# dnstap.proto field numbers
+DNSTAP_MESSAGE = 14
+MESSAGE_TYPE = 1
+MESSAGE_QUERY_ADDRESS = 4
+MESSAGE_RESPONSE_MESSAGE = 14
+CLIENT_RESPONSE = 6
+
+QTYPES = {
+    1: 'A', 2: 'NS', 5: 'CNAME', 6: 'SOA', 12: 'PTR', 13: 'HINFO', 15: 'MX', 16: 'TXT', 28: 'AAAA',
+    33: 'SRV', 35: 'NAPTR', 43: 'DS', 46: 'RRSIG', 47: 'NSEC', 48: 'DNSKEY', 50: 'NSEC3', 52: 'TLSA',
+    64: 'SVCB', 65: 'HTTPS', 255: 'ANY', 257: 'CAA',
+}
+RCODES = ('NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED', 'YXDOMAIN', 'YXRRSET',
+          'NXRRSET', 'NOTAUTH', 'NOTZONE')
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _scan(buf, pos, end, wanted):
+    """Returns {field number: value} for the `wanted` fields of the protobuf message in buf[pos:end].
+
+    Varints are returned as ints, length-delimited fields as (start, end) offsets.
+    """
+    found = {}
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 1:
+            value, pos = None, pos + 8
+        elif wire_type == 5:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire_type}")
+        if number in wanted:
+            found[number] = value
+    if pos != end:
+        raise ValueError("truncated protobuf message")
+    return found
+
+
+def _question(buf, start, end):
+    """Returns the (wire-format qname, qtype, rcode) of the DNS message in buf[start:end]."""
+    if end - start < 12 or buf[start + 4:start + 6] == b'\0\0':
+        raise ValueError("DNS message without a question")
+    rcode = buf[start + 3] & 0x0f
+    pos = start + 12
+    while buf[pos]:
+        if buf[pos] >= 0xc0:
+            raise ValueError("compressed name in question")
+        pos += buf[pos] + 1
+    pos += 1
+    if pos + 2 > end:
+        raise ValueError("truncated DNS question")
+    return buf[start + 12:pos], int.from_bytes(buf[pos:pos + 2], 'big'), rcode
+
+
+def _qname_text(wire):
+    labels = []
+    pos = 0
+    while wire[pos]:
+        length = wire[pos]
+        labels.append(wire[pos + 1:pos + 1 + length].decode('ascii', 'backslashreplace'))
+        pos += length + 1
+    return '.'.join(labels).lower() or '.'
+
+
+def decode_frames(blob):
+    """Counts the CLIENT_RESPONSE messages in a run of length-prefixed data frames.
+
+    Runs in a worker process. Returns ({field: Counter}, queries, undecodable frames).
+    """
+    clients, qnames, qtypes, rcodes = [], [], [], []
+    bad = 0
+    pos, size = 0, len(blob)
+    while pos < size:
+        end = pos + 4 + int.from_bytes(blob[pos:pos + 4], 'big')
+        pos += 4
+        try:
+            message = _scan(blob, pos, end, (DNSTAP_MESSAGE,)).get(DNSTAP_MESSAGE)
+            if message is not None:
+                fields = _scan(blob, message[0], message[1],
+                               (MESSAGE_TYPE, MESSAGE_QUERY_ADDRESS, MESSAGE_RESPONSE_MESSAGE))
+                if fields.get(MESSAGE_TYPE) == CLIENT_RESPONSE and MESSAGE_RESPONSE_MESSAGE in fields:
+                    qname, qtype, rcode = _question(blob, *fields[MESSAGE_RESPONSE_MESSAGE])
+                    address = fields.get(MESSAGE_QUERY_ADDRESS)
+                    clients.append(blob[address[0]:address[1]] if address else b'')
+                    qnames.append(qname)
+                    qtypes.append(qtype)
+                    rcodes.append(rcode)
+        except (ValueError, IndexError):
+            bad += 1
+        pos = end
+    # Convert each distinct value once rather than once per message
+    counters = {
+        'client': Counter({(str(ipaddress.ip_address(address)) if len(address) in (4, 16) else '-'): count
+                           for address, count in Counter(clients).items()}),
+        'qname': Counter({_qname_text(qname): count for qname, count in Counter(qnames).items()}),
+        'qtype': Counter({QTYPES.get(qtype, f"TYPE{qtype}"): count for qtype, count in Counter(qtypes).items()}),
+        'rcode': Counter({(RCODES[rcode] if rcode < len(RCODES) else f"RCODE{rcode}"): count
+                          for rcode, count in Counter(rcodes).items()}),
+    }
+    return counters, len(rcodes), bad
+
+
+def control_frame(control_type, content_type=None):
+    payload = control_type.to_bytes(4, 'big')
+    if content_type is not None:
+        payload += CONTROL_FIELD_CONTENT_TYPE.to_bytes(4, 'big') + len(content_type).to_bytes(4, 'big') + content_type
+    return b'\0\0\0\0' + len(payload).to_bytes(4, 'big') + payload
+
+
+def _content_types(payload):
+    types, pos = [], 4
+    while pos + 8 <= len(payload):
+        field = int.from_bytes(payload[pos:pos + 4], 'big')
+        length = int.from_bytes(payload[pos + 4:pos + 8], 'big')
+        if field == CONTROL_FIELD_CONTENT_TYPE:
+            types.append(bytes(payload[pos + 8:pos + 8 + length]))
+        pos += 8 + length
+    return types
+
+
+class DnstapIngester:
+    """Accepts Frame Streams connections on a Unix socket and decodes dnstap in a process pool."""
+
+    def __init__(self, source, top, processes=None):
+        if not source.startswith('unix:'):
+            raise ValueError("dnstap input needs a unix:/path source")
+        self.path = source[len('unix:'):]
+        self.top = top
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        # Bounds the batches queued for decoding; the reader blocks, and kresd drops, beyond it
+        self.in_flight = threading.BoundedSemaphore(2 * self.processes)
+
+    def _start_pool(self):
+        # forkserver: the scraping worker has threads, which don't mix with a plain fork
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['knotstats_dnstap'])
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=context)
+
+    def run(self):
+        """Serves until the process exits; meant to run on its own thread."""
+        self._start_pool()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(16)
+        logger.info(f"Listening for dnstap on {self.path} with {self.processes} decoder processes")
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=self._read_connection, args=(connection,), daemon=True).start()
+
+    def _submit(self, batch):
+        self.in_flight.acquire()
+        try:
+            future = self.pool.submit(decode_frames, bytes(batch))
+        except concurrent.futures.process.BrokenProcessPool:
+            self.in_flight.release()
+            logger.warning("dnstap decoder pool died; restarting it and dropping a batch")
+            self._start_pool()
+            return
+        future.add_done_callback(self._merge)
+
+    def _merge(self, future):
+        self.in_flight.release()
+        try:
+            counters, queries, bad = future.result()
+        except Exception as e:
+            logger.warning(f"dnstap decoder failed: {e}")
+            return
+        if queries or bad:
+            self.top.add(counters, queries, bad)
+
+    def _read_connection(self, connection):
+        with connection:
+            connection.settimeout(BATCH_DELAY)
+            buffer, batch = bytearray(), bytearray()
+            started = time.monotonic()
+            try:
+                while True:
+                    try:
+                        chunk = connection.recv(READ_SIZE)
+                        if not chunk:
+                            break
+                        buffer += chunk
+                    except socket.timeout:
+                        pass
+                    pos = 0
+                    while len(buffer) - pos >= 4:
+                        length = int.from_bytes(buffer[pos:pos + 4], 'big')
+                        if length:
+                            if len(buffer) - pos < 4 + length:
+                                break
+                            if not batch:
+                                started = time.monotonic()
+                            batch += buffer[pos:pos + 4 + length]
+                            pos += 4 + length
+                            continue
+                        # Control frame: escape, length, type and fields
+                        if len(buffer) - pos < 8:
+                            break
+                        control_length = int.from_bytes(buffer[pos + 4:pos + 8], 'big')
+                        if len(buffer) - pos < 8 + control_length:
+                            break
+                        payload = buffer[pos + 8:pos + 8 + control_length]
+                        pos += 8 + control_length
+                        if not self._control(connection, payload):
+                            return
+                    del buffer[:pos]
+                    if len(batch) >= BATCH_SIZE or (batch and time.monotonic() - started >= BATCH_DELAY):
+                        self._submit(batch)
+                        batch = bytearray()
+            except OSError as e:
+                logger.warning(f"dnstap connection error: {e}")
+            finally:
+                if batch:
+                    self._submit(batch)
+
+    def _control(self, connection, payload):
+        """Handles one control frame; returns False when the stream is over."""
+        control_type = int.from_bytes(payload[:4], 'big')
+        if control_type == CONTROL_READY:
+            if CONTENT_TYPE not in _content_types(payload):
+                logger.warning(f"dnstap writer doesn't offer {CONTENT_TYPE.decode()}; closing")
+                return False
+            connection.sendall(control_frame(CONTROL_ACCEPT, CONTENT_TYPE))
+        elif control_type == CONTROL_STOP:
+            connection.sendall(control_frame(CONTROL_FINISH))
+            return False
+        return True
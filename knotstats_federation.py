@@ -0,0 +1,206 @@
+################################################################################
+# Knot Resolver Stats Dashboard - multi-site federation
+################################################################################
+#
+# Lets a central `knotstats-v6.py` show resolvers in several sites without
+# scraping each kresd across the WAN. Every site runs its own dashboard, which
+# publishes a downsampled snapshot of its stats; the central one pulls those
+# (`--federate paris=https://knotstats.paris.example`) and serves the union,
+# with instances named `<site>/<instance>`.
+#
+# Snapshots reuse the columnar encoding of `/api/stats?format=columnar`: a key
+# dictionary, fetched once per change, and one float64 per (instance, key).
+# Each `--federation-interval`, aligned to the wall clock so that sites using
+# the same interval snapshot together, the site stores the values
+# zlib-compressed in full and as an XOR against the previous snapshot. A
+# central that pulled the previous snapshot sends its version and gets the
+# XOR, in which unchanged values are zero bytes and counters that moved a
+# little differ only in their low bytes, so a pull is a small fraction of the
+# full snapshot. A central that is up to date gets a 304.
+#
+# Snapshots are downsampled in time but not aggregated across a site's
+# workers: the central keeps per-worker drill-down and imbalance detection,
+# and sums per-site views in the browser as it does the global one, at the
+# cost of deltas that grow with the number of workers.
+#
+
+import concurrent.futures
+import json
+import logging
+import time
+import zlib
+
+from knotstats_common import content_digest, error_body
+
+logger = logging.getLogger(__name__)
+
+# Drop a site from the merged view once it hasn't answered for this long (seconds)
+SITE_STALE_AFTER = 60.0
+# Wait this long for every site to publish the newest snapshot before merging without the laggards (seconds)
+SITE_LAG_GRACE = 5.0
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class FederationPublisher:
+    """Scrape hook that publishes a federation snapshot every `interval` seconds."""
+
+    def __init__(self, cache, interval):
+        self.cache = cache
+        self.interval = interval
+        self.slot = None
+        self.values = None
+        self.version = None
+
+    def update(self, data):
+        slot = int(time.time() // self.interval)
+        if slot == self.slot:
+            return
+        columnar = self.cache.get('stats.columnar')
+        dictionary = self.cache.get('stats.dictionary')
+        if columnar is None or dictionary is None or columnar.meta['dictionary'] != dictionary.meta['id']:
+            return
+        self.slot = slot
+        snapshot_time = slot * self.interval
+        values = columnar.body
+        version = content_digest(values + dictionary.meta['id'].encode())
+        if version == self.version:
+            return
+        if self.values is None:
+            # Pick up from the snapshot a previous scraper published
+            previous = self.cache.get('federation.full')
+            if previous is not None:
+                self.values, self.version = zlib.decompress(previous.body), previous.meta['version']
+        dictionary_id = dictionary.meta['id']
+        self.cache.put('federation.dictionary', dictionary.body, status=200, id=dictionary_id)
+        if self.values is not None and len(self.values) == len(values):
+            self.cache.put('federation.delta', zlib.compress(xor_bytes(self.values, values)), status=200,
+                           version=version, base=self.version, dictionary=dictionary_id, time=snapshot_time)
+        self.cache.put('federation.full', zlib.compress(values), status=200, version=version,
+                       dictionary=dictionary_id, time=snapshot_time)
+        self.values, self.version = values, version
+
+
+class FederatedSite:
+    """One remote dashboard, pulled with deltas against the last snapshot received."""
+
+    def __init__(self, name, url, timeout=5.0):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = None
+        self.version = None
+        self.values = None
+        self.dictionary_id = None
+        self.dictionary = None
+        self.stats = {}
+        self.snapshot_time = 0.0
+        self.updated = 0.0
+        self.bytes_received = 0
+
+    def pull(self):
+        """Fetches the site's latest snapshot; returns True if its stats changed."""
+        if self.session is None:
+            import requests  # Deferred to the first pull, as it is slow to import
+            self.session = requests.Session()
+        params = {'base': self.version} if self.version else {}
+        response = self.session.get(f"{self.url}/api/federation", params=params, timeout=self.timeout)
+        self.bytes_received += len(response.content)
+        if response.status_code == 304:
+            self.updated = time.time()
+            return False
+        response.raise_for_status()
+        values = zlib.decompress(response.content)
+        if 'X-Federation-Base' in response.headers:
+            if response.headers['X-Federation-Base'] != self.version or len(values) != len(self.values):
+                raise ValueError("delta against a snapshot this site doesn't have")
+            values = xor_bytes(self.values, values)
+        dictionary_id = response.headers['X-Stats-Dictionary']
+        if dictionary_id != self.dictionary_id:
+            dictionary = self.session.get(f"{self.url}/api/federation/dictionary/{dictionary_id}", timeout=self.timeout)
+            dictionary.raise_for_status()
+            self.dictionary, self.dictionary_id = dictionary.json(), dictionary_id
+        self.values, self.version = values, response.headers['X-Federation-Version']
+        self.snapshot_time = float(response.headers.get('X-Federation-Time', 0))
+        self.stats = self._decode()
+        self.updated = time.time()
+        return True
+
+    def _decode(self):
+        """Rebuilds {site/instance: {section: {key: value}}} from the dictionary and values."""
+        keys = self.dictionary['keys']
+        values = memoryview(self.values).cast('d')
+        if len(values) != len(keys) * len(self.dictionary['instances']):
+            raise ValueError("snapshot doesn't match its dictionary")
+        stats = {}
+        for row, instance in enumerate(self.dictionary['instances']):
+            sections = {}
+            for column, path in enumerate(keys):
+                value = values[row * len(keys) + column]
+                if value != value:  # NaN: this instance lacks the key
+                    continue
+                node = sections
+                for part in path[:-1]:
+                    node = node.setdefault(part, {})
+                node[path[-1]] = int(value) if value.is_integer() else value
+            stats[f"{self.name}/{instance}"] = sections
+        return stats
+
+
+class FederationCollector:
+    """Pulls all sites in parallel and merges them into one /metrics/json-style body."""
+
+    def __init__(self, sites):
+        self.sites = sites
+        self.executor = concurrent.futures.ThreadPoolExecutor(min(16, len(sites)), thread_name_prefix='knotstats-federation')
+        self.body = None
+        self.dirty = False
+        self.newest = None
+        self.newest_seen = 0.0
+
+    @classmethod
+    def from_args(cls, specs):
+        """Builds the collector from NAME=URL strings."""
+        sites = []
+        for spec in specs:
+            name, sep, url = spec.partition('=')
+            if not sep or not name or not url.startswith(('http://', 'https://')):
+                raise ValueError(f"expected NAME=URL, got {spec!r}")
+            sites.append(FederatedSite(name, url))
+        return cls(sites)
+
+    def _pull(self, site):
+        try:
+            return site.pull()
+        # requests' RequestException is an OSError
+        except (OSError, ValueError, KeyError, zlib.error) as e:
+            logger.warning(f"Federation pull from {site.name} ({site.url}) failed: {e}")
+            # Start over with a full snapshot next time
+            site.version = None
+            return False
+
+    def fetch(self):
+        """Returns (status, JSON body) of the merged view of every site heard from recently."""
+        self.dirty |= any(list(self.executor.map(self._pull, self.sites)))
+        now = time.time()
+        live = [site for site in self.sites if now - site.updated <= SITE_STALE_AFTER]
+        if not live:
+            return 503, error_body(f"None of the {len(self.sites)} federated sites answered.")
+        newest = max(site.snapshot_time for site in live)
+        if newest != self.newest:
+            self.newest, self.newest_seen = newest, now
+        # Merge once every site has caught up, so each view covers the same interval
+        # on all sites and rates derived from it stay right
+        lagging = any(site.snapshot_time < newest for site in live)
+        if lagging and self.body is not None and now - self.newest_seen < SITE_LAG_GRACE:
+            return 200, self.body[1]
+        names = tuple(site.name for site in live)
+        if self.dirty or self.body is None or names != self.body[0]:
+            self.dirty = False
+            merged = {}
+            for site in live:
+                merged.update(site.stats)
+            self.body = names, json.dumps(merged, separators=(',', ':')).encode()
+        return 200, self.body[1]
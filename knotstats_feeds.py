@@ -0,0 +1,194 @@
+################################################################################
+# Knot Resolver Goodies - blocklist feeds
+################################################################################
+#
+# Downloads the RPZ feeds listed in a manifest, for `knotstats-rpz.py update`.
+# See `adblock-feeds.json`:
+#
+# - `name`         the zone's file name, as kresd loads it from the release
+# - `urls`         mirrors, tried in order until one gives a valid zone
+# - `interval`     seconds between checks for a new version (default: a day)
+# - `min_size`, `max_size`  bytes; downloads outside them are rejected, and
+#                  a download is abandoned as soon as it passes `max_size`
+# - `timeout`      seconds the feed may take across all its mirrors
+# - `max_invalid`  fraction of invalid records to tolerate
+#
+# Feeds are fetched in parallel, each on its own thread with its own time
+# budget, so a dead mirror or a slow feed costs only that feed: its installed
+# zone stays, and the others go ahead. Requests are conditional on the
+# ETag and Last-Modified of the installed version, and a download identical
+# to it counts as unchanged. `file://` URLs are read like any other, and a
+# source directory replaces every feed's URLs with `<directory>/<name>`, so
+# the updater runs offline against local files.
+#
+
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import pathlib
+import re
+import time
+import urllib.error
+import urllib.request
+
+from knotstats_names import check_file
+
+READ_SIZE = 1 << 20
+FEED_NAME_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+USER_AGENT = 'knotstats-rpz'
+
+
+class ManifestError(ValueError):
+    """Raised for an invalid feed manifest."""
+
+
+class FeedError(Exception):
+    """A mirror didn't give a usable zone."""
+
+
+class Feed:
+    """One feed of the manifest."""
+
+    def __init__(self, config):
+        try:
+            self.name = config['name']
+            self.urls = list(config['urls'])
+        except (KeyError, TypeError) as e:
+            raise ManifestError(f"Feed is missing {e}: {config}")
+        if not isinstance(self.name, str) or not FEED_NAME_RE.fullmatch(self.name):
+            raise ManifestError(f"Feed name {self.name!r} isn't a plain file name")
+        if not self.urls or not all(isinstance(url, str) for url in self.urls):
+            raise ManifestError(f"Feed {self.name!r} needs a list of URLs")
+        self.interval = float(config.get('interval', 86400))
+        self.min_size = int(config.get('min_size', 1))
+        self.max_size = int(config.get('max_size', 256 << 20))
+        self.timeout = float(config.get('timeout', 300))
+        self.max_invalid = float(config.get('max_invalid', 0.01))
+
+    def due(self, state, now):
+        return now - state.get('checked', 0) >= self.interval
+
+    def fetch(self, directory, state, installed):
+        """Downloads the feed into `directory`; returns (path or None if unchanged, new state).
+
+        state is what the last successful fetch returned, and installed the
+        path of the zone now installed, if any. Raises FeedError once every
+        mirror has failed.
+        """
+        deadline = time.monotonic() + self.timeout
+        errors = []
+        for url in self.urls:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                errors.append(f"{url}: out of time")
+                break
+            try:
+                return self._fetch(url, directory, state if installed else {}, installed, deadline)
+            except (FeedError, urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as e:
+                errors.append(f"{url}: {e}")
+        raise FeedError('; '.join(errors))
+
+    def _fetch(self, url, directory, state, installed, deadline):
+        headers = {'User-Agent': USER_AGENT}
+        if state.get('url') == url:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        path = os.path.join(directory, self.name)
+        part = f"{path}.part"
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                        timeout=max(deadline - time.monotonic(), 1)) as response:
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > self.max_size:
+                    raise FeedError(f"{length} bytes, over the {self.max_size} byte limit")
+                digest, size = hashlib.sha256(), 0
+                with open(part, 'wb') as out:
+                    # read1() returns whatever has arrived, so a trickling mirror still runs into the deadline
+                    while chunk := response.read1(READ_SIZE):
+                        size += len(chunk)
+                        if size > self.max_size:
+                            raise FeedError(f"over the {self.max_size} byte limit")
+                        if time.monotonic() > deadline:
+                            raise FeedError(f"out of time after {size} bytes")
+                        digest.update(chunk)
+                        out.write(chunk)
+                # read1() doesn't raise IncompleteRead, so a connection dropped mid-body looks like the end
+                if length and length.isdigit() and size < int(length):
+                    raise FeedError(f"truncated at {size} of {length} bytes")
+                new_state = {'url': url, 'checked': time.time(), 'sha256': digest.hexdigest(),
+                             'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, {**state, 'checked': time.time()}
+            raise
+        except BaseException:
+            if os.path.exists(part):
+                os.unlink(part)
+            raise
+        try:
+            if size < self.min_size:
+                raise FeedError(f"only {size} bytes, under the {self.min_size} byte minimum")
+            if installed and new_state['sha256'] == state.get('sha256'):
+                return None, new_state
+            entries, invalid, errors = check_file(part, 'rpz')
+            if not entries or invalid > entries * self.max_invalid:
+                raise FeedError(f"{entries} entries, {invalid} invalid" + (f" ({errors[0]})" if errors else ""))
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.unlink(part)
+        return path, new_state
+
+
+def load_manifest(path, source_dir=None):
+    """Returns the Feeds of a manifest; with source_dir, each is read from `<source_dir>/<name>` instead."""
+    with open(path) as file:
+        try:
+            config = json.load(file)
+        except ValueError as e:
+            raise ManifestError(f"{path}: {e}")
+    feeds = [Feed(feed) for feed in config.get('feeds', [])] if isinstance(config, dict) else []
+    if not feeds:
+        raise ManifestError(f"{path} lists no feeds")
+    names = [feed.name for feed in feeds]
+    if len(set(names)) != len(names):
+        raise ManifestError(f"{path} lists a feed name twice")
+    if source_dir:
+        for feed in feeds:
+            feed.urls = [pathlib.Path(source_dir, feed.name).resolve().as_uri()]
+    return feeds
+
+
+def fetch_feeds(feeds, directory, states, installed_dir, force=False):
+    """Fetches the feeds that are due, in parallel; returns {name: (path, state, error)}.
+
+    path is None for feeds that are unchanged or failed; error is None unless
+    the feed failed. Feeds not yet due are left out.
+    """
+    now = time.time()
+    due = [feed for feed in feeds if force or feed.due(states.get(feed.name, {}), now)]
+    results = {}
+    if not due:
+        return results
+
+    def fetch(feed):
+        installed = installed_dir and os.path.join(installed_dir, feed.name)
+        return feed.fetch(directory, states.get(feed.name, {}), installed if installed and os.path.exists(installed) else None)
+
+    with concurrent.futures.ThreadPoolExecutor(min(16, len(due)), thread_name_prefix='knotstats-feed') as executor:
+        futures = {executor.submit(fetch, feed): feed for feed in due}
+        for future in concurrent.futures.as_completed(futures):
+            feed = futures[future]
+            try:
+                path, state = future.result()
+                results[feed.name] = (path, state, None)
+            except FeedError as e:
+                results[feed.name] = (None, None, str(e))
+            except Exception as e:
+                # Whatever went wrong is this feed's failure, not the other feeds'
+                results[feed.name] = (None, None, f"{type(e).__name__}: {e}")
+    return results
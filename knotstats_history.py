@@ -0,0 +1,458 @@
+################################################################################
+# Knot Resolver Stats Dashboard - stats history, export and replay
+################################################################################
+#
+# Keeps a rolling history of scrapes, so that what `knotstats-v6.py` showed
+# around an incident can be exported to a file (`/api/export`, `--export`)
+# and replayed through a dashboard later (`--replay`).
+#
+# Every `--history-interval` seconds the scraper appends the columnar values
+# of the latest scrape (see `encode_columnar()`) to a pending file,
+# zlib-compressed, with the id of their key dictionary. Every SEGMENT_SECONDS
+# the pending snapshots are encoded into a segment: one column per
+# (instance, key), each stored as delta-of-delta integers, scaled by the
+# fewest decimal places that represent the column exactly, or as raw float64
+# when none does. Counters growing at a steady rate become runs of small
+# numbers and unchanging values become zeros, which zlib then squeezes
+# further. Segments older than `--history-retention` are deleted.
+#
+# An export is MAGIC followed by blocks, each a length-prefixed segment that
+# decodes on its own. Exporting a window copies the stored segments inside it
+# and only encodes the snapshots at its edges and those still pending.
+#
+# Block layout, zlib-compressed after its 4-byte length:
+#   4-byte header length, JSON header {"instances", "keys", "rows", "columns"},
+#   then the time column (milliseconds) and each data column in order.
+# "columns" holds [decimals, flags, size] per column, instance-major:
+# decimals -1 means float64, flag 1 a presence bitmap before the values
+# (instances come and go), flag 2 a column with no values at all.
+#
+
+import glob
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'KSNAP1\n'
+SEGMENT_SECONDS = 3600
+MAX_DECIMALS = 6
+
+# Pending snapshot: time, dictionary id, length of the compressed values
+PENDING_RECORD = struct.Struct('<d16sI')
+
+FLAG_BITMAP = 1
+FLAG_ABSENT = 2
+
+
+def _zigzag_varints(numbers):
+    zigzag = [n * 2 if n >= 0 else -n * 2 - 1 for n in numbers]
+    if not zigzag or max(zigzag) < 0x80:
+        return bytes(zigzag)
+    out = bytearray()
+    for z in zigzag:
+        while z >= 0x80:
+            out.append((z & 0x7f) | 0x80)
+            z >>= 7
+        out.append(z)
+    return bytes(out)
+
+
+def _read_zigzag_varints(buf, count):
+    if len(buf) == count:
+        zigzag = list(buf)
+    else:
+        zigzag = []
+        z = shift = 0
+        for byte in buf:
+            z |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                zigzag.append(z)
+                z = shift = 0
+            else:
+                shift += 7
+    return [z >> 1 if not z & 1 else -(z >> 1) - 1 for z in zigzag]
+
+
+def encode_delta_of_delta(ints):
+    out, previous, previous_delta = [], 0, 0
+    for n in ints:
+        delta = n - previous
+        out.append(delta - previous_delta)
+        previous, previous_delta = n, delta
+    return _zigzag_varints(out)
+
+
+def decode_delta_of_delta(buf, count):
+    ints, previous, delta = [], 0, 0
+    for dod in _read_zigzag_varints(buf, count):
+        delta += dod
+        previous += delta
+        ints.append(previous)
+    return ints
+
+
+def _decimals(values):
+    """Returns the fewest decimal places that represent every value exactly, or None."""
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10 ** decimals
+        if all(abs(value) * scale < 2 ** 53 and round(value * scale) / scale == value for value in values):
+            return decimals
+    return None
+
+
+def _float_bytes(values):
+    values = array('d', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _floats(buf):
+    values = array('d', buf)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+def encode_block(rows):
+    """Encodes snapshots as one block.
+
+    rows are (time, instances, keys, values) in time order, where values is a
+    row-major float64 sequence per (instance, key) with NaN where missing, as
+    in the columnar wire format. Instances and keys may change between rows.
+    """
+    instances = sorted(set().union(*(row[1] for row in rows)))
+    keys = sorted(set().union(*(map(tuple, row[2]) for row in rows)))
+    instance_index = {instance: n for n, instance in enumerate(instances)}
+    key_index = {key: n for n, key in enumerate(keys)}
+    nan = float('nan')
+    columns = [[nan] * len(rows) for _ in range(len(instances) * len(keys))]
+    targets = {}
+    for row_number, (_, row_instances, row_keys, values) in enumerate(rows):
+        layout = (tuple(row_instances), tuple(map(tuple, row_keys)))
+        if layout not in targets:
+            targets[layout] = [instance_index[instance] * len(keys) + key_index[key]
+                               for instance in layout[0] for key in layout[1]]
+        for column, value in zip(targets[layout], values):
+            columns[column][row_number] = value
+    specs, encoded = [], [encode_delta_of_delta([round(row[0] * 1000) for row in rows])]
+    for column in columns:
+        present = [value for value in column if not math.isnan(value)]
+        if not present:
+            specs.append([0, FLAG_ABSENT, 0])
+            continue
+        flags, data = 0, b''
+        if len(present) < len(column):
+            flags = FLAG_BITMAP
+            bits = 0
+            for n, value in enumerate(column):
+                if not math.isnan(value):
+                    bits |= 1 << n
+            data = bits.to_bytes((len(column) + 7) // 8, 'little')
+        decimals = _decimals(present)
+        if decimals is None:
+            data += _float_bytes(present)
+            decimals = -1
+        else:
+            scale = 10 ** decimals
+            data += encode_delta_of_delta([round(value * scale) for value in present])
+        specs.append([decimals, flags, len(data)])
+        encoded.append(data)
+    header = json.dumps({"instances": instances, "keys": keys, "rows": len(rows), "times": len(encoded[0]),
+                         "columns": specs}, separators=(',', ':')).encode()
+    body = zlib.compress(struct.pack('>I', len(header)) + header + b''.join(encoded), 9)
+    return struct.pack('>I', len(body)) + body
+
+
+def decode_block(body):
+    """Returns (times, instances, keys, columns) of a block body (without its length prefix).
+
+    Each column is a list with one value per time, None where missing.
+    """
+    raw = zlib.decompress(body)
+    header_length = struct.unpack_from('>I', raw)[0]
+    header = json.loads(raw[4:4 + header_length])
+    count = header['rows']
+    pos = 4 + header_length
+    times = [ms / 1000 for ms in decode_delta_of_delta(raw[pos:pos + header['times']], count)]
+    pos += header['times']
+    columns = []
+    for decimals, flags, size in header['columns']:
+        if flags & FLAG_ABSENT:
+            columns.append([None] * count)
+            continue
+        data = raw[pos:pos + size]
+        pos += size
+        present = list(range(count))
+        if flags & FLAG_BITMAP:
+            bits = int.from_bytes(data[:(count + 7) // 8], 'little')
+            data = data[(count + 7) // 8:]
+            present = [n for n in range(count) if bits >> n & 1]
+        if decimals < 0:
+            values = _floats(data)
+        elif decimals == 0:
+            values = decode_delta_of_delta(data, len(present))
+        else:
+            scale = 10 ** decimals
+            values = [n / scale for n in decode_delta_of_delta(data, len(present))]
+        column = [None] * count
+        for n, value in zip(present, values):
+            column[n] = value
+        columns.append(column)
+    return times, header['instances'], [tuple(key) for key in header['keys']], columns
+
+
+def read_blocks(data):
+    """Yields the block bodies in an export file's contents."""
+    if not data.startswith(MAGIC):
+        raise ValueError("not a knotstats snapshot export")
+    pos = len(MAGIC)
+    while pos < len(data):
+        if pos + 4 > len(data):
+            raise ValueError("truncated snapshot export")
+        length = struct.unpack_from('>I', data, pos)[0]
+        if pos + 4 + length > len(data):
+            raise ValueError("truncated snapshot export")
+        yield data[pos + 4:pos + 4 + length]
+        pos += 4 + length
+
+
+def block_snapshots(body):
+    """Returns the snapshots in a block as rows for encode_block()."""
+    times, instances, keys, columns = decode_block(body)
+    nan = float('nan')
+    return [(t, instances, keys, [nan if column[row] is None else column[row] for column in columns])
+            for row, t in enumerate(times)]
+
+
+def block_rows(body):
+    """Yields (time, {instance: {section: {key: value}}}) for each snapshot in a block."""
+    times, instances, keys, columns = decode_block(body)
+    for row, t in enumerate(times):
+        stats = {}
+        for instance_number, instance in enumerate(instances):
+            sections = {}
+            for key_number, path in enumerate(keys):
+                value = columns[instance_number * len(keys) + key_number][row]
+                if value is None:
+                    continue
+                node = sections
+                for part in path[:-1]:
+                    node = node.setdefault(part, {})
+                node[path[-1]] = value
+            if sections:
+                stats[instance] = sections
+        yield t, stats
+
+
+class HistoryRecorder:
+    """Scrape hook recording a snapshot every `interval` seconds, and the leader task maintaining them."""
+
+    def __init__(self, cache, directory, interval, retention):
+        self.cache = cache
+        self.directory = directory
+        self.interval = interval
+        self.retention = retention
+        self.slot = None
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'dictionaries'), mode=0o700, exist_ok=True)
+
+    def _pending_path(self, suffix=''):
+        return os.path.join(self.directory, f"pending{suffix}")
+
+    def _dictionary_path(self, dictionary_id):
+        return os.path.join(self.directory, 'dictionaries', f"{dictionary_id}.json")
+
+    def update(self, data):
+        slot = int(time.time() // self.interval)
+        if slot == self.slot:
+            return
+        columnar = self.cache.get('stats.columnar')
+        dictionary = self.cache.get('stats.dictionary')
+        if columnar is None or dictionary is None or columnar.meta['dictionary'] != dictionary.meta['id']:
+            return
+        self.slot = slot
+        dictionary_id = dictionary.meta['id']
+        if not os.path.exists(self._dictionary_path(dictionary_id)):
+            tmp_path = f"{self._dictionary_path(dictionary_id)}.tmp.{os.getpid()}"
+            with open(tmp_path, 'wb') as file:
+                file.write(dictionary.body)
+            os.replace(tmp_path, self._dictionary_path(dictionary_id))
+        values = zlib.compress(columnar.body)
+        record = PENDING_RECORD.pack(columnar.meta['updated'], dictionary_id.encode(), len(values)) + values
+        with self.lock:
+            # One write per record; readers ignore a partial record at the end
+            with open(self._pending_path(), 'ab') as file:
+                file.write(record)
+
+    def run(self):
+        """Encodes pending snapshots into segments and deletes expired ones; runs on the leader."""
+        while True:
+            try:
+                self.rotate()
+                self.prune()
+            except Exception as e:
+                logger.error(f"Stats history maintenance failed: {e}", exc_info=True)
+            time.sleep(60)
+
+    def rotate(self, force=False):
+        """Moves pending snapshots into a segment once the oldest is SEGMENT_SECONDS old."""
+        oldest = next(self._pending_records(self._pending_path()), None)
+        if oldest and (force or time.time() - oldest[0] >= SEGMENT_SECONDS):
+            with self.lock:
+                os.replace(self._pending_path(), self._pending_path(f".{time.time_ns()}"))
+        # Also picks up snapshots a scraper that died mid-rotation left behind
+        for path in sorted(glob.glob(self._pending_path('.*'))):
+            rows = self._pending_rows(path)
+            if rows:
+                name = f"{round(rows[0][0] * 1000)}-{round(rows[-1][0] * 1000)}.block"
+                tmp_path = os.path.join(self.directory, f"{name}.tmp.{os.getpid()}")
+                with open(tmp_path, 'wb') as file:
+                    file.write(encode_block(rows))
+                os.replace(tmp_path, os.path.join(self.directory, name))
+            os.unlink(path)
+
+    def prune(self):
+        cutoff = (time.time() - self.retention) * 1000
+        for start, end, path in self._segments():
+            if end < cutoff:
+                os.unlink(path)
+        # Dictionaries are only needed by pending snapshots; segments embed theirs
+        in_use = {dictionary_id for path in glob.glob(self._pending_path('*'))
+                  for dictionary_id in self._pending_dictionary_ids(path)}
+        for path in glob.glob(os.path.join(self.directory, 'dictionaries', '*.json')):
+            if os.path.basename(path)[:-len('.json')] not in in_use:
+                os.unlink(path)
+
+    def _segments(self):
+        """Returns (start ms, end ms, path) of the stored segments, oldest first."""
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, '*.block')):
+            try:
+                start, end = map(int, os.path.basename(path)[:-len('.block')].split('-'))
+            except ValueError:
+                continue
+            segments.append((start, end, path))
+        return sorted(segments)
+
+    def _pending_records(self, path):
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+        pos = 0
+        while pos + PENDING_RECORD.size <= len(data):
+            t, dictionary_id, length = PENDING_RECORD.unpack_from(data, pos)
+            pos += PENDING_RECORD.size
+            if pos + length > len(data):
+                return
+            yield t, dictionary_id.decode(), data[pos:pos + length]
+            pos += length
+
+    def _pending_dictionary_ids(self, path):
+        return {dictionary_id for _, dictionary_id, _ in self._pending_records(path)}
+
+    def _pending_rows(self, path, start=0.0, end=float('inf')):
+        rows, dictionaries = [], {}
+        for t, dictionary_id, values in self._pending_records(path):
+            if not start <= t <= end:
+                continue
+            if dictionary_id not in dictionaries:
+                try:
+                    with open(self._dictionary_path(dictionary_id), 'rb') as file:
+                        dictionaries[dictionary_id] = json.load(file)
+                except FileNotFoundError:
+                    dictionaries[dictionary_id] = None
+            dictionary = dictionaries[dictionary_id]
+            if dictionary is not None:
+                rows.append((t, dictionary['instances'], dictionary['keys'], _floats(zlib.decompress(values))))
+        return rows
+
+    def export(self, start, end, step=0.0):
+        """Returns an export of the snapshots taken from start to end, at most one per `step` seconds."""
+        out = bytearray(MAGIC)
+        last = [float('-inf')]
+
+        def keep(t):
+            if t < start or t > end or t < last[0] + (step or 1e-6):
+                return False
+            last[0] = t
+            return True
+
+        def add(rows):
+            rows = [row for row in rows if keep(row[0])]
+            if rows:
+                out.extend(encode_block(rows))
+
+        for segment_start, segment_end, path in self._segments():
+            if segment_end < start * 1000 or segment_start > end * 1000:
+                continue
+            try:
+                with open(path, 'rb') as file:
+                    block = file.read()
+            except FileNotFoundError:
+                continue  # Pruned meanwhile
+            if not step and start * 1000 <= segment_start and segment_end <= end * 1000 and segment_start > last[0] * 1000:
+                # Entirely inside the window: copy it as stored
+                out.extend(block)
+                last[0] = segment_end / 1000
+                continue
+            add(block_snapshots(block[4:]))
+        pending = sorted(glob.glob(self._pending_path('.*'))) + [self._pending_path()]
+        add(row for path in pending for row in self._pending_rows(path, start, end))
+        return bytes(out)
+
+
+class HistoryReplay:
+    """Serves the snapshots in an export in place of scrapes, `speed` times faster than recorded.
+
+    The replay's start time is kept in the shared cache by `start()`, so
+    whichever worker scrapes plays the same point of the recording.
+    """
+
+    def __init__(self, path, speed):
+        with open(path, 'rb') as file:
+            self.blocks = list(read_blocks(file.read()))
+        self.path = path
+        self.speed = speed
+        self.rows = (row for block in self.blocks for row in block_rows(block))
+        self.current = next(self.rows, None)
+        if self.current is None:
+            raise ValueError("the export holds no snapshots")
+        self.upcoming = next(self.rows, None)
+        self.first_time = self.current[0]
+        self.cache = None
+        self.body = None
+        self.lock = threading.Lock()
+
+    def start(self, cache):
+        """Starts the replay now, for every worker sharing the cache."""
+        self.cache = cache
+        cache.put('replay.started', b'', started=time.time())
+
+    def fetch(self):
+        """Returns (status, JSON body) of the snapshot due at this point of the replay."""
+        with self.lock:
+            due = self.first_time + (time.time() - self.cache.get('replay.started').meta['started']) * self.speed
+            while self.upcoming is not None and self.upcoming[0] <= due:
+                self.current, self.upcoming = self.upcoming, next(self.rows, None)
+                self.body = None
+                if self.upcoming is None:
+                    logger.info(f"Replay of {self.path} reached its last snapshot")
+            if self.body is None:
+                self.body = json.dumps(self.current[1], separators=(',', ':')).encode()
+            return 200, self.body
+
+    def clock(self):
+        """Returns the recorded time of the snapshot being served, so rates come out as recorded."""
+        return self.current[0]
@@ -0,0 +1,313 @@
+################################################################################
+# Knot Resolver Stats Dashboard - hosts file editing and import
+################################################################################
+#
+# Backs the hosts editor of `knotstats-v6.py`.
+#
+# Edits are optimistic: every read returns the file's version (mtime and a
+# content hash), and every write names the version it was based on. Writers,
+# in any worker process, take an exclusive lock on `<hosts file>.lock`,
+# check the version, and write a temporary file that is renamed over the
+# hosts file; a stale version gets VersionConflict instead of overwriting
+# someone else's changes. Edits are patches of entries to add and remove,
+# so lines nobody touched, comments included, are kept as they are.
+#
+# Bulk imports (`/api/hosts/import`) go through the same lock, but only once
+# the upload is in. It is read line by line as it arrives, never held whole,
+# in hosts format (`ip name [alias...]`, `#` comments) or CSV (`ip,name`,
+# with an optional header row). Lines are validated a batch at a time, each
+# distinct IP in a batch once, since block lists map many names to the same
+# few addresses, and all names with one pattern match (see
+# `knotstats_names.py`), and the new entries staged in a temporary file, so
+# a slow client never holds up other writers. Then, with the lock held,
+# entries already in the hosts file are skipped and the rest merged into a
+# file written next to the hosts file and renamed over it, so Knot Resolver
+# never reads a half-written file. Appending keeps the existing file as it
+# is, comments and aliases included.
+#
+# The upload is never held whole, but the sets of entries seen grow with the
+# number of entries in the upload, and then in the file: about 100 bytes each.
+#
+
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import os
+import threading
+
+from knotstats_names import normalize_hostname, normalize_hostnames, normalize_ip, parse_hosts_lines, validate_hosts_lines
+
+READ_SIZE = 1 << 20
+BATCH_SIZE = 10000
+# Invalid lines reported back in detail; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def iter_lines(stream):
+    """Yields the lines of a binary stream, read in large chunks rather than a line at a time."""
+    pending = b''
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        complete, newline, pending = (pending + chunk).rpartition(b'\n')
+        if newline:
+            yield from complete.decode('utf-8', 'replace').split('\n')
+    if pending:
+        yield pending.decode('utf-8', 'replace')
+
+
+def line_fields(line):
+    """Returns [ip, name, alias...] for a hosts file line, or [] for blank lines and comments."""
+    return line.split('#', 1)[0].split()
+
+
+def read_entries(path):
+    """Yields (ip, hostname) for each name, aliases included, in an existing hosts file."""
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                fields = line_fields(line)
+                for name in fields[1:]:
+                    yield fields[0], name
+    except FileNotFoundError:
+        return
+
+
+class VersionConflict(Exception):
+    """The hosts file changed since the version a write was based on."""
+
+    def __init__(self, current):
+        super().__init__("The hosts file was changed by someone else since it was loaded")
+        self.current = current
+
+
+def parse_entries(content):
+    """Returns ([{"ip", "hostname"}], [{"line", "text", "error"}]) for hosts file content.
+
+    Each name on a line, aliases included, is an entry. Lines Knot Resolver
+    would reject or misread are reported instead.
+    """
+    numbered = [(number, line, fields) for number, line in enumerate(content.splitlines(), 1)
+                if (fields := line_fields(line))]
+    entries, invalid = [], []
+    for (number, line, fields), result in zip(numbered, validate_hosts_lines([fields for _, _, fields in numbered])):
+        if isinstance(result, str):
+            invalid.append({"line": number, "text": line, "error": result})
+            continue
+        entries.extend({"ip": fields[0], "hostname": name} for name in fields[1:])
+    return entries, invalid
+
+
+def validate_entry(entry):
+    """Returns (ip, hostname) as written to the file; raises ValueError for invalid ones."""
+    if not isinstance(entry, dict) or not isinstance(entry.get('ip'), str) or not isinstance(entry.get('hostname'), str):
+        raise ValueError("Each host must have both IP and hostname")
+    ip, hostname = normalize_ip(entry['ip'].strip()), normalize_hostname(entry['hostname'].strip())
+    if ip is None:
+        raise ValueError(f"Invalid IP address: {entry['ip']!r}")
+    if hostname is None:
+        raise ValueError(f"Invalid hostname: {entry['hostname']!r}")
+    return ip, hostname
+
+
+class HostsFile:
+    """The hosts file, read with a version and written only against the current one."""
+
+    def __init__(self, path):
+        self.path = path
+        self._memo = None  # ((mtime_ns, size), version)
+        self._memo_lock = threading.Lock()
+
+    def _read(self):
+        """Returns (version, content); version is None if the file doesn't exist."""
+        try:
+            with open(self.path, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                key = (stat.st_mtime_ns, stat.st_size)
+                with self._memo_lock:
+                    memo = self._memo
+                raw = file.read()
+        except FileNotFoundError:
+            return None, ''
+        if memo and memo[0] == key:
+            version = memo[1]
+        else:
+            version = f"{stat.st_mtime_ns:x}-{hashlib.sha256(raw).hexdigest()[:16]}"
+            with self._memo_lock:
+                self._memo = (key, version)
+        return version, raw.decode('utf-8', 'replace')
+
+    def version(self):
+        return self._read()[0]
+
+    def read(self):
+        """Returns (version, entries, invalid lines), as parse_entries()."""
+        version, content = self._read()
+        return (version, *parse_entries(content))
+
+    @contextlib.contextmanager
+    def locked(self, version=None):
+        """Holds the write lock; with a version, raises VersionConflict unless the file is still at it.
+
+        Pass a version of '' to require that the file doesn't exist yet.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if version is not None:
+                current, _ = self._read()
+                if (current or '') != version:
+                    raise VersionConflict(current)
+            yield
+
+    def write(self, content):
+        """Replaces the file atomically; call with the lock held. Returns the new version."""
+        tmp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, 'w') as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            if os.path.exists(self.path):
+                os.chmod(tmp_path, os.stat(self.path).st_mode & 0o7777)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return self.version()
+
+    def patch(self, version, add=(), remove=()):
+        """Removes and adds entries against `version`; returns (new version, added, removed).
+
+        Entries are {"ip", "hostname"} dicts, compared in canonical form, so
+        `A.example` matches `a.example` and `::0001` matches `::1`. Removing
+        an entry removes the name from every line with it, and lines left
+        without names; adding one already present does nothing.
+        """
+        additions = [validate_entry(entry) for entry in add]
+        removals = {(normalize_ip(entry['ip']) or entry['ip'], normalize_hostname(entry['hostname']) or entry['hostname'])
+                    for entry in remove
+                    if isinstance(entry, dict) and isinstance(entry.get('ip'), str) and isinstance(entry.get('hostname'), str)}
+        with self.locked(version):
+            _, content = self._read()
+            lines = content.splitlines()
+            parsed = [line_fields(line) for line in lines]
+            ips = {ip: normalize_ip(ip) or ip for ip in {fields[0] for fields in parsed if fields}}
+            # Canonical (ip, hostname) of every name in the file, in order, and the line each starts on
+            written = [name for fields in parsed for name in fields[1:]]
+            keys = list(zip([ips[fields[0]] for fields in parsed for _ in fields[1:]],
+                            [name or raw for name, raw in zip(normalize_hostnames(written), written)]))
+            # Only lines with a name to remove are rewritten, found from the index of the name
+            starts = list(itertools.accumulate((len(fields[1:]) for fields in parsed), initial=0))
+            dropped = {}
+            for index in [index for index, key in enumerate(keys) if key in removals] if removals else []:
+                number = bisect.bisect_right(starts, index) - 1
+                dropped.setdefault(number, set()).add(index - starts[number])
+            removed = 0
+            for number, drop in dropped.items():
+                removed += len(drop)
+                fields = parsed[number]
+                names = [name for index, name in enumerate(fields[1:]) if index not in drop]
+                comment = lines[number].partition('#')[2]
+                lines[number] = ' '.join([fields[0], *names]) + (f" #{comment}" if comment else '') if names else None
+            lines = [line for line in lines if line is not None]
+            present = {(ip, hostname) for ip, hostname in additions}.intersection(keys) - removals
+            added = 0
+            for ip, hostname in additions:
+                if (ip, hostname) not in present:
+                    present.add((ip, hostname))
+                    lines.append(f"{ip} {hostname}")
+                    added += 1
+            if not added and not removed:
+                return version, 0, 0
+            return self.write(''.join(line + '\n' for line in lines)), added, removed
+
+
+class HostsImport:
+    """Validates uploaded lines batch by batch into a staging file, then merges the new entries into the hosts file."""
+
+    def __init__(self, hosts_file, replace=False):
+        self.hosts_file = hosts_file
+        self.replace = replace
+        self.seen = set()
+        self.added = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+        suffix = f"{os.getpid()}.{threading.get_ident()}"
+        self.staging_path = f"{hosts_file.path}.upload.{suffix}"
+        self.tmp_path = f"{hosts_file.path}.import.{suffix}"
+
+    def _validate(self, numbers, lines, out):
+        parsed = parse_hosts_lines(lines)
+        numbers = [number for number, fields in zip(numbers, parsed) if fields]
+        parsed = [fields for fields in parsed if fields]
+        for line_number, result in zip(numbers, validate_hosts_lines(parsed)):
+            if isinstance(result, str):
+                self.invalid += 1
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append(f"line {line_number}: {result}")
+                continue
+            for name in result[1:]:
+                key = f"{result[0]} {name}"
+                if key in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(key)
+                out.write(key + '\n')
+
+    def _merge(self, dry_run):
+        """Writes the hosts file with the staged entries it doesn't have yet; call with the lock held."""
+        path = self.hosts_file.path
+        with open(os.devnull if dry_run else self.tmp_path, 'w') as out:
+            present = set()
+            if not self.replace:
+                # Keep the existing file as it is, comments and aliases included
+                try:
+                    with open(path, 'r') as existing:
+                        for line in existing:
+                            out.write(line if line.endswith('\n') else line + '\n')
+                except FileNotFoundError:
+                    pass
+                existing = list(read_entries(path))
+                canonical = {ip: normalize_ip(ip) or ip for ip in {ip for ip, _ in existing}}
+                names = normalize_hostnames([hostname for _, hostname in existing])
+                present.update(f"{canonical[ip]} {name or hostname}" for (ip, hostname), name in zip(existing, names))
+            with open(self.staging_path, 'r') as staged:
+                for line in staged:
+                    if line[:-1] in present:
+                        self.duplicates += 1
+                        continue
+                    out.write(line)
+                    self.added += 1
+            out.flush()
+            if not dry_run:
+                os.fsync(out.fileno())
+        if not dry_run and self.added:
+            if os.path.exists(path):
+                os.chmod(self.tmp_path, os.stat(path).st_mode & 0o7777)
+            os.replace(self.tmp_path, path)
+
+    def run(self, stream, version=None, dry_run=False):
+        """Imports an uploaded binary stream against `version`, as HostsFile.locked(); returns a report.
+
+        Nothing is written with dry_run; the report says what would have been.
+        """
+        try:
+            with open(self.staging_path, 'w') as out:
+                lines = iter_lines(stream)
+                line_number = 1
+                while batch := list(itertools.islice(lines, BATCH_SIZE)):
+                    self._validate(range(line_number, line_number + len(batch)), batch, out)
+                    line_number += len(batch)
+            self.seen.clear()
+            with self.hosts_file.locked(version):
+                self._merge(dry_run)
+        finally:
+            for path in (self.staging_path, self.tmp_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+        return {"added": self.added, "duplicates": self.duplicates, "invalid": self.invalid, "errors": self.errors}
@@ -0,0 +1,263 @@
+################################################################################
+# Knot Resolver Stats Dashboard - blocklist lookups
+################################################################################
+#
+# Answers "why is this name blocked?" for `/api/lookup` of `knotstats-v6.py`
+# without grepping the RPZ feeds and hosts file on every question.
+#
+# Each source file gets an index file of its own under the cache directory,
+# named after the source's path, mtime and size, so a changed feed rebuilds
+# only its own index and every worker process maps the same files. An index
+# holds one record per rule, `key \t line \t rule \n`, sorted by key, after
+# an array of record offsets. Keys are the owner's labels reversed
+# (`ads.example.com` is `com.example.ads`, `*.example.com` is
+# `com.example.*`), so all rules below a name are one contiguous range.
+#
+# The scraping worker rebuilds indexes as sources change; lookups keep using
+# the previous index of a changed source until its new one is ready.
+#
+# A lookup binary-searches each index, through the memory map, for the name
+# itself and for the wildcard of each of its parents; a handful of probes of
+# about twenty comparisons each, which takes microseconds.
+#
+
+import array
+import fcntl
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from knotstats_names import (normalize_hostname, normalize_hostnames, parse_hosts_line, parse_rpz_line,
+                             validate_hosts_lines)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'KSLKUP1\n'
+HEADER = struct.Struct('<8sI')
+# Seconds between checks of the sources for changes
+CHECK_INTERVAL = 5.0
+# What kresd does for an RPZ CNAME to each of these targets
+RPZ_ACTIONS = {'.': 'NXDOMAIN', '*.': 'NODATA', 'rpz-passthru.': 'PASSTHRU', 'rpz-drop.': 'DROP',
+               'rpz-tcp-only.': 'TCP-ONLY'}
+
+
+def reverse_key(name):
+    return '.'.join(reversed(name.split('.')))
+
+
+def rpz_records(path):
+    """Yields (key, line number, rule) for each record of an RPZ zone with a valid owner."""
+    records = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        for number, line in enumerate(file, 1):
+            record = parse_rpz_line(line)
+            if record is not None and record[1]:
+                records.append((number, record))
+    owners = normalize_hostnames([owner[2:] if owner.startswith('*.') else owner for _, (owner, _, _) in records])
+    for (number, (owner, rrtype, data)), name in zip(records, owners):
+        if name is not None:
+            key = reverse_key(name) + ('.*' if owner.startswith('*.') else '')
+            yield key, number, f"{owner} {rrtype} {data}"
+
+
+def hosts_records(path):
+    """Yields (key, line number, rule) for each name of a hosts file."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        lines = [(number, fields) for number, line in enumerate(file, 1)
+                 if (fields := parse_hosts_line(line))]
+    for (number, _), result in zip(lines, validate_hosts_lines([fields for _, fields in lines])):
+        if not isinstance(result, str):
+            for name in result[1:]:
+                yield reverse_key(name), number, f"{result[0]} {name}"
+
+
+def write_index(records, path):
+    """Writes sorted records to an index file, atomically."""
+    offsets = array.array('I', [0])
+    blob = bytearray()
+    for key, number, rule in sorted(records):
+        blob += f"{key}\t{number}\t{rule}\n".encode()
+        offsets.append(len(blob))
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(offsets) - 1))
+        file.write(offsets.tobytes())
+        file.write(blob)
+    os.replace(tmp_path, path)
+
+
+class Index:
+    """One source's index file, memory-mapped."""
+
+    def __init__(self, path, source, kind):
+        self.source = source
+        self.kind = kind
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a lookup index")
+        self.offsets = memoryview(self.map)[HEADER.size:HEADER.size + 4 * (self.count + 1)].cast('I')
+        self.base = HEADER.size + 4 * (self.count + 1)
+
+    def _key(self, index):
+        start = self.base + self.offsets[index]
+        return self.map[start:self.map.find(b'\t', start)]
+
+    def _lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, key):
+        """Returns [(line number, rule)] of the records with exactly this key."""
+        matches = []
+        index = self._lower_bound(key)
+        while index < self.count and self._key(index) == key:
+            record = self.map[self.base + self.offsets[index]:self.base + self.offsets[index + 1] - 1]
+            _, number, rule = record.decode().split('\t', 2)
+            matches.append((int(number), rule))
+            index += 1
+        return matches
+
+    def count_below(self, key):
+        """Returns how many records are for names below the key."""
+        return self._lower_bound(key + b'/') - self._lower_bound(key + b'.')
+
+
+class LookupIndex:
+    """The indexes of every RPZ zone matching `patterns` and of the hosts file, rebuilt as they change."""
+
+    def __init__(self, patterns, hosts_path, directory):
+        self.patterns = patterns
+        self.hosts_path = hosts_path
+        self.directory = directory
+        self.indexes = {}  # source path -> ((mtime_ns, size), Index)
+        self.pending = []  # source paths with no index built yet
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def sources(self):
+        """Returns [(path, kind)] of the files to index."""
+        paths = sorted({path for pattern in self.patterns for path in glob.glob(pattern)})
+        return [(path, 'rpz') for path in paths] + [(self.hosts_path, 'hosts')]
+
+    def _index_path(self, source, stat):
+        digest = hashlib.sha256(os.path.abspath(source).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{digest}-{stat.st_mtime_ns:x}-{stat.st_size:x}.idx")
+
+    def _build(self, source, kind, stat):
+        """Returns the Index of a source file, building it unless another worker already has."""
+        path = self._index_path(source, stat)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, 'build.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    started = time.monotonic()
+                    write_index(rpz_records(source) if kind == 'rpz' else hosts_records(source), path)
+                    logger.info(f"Indexed {source} for lookups in {time.monotonic() - started:.1f}s")
+                    self._remove_stale(source, path)
+        return Index(path, source, kind)
+
+    def _remove_stale(self, source, current):
+        """Deletes the index files of previous versions of a source."""
+        prefix = os.path.basename(current).split('-', 1)[0] + '-'
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith('.idx') and name != os.path.basename(current):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def refresh(self, force=False, build=True):
+        """Reindexes sources that changed since the last check, at most every CHECK_INTERVAL seconds.
+
+        Without build, a changed source keeps its previous index until another
+        caller, normally the leader, has built the new one, and a source with
+        no index built yet is left out until then.
+        """
+        if not force and time.monotonic() - self.checked < CHECK_INTERVAL:
+            return
+        with self.lock:
+            if not force and time.monotonic() - self.checked < CHECK_INTERVAL:
+                return
+            indexes, pending = {}, []
+            for source, kind in self.sources():
+                try:
+                    stat = os.stat(source)
+                except FileNotFoundError:
+                    continue
+                version = (stat.st_mtime_ns, stat.st_size)
+                known = self.indexes.get(source)
+                if known and known[0] == version:
+                    indexes[source] = known
+                    continue
+                if not build and not os.path.exists(self._index_path(source, stat)):
+                    if known:
+                        indexes[source] = known
+                    else:
+                        pending.append(source)
+                    continue
+                try:
+                    indexes[source] = (version, self._build(source, kind, stat))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Failed to index {source} for lookups: {e}")
+            self.indexes, self.pending = indexes, pending
+            self.checked = time.monotonic()
+
+    def lookup(self, name):
+        """Returns the rules matching a name in every source; raises ValueError for invalid names."""
+        started = time.perf_counter()
+        normalized = normalize_hostname(name.strip())
+        if normalized is None:
+            raise ValueError(f"Invalid name: {name!r}")
+        self.refresh(build=False)
+        labels = normalized.split('.')
+        # The name itself, then the wildcard of each parent, most specific first
+        probes = [(reverse_key(normalized).encode(), normalized)]
+        probes += [(f"{reverse_key('.'.join(labels[i:]))}.*".encode(), f"*.{'.'.join(labels[i:])}")
+                   for i in range(1, len(labels))]
+        # Keyed by path: zones in different directories can share a file name
+        matches, below = [], {}
+        for _, index in self.indexes.values():
+            source = os.path.basename(index.source)
+            for key, owner in probes:
+                for number, rule in index.find(key):
+                    if index.kind == 'rpz':
+                        _, rrtype, data = rule.split(' ', 2)
+                        action = RPZ_ACTIONS.get(data, 'LOCAL-DATA') if rrtype == 'CNAME' else 'LOCAL-DATA'
+                    else:
+                        action = 'HOSTS'
+                    matches.append({"source": source, "path": index.source, "line": number, "owner": owner,
+                                    "rule": rule, "action": action})
+            if count := index.count_below(probes[0][0]):
+                below[index.source] = count
+        return {
+            "name": normalized,
+            "matched": bool(matches),
+            "matches": matches,
+            "below": below,
+            "sources": {index.source: index.count for _, index in self.indexes.values()},
+            "pending": self.pending,
+            "micros": round((time.perf_counter() - started) * 1e6),
+        }
+
+    def run(self):
+        """Keeps the indexes built ahead of lookups; runs on the leader."""
+        while True:
+            try:
+                self.refresh(force=True)
+            except Exception as e:
+                logger.error(f"Lookup index refresh failed: {e}", exc_info=True)
+            time.sleep(CHECK_INTERVAL)
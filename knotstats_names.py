@@ -0,0 +1,218 @@
+################################################################################
+# Knot Resolver Goodies - hostname and address validation
+################################################################################
+#
+# Shared by the hosts editor of `knotstats-v6.py` and the RPZ updater, so
+# that nothing Knot Resolver would reject or misread gets into its files.
+#
+# - Addresses are parsed with `ipaddress` and written in canonical form.
+# - Names are lowercased, lose a trailing dot, and non-ASCII names are IDNA
+#   encoded to their `xn--` form. Python's codec is IDNA 2003, which maps the
+#   IDNA 2008 deviation characters (ß or ẞ, ς, ZWJ, ZWNJ) away, so `faß.de`
+#   would become `fass.de`, another domain; names with them are rejected
+#   rather than silently redirected. Labels are 1-63 letters, digits, hyphens
+#   or underscores, not starting or ending with a hyphen; names at most 253
+#   characters. RPZ owners may also start with a `*.` wildcard label.
+# - `normalize_hostnames()` checks a whole batch with one match of a
+#   precompiled pattern over the joined names, falling back to one name at a
+#   time only for batches with an invalid or non-ASCII name in them, which
+#   keeps bulk paths well above a million names a second.
+#
+# Run as a script to check files before installing them:
+#
+# ```
+# python3 knotstats_names.py rpz oisd.rpz.tmp --max-invalid 0.01
+# python3 knotstats_names.py hosts hosts.local
+# ```
+#
+
+import argparse
+import ipaddress
+import itertools
+import re
+import sys
+
+MAX_NAME_LENGTH = 253
+
+# Encoded differently by IDNA 2003 (Python's codec) and IDNA 2008 (browsers, registries)
+IDNA_DEVIATIONS = frozenset('\u00df\u1e9e\u03c2\u200c\u200d')
+
+LABEL = r'(?!-)[a-z0-9_-]{1,63}(?<!-)'
+NAME = rf'{LABEL}(?:\.{LABEL})*'
+NAME_RE = re.compile(NAME)
+# Every line of a '\n'-joined, lowercased batch is a valid name of at most MAX_NAME_LENGTH characters
+NAME_BATCH_RE = re.compile(rf'(?:(?=[^\n]{{1,{MAX_NAME_LENGTH}}}\n){NAME}\n)*')
+CSV_HEADER_RE = re.compile(r'\s*"?ip', re.IGNORECASE)
+
+# Errors kept in detail by check_file(); the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def normalize_ip(text):
+    """Returns the canonical form of an IPv4 or IPv6 address, or None if it isn't one."""
+    try:
+        return str(ipaddress.ip_address(text))
+    except ValueError:
+        return None
+
+
+def normalize_hostname(text):
+    """Returns the name lowercased, without a trailing dot and IDNA-encoded, or None if it isn't valid."""
+    name = text[:-1] if text.endswith('.') else text
+    if not name.isascii():
+        if not IDNA_DEVIATIONS.isdisjoint(name):
+            return None
+        try:
+            name = name.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+    name = name.lower()
+    if len(name) > MAX_NAME_LENGTH or not NAME_RE.fullmatch(name):
+        return None
+    return name
+
+
+def normalize_hostnames(names):
+    """Returns normalize_hostname() of each name in a list, checking the whole list at once where possible."""
+    if not names:
+        return []
+    joined = '\n'.join(names) + '\n'
+    if joined.isascii():
+        # A trailing dot sits before the line's newline: strip it in bulk, as normalize_hostname() does
+        lowered = joined.lower().replace('.\n', '\n')
+        if NAME_BATCH_RE.fullmatch(lowered):
+            return lowered.split('\n')[:-1]
+    return [normalize_hostname(name) for name in names]
+
+
+def normalize_rpz_owner(text):
+    """Like normalize_hostname(), also allowing a leading `*.` wildcard label."""
+    if text.startswith('*.'):
+        name = normalize_hostname(text[2:])
+        return None if name is None else f"*.{name}"
+    return normalize_hostname(text)
+
+
+def parse_hosts_line(line):
+    """Returns the fields [ip, name, alias...] of a hosts or CSV line, or None for blank lines, comments and CSV headers.
+
+    Hosts lines are `ip name [alias...]`; CSV lines `ip,name[,alias...]`.
+    Nothing is validated.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    if ',' in line:
+        if CSV_HEADER_RE.match(line):
+            return None
+        fields = [field.strip().strip('"') for field in line.split(',')]
+        return fields[:1] + [field for field in fields[1:] if field]
+    return line.split()
+
+
+def parse_hosts_lines(lines):
+    """Returns parse_hosts_line() of each line in a list."""
+    joined = '\n'.join(lines)
+    if '#' in joined or ',' in joined:
+        return [parse_hosts_line(line) for line in lines]
+    return [line.split() or None for line in lines]
+
+
+def validate_hosts_lines(parsed):
+    """Validates parsed hosts lines in bulk.
+
+    parsed is a list of [ip, name, alias...]. Returns a list with, for each
+    line, either [canonical ip, normalized names...] or an error message.
+    Each distinct address is parsed once, and all names are checked together.
+    """
+    ips = {ip: normalize_ip(ip) for ip in {fields[0] for fields in parsed}}
+    one_name = all(len(fields) == 2 for fields in parsed)
+    flat = [fields[1] for fields in parsed] if one_name else [name for fields in parsed for name in fields[1:]]
+    normalized = normalize_hostnames(flat)
+    if all(ip == canonical for ip, canonical in ips.items()):
+        # Lines already in canonical form, as most of a block list is, are returned as they are
+        if normalized == flat and (one_name or all(len(fields) > 1 for fields in parsed)):
+            return parsed
+        if one_name and None not in normalized:
+            return [[fields[0], name] for fields, name in zip(parsed, normalized)]
+    normalized = iter(normalized)
+    results = []
+    for fields in parsed:
+        ip, names = fields[0], fields[1:]
+        line_names = [next(normalized) for _ in names]
+        if ips[ip] is None:
+            results.append(f"invalid IP address {ip!r}")
+        elif not names:
+            results.append("no hostname")
+        elif None in line_names:
+            results.append(f"invalid hostname {names[line_names.index(None)]!r}")
+        else:
+            results.append([ips[ip], *line_names])
+    return results
+
+
+def parse_rpz_line(line):
+    """Returns (owner, type, data) for a record line of an RPZ zone, or None for anything else.
+
+    Directives, comments, blank lines and the zone's own SOA and NS records
+    (at `@` or on continuation lines) return None.
+    """
+    line = line.split(';', 1)[0]
+    if not line.strip() or line[0] in ' \t$@(' or line.strip() == ')':
+        return None
+    fields = line.split()
+    # owner [ttl] [class] type data
+    position = 1
+    while position < len(fields) - 1 and (fields[position].isdigit() or fields[position].upper() in ('IN', 'CH')):
+        position += 1
+    if position >= len(fields) - 1:
+        return fields[0], '', ''
+    rrtype = fields[position].upper()
+    if rrtype in ('SOA', 'NS'):
+        return None
+    return fields[0], rrtype, ' '.join(fields[position + 1:])
+
+
+def _problems(kind, records):
+    """Returns the problem with each parsed hosts line or RPZ record, or None if it is valid."""
+    if kind == 'hosts':
+        return [result if isinstance(result, str) else None for result in validate_hosts_lines(records)]
+    owners = normalize_hostnames([owner[2:] if owner.startswith('*.') else owner for owner, _, _ in records])
+    return [f"invalid owner {owner!r}" if name is None else None if rrtype else "record without a type"
+            for (owner, rrtype, _), name in zip(records, owners)]
+
+
+def check_file(path, kind, batch_size=10000):
+    """Returns (entries, invalid, [error messages]) for a hosts file or RPZ zone."""
+    entries, invalid, errors = 0, 0, []
+    parse = parse_hosts_line if kind == 'hosts' else parse_rpz_line
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        parsed = ((number, parse(line)) for number, line in enumerate(file, 1))
+        records = ((number, record) for number, record in parsed if record is not None)
+        while batch := list(itertools.islice(records, batch_size)):
+            entries += len(batch)
+            for (number, _), problem in zip(batch, _problems(kind, [record for _, record in batch])):
+                if problem:
+                    invalid += 1
+                    if len(errors) < MAX_REPORTED_ERRORS:
+                        errors.append(f"line {number}: {problem}")
+    return entries, invalid, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check a hosts file or RPZ zone for entries Knot Resolver would reject.")
+    parser.add_argument('kind', choices=['hosts', 'rpz'])
+    parser.add_argument('path')
+    parser.add_argument('--max-invalid', type=float, default=0.0,
+                        help="Fraction of invalid entries to tolerate (default: %(default)s)")
+    args = parser.parse_args(argv)
+    entries, invalid, errors = check_file(args.path, args.kind)
+    for error in errors:
+        print(f"{args.path}: {error}", file=sys.stderr)
+    print(f"{args.path}: {entries} entries, {invalid} invalid")
+    if not entries or invalid > entries * args.max_invalid:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
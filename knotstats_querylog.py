@@ -0,0 +1,306 @@
+################################################################################
+# Knot Resolver Stats Dashboard - query log ingestion
+################################################################################
+#
+# Streams a query log into bounded-memory top-K counts of query names,
+# clients, query types and response codes per time window, for the "Top Talkers"
+# tab of `knotstats-v6.py`.
+#
+# Sources (`--querylog`):
+#
+# - a file path, followed like `tail -F` (rotation and truncation included),
+# - `unix:/path/to/socket`, a stream socket the backend listens on; any
+#   number of writers can connect.
+#
+# Formats (`--querylog-format`):
+#
+# - `text`: one query per line, `[timestamp] client qname qtype rcode`,
+#   separated by whitespace.
+# - `json`: one object per line with `client`, `qname`, `qtype` and `rcode`.
+#
+# Input is read and parsed in large batches. Each batch is counted with
+# `collections.Counter` before being merged into the per-window summaries, so
+# normalisation and merging are per distinct value, not per query.
+#
+
+import heapq
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter, deque
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('qname', 'client', 'qtype', 'rcode')
+
+READ_SIZE = 1 << 20
+
+
+class TopK:
+    """Bounded-memory heavy-hitter counts, with the Space-Saving guarantee.
+
+    Counts grow until twice `capacity` distinct items are held, then only the
+    `capacity` largest are kept. `error` is at least the largest count ever
+    evicted, and items counted after an eviction start from it rather than
+    from 0, as in Space-Saving. So an item outside the summary occurred at
+    most `error` times, and a kept item's count is never low, and high by at
+    most `error`.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def update(self, counts):
+        own, error = self.counts, self.error
+        for item, count in counts.items():
+            own[item] = own.get(item, error) + count
+        if len(own) > 2 * self.capacity:
+            self._prune()
+
+    def merge(self, other):
+        # An item missing from one summary may have been evicted from it, with up to its error
+        own = self.counts
+        if other.error:
+            for item in own.keys() - other.counts.keys():
+                own[item] += other.error
+        for item, count in other.counts.items():
+            own[item] = own.get(item, self.error) + count
+        self.error += other.error
+        if len(own) > 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        largest = heapq.nlargest(self.capacity + 1, self.counts.items(), key=itemgetter(1))
+        self.error = max(self.error, largest[-1][1])
+        self.counts = dict(largest[:-1])
+
+    def top(self, n):
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+
+def normalize_qname(qname):
+    return qname.rstrip('.').lower() or '.'
+
+
+def normalize_client(client):
+    """Strips the port from `addr#port`, `ipv4:port` and `[ipv6]:port` forms."""
+    if '#' in client:
+        return client.split('#', 1)[0]
+    if client.startswith('['):
+        return client[1:].split(']', 1)[0]
+    if client.count(':') == 1:
+        return client.split(':', 1)[0]
+    return client
+
+
+NORMALIZERS = {
+    'qname': normalize_qname,
+    'client': normalize_client,
+    'qtype': str.upper,
+    'rcode': str.upper,
+}
+
+
+def count_text(lines):
+    """Counts the fields of `[timestamp] client qname qtype rcode` lines; returns (counters, bad lines)."""
+    clients, qnames, qtypes, rcodes = [], [], [], []
+    bad = 0
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 5:
+            fields = fields[1:]
+        elif len(fields) != 4:
+            if fields:
+                bad += 1
+            continue
+        clients.append(fields[0])
+        qnames.append(fields[1])
+        qtypes.append(fields[2])
+        rcodes.append(fields[3])
+    return {'client': Counter(clients), 'qname': Counter(qnames),
+            'qtype': Counter(qtypes), 'rcode': Counter(rcodes)}, bad
+
+
+def count_json(lines):
+    """Counts the fields of JSON lines; returns (counters, bad lines)."""
+    counters = {field: Counter() for field in FIELDS}
+    bad = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            values = [str(record[field]) for field in FIELDS]
+        except (ValueError, KeyError, TypeError):
+            bad += 1
+            continue
+        for field, value in zip(FIELDS, values):
+            counters[field][value] += 1
+    return counters, bad
+
+
+COUNTERS = {'text': count_text, 'json': count_json}
+
+
+def normalize(counters):
+    """Applies NORMALIZERS to each distinct value, merging values that normalise the same."""
+    normalized = {}
+    for field, counter in counters.items():
+        function = NORMALIZERS[field]
+        merged = {}
+        for value, count in counter.items():
+            key = function(value)
+            merged[key] = merged.get(key, 0) + count
+        normalized[field] = merged
+    return normalized
+
+
+class WindowedTop:
+    """TopK summaries per field for each `window`-second bucket, keeping `windows` buckets."""
+
+    def __init__(self, window=10, windows=90, capacity=1000):
+        self.window = window
+        self.capacity = capacity
+        self.buckets = deque(maxlen=windows)  # [start, {field: TopK}, queries]
+        self.queries = 0
+        self.bad_lines = 0
+        self.lock = threading.Lock()
+
+    def add(self, counters, queries, bad=0, now=None):
+        now = time.time() if now is None else now
+        start = now - now % self.window
+        counters = normalize(counters)
+        with self.lock:
+            if not self.buckets or self.buckets[-1][0] != start:
+                self.buckets.append([start, {field: TopK(self.capacity) for field in FIELDS}, 0])
+            bucket = self.buckets[-1]
+            for field, counts in counters.items():
+                bucket[1][field].update(counts)
+            bucket[2] += queries
+            self.queries += queries
+            self.bad_lines += bad
+
+    def snapshot(self, seconds, n, now=None):
+        """Merges the buckets of the last `seconds` and returns the top n of each field."""
+        now = time.time() if now is None else now
+        merged = {field: TopK(self.capacity) for field in FIELDS}
+        queries = 0
+        with self.lock:
+            for start, summaries, bucket_queries in self.buckets:
+                if start + self.window > now - seconds:
+                    for field in FIELDS:
+                        merged[field].merge(summaries[field])
+                    queries += bucket_queries
+        return {
+            "seconds": seconds,
+            "queries": queries,
+            "top": {field: [[value, count] for value, count in merged[field].top(n)] for field in FIELDS},
+            "error": {field: merged[field].error for field in FIELDS},
+        }
+
+
+class QueryLogIngester:
+    """Reads a query log source and feeds parsed batches into a WindowedTop."""
+
+    def __init__(self, source, fmt, top):
+        if fmt not in COUNTERS:
+            raise ValueError(f"Unknown query log format {fmt!r}; expected one of {', '.join(COUNTERS)}")
+        self.source = source
+        self.count = COUNTERS[fmt]
+        self.top = top
+
+    def feed_lines(self, lines):
+        counters, bad = self.count(lines)
+        queries = sum(counters['rcode'].values()) if counters['rcode'] else 0
+        if queries or bad:
+            self.top.add(counters, queries, bad)
+
+    def run(self):
+        """Ingests until the process exits; meant to run on its own thread."""
+        if self.source.startswith('unix:'):
+            self._serve_unix(self.source[len('unix:'):])
+        else:
+            self._follow_file(self.source)
+
+    def _consume(self, read, pending=b''):
+        """Reads chunks from read() until it returns b'', feeding complete lines; returns the partial tail."""
+        chunk = read(READ_SIZE)
+        while chunk:
+            complete, _, pending = (pending + chunk).rpartition(b'\n')
+            if complete:
+                self.feed_lines(complete.decode('utf-8', 'replace').split('\n'))
+            chunk = read(READ_SIZE)
+        return pending
+
+    def _follow_file(self, path):
+        file, inode, pending = None, None, b''
+        while True:
+            try:
+                stat = os.stat(path)
+                if file is None or stat.st_ino != inode or stat.st_size < file.tell():
+                    # First open, rotated or truncated: (re)open; start at the end only the first time
+                    first = file is None and inode is None
+                    if file is not None:
+                        file.close()
+                    file = open(path, 'rb')
+                    inode = stat.st_ino
+                    pending = b''
+                    if first:
+                        file.seek(0, os.SEEK_END)
+                pending = self._consume(file.read, pending)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Error reading query log {path}: {e}")
+            time.sleep(0.2)
+
+    def _serve_unix(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        logger.info(f"Listening for query log lines on {path}")
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=self._read_connection, args=(connection,), daemon=True).start()
+
+    def _read_connection(self, connection):
+        with connection:
+            try:
+                pending = self._consume(connection.recv)
+                if pending:
+                    self.feed_lines([pending.decode('utf-8', 'replace')])
+            except OSError as e:
+                logger.warning(f"Query log connection error: {e}")
+
+
+class TopPublisher:
+    """Publishes top-N snapshots for each of RANGES to the shared cache once a second.
+
+    Each range is its own cache entry, `querylog.top.<seconds>`, so workers can
+    serve it as stored.
+    """
+
+    RANGES = (60, 300, 900)
+
+    def __init__(self, top, cache, n=100):
+        self.top = top
+        self.cache = cache
+        self.n = n
+
+    def run(self):
+        while True:
+            now = time.time()
+            for seconds in self.RANGES:
+                report = self.top.snapshot(seconds, self.n, now)
+                report.update({"t": round(now, 3), "total_queries": self.top.queries, "bad_lines": self.top.bad_lines})
+                self.cache.put(f"querylog.top.{seconds}", json.dumps(report, separators=(',', ':')).encode(),
+                               status=200)
+            time.sleep(1.0)
@@ -0,0 +1,318 @@
+################################################################################
+# Knot Resolver Stats Dashboard - self-metrics and profiling
+################################################################################
+#
+# Measures the dashboard itself, to tell a slow kresd or network from a slow
+# backend. `Poller` times each stage of a scrape: the upstream fetch, parsing
+# the JSON, every hook that aggregates it, and storing entries in the shared
+# cache. Requests are timed per endpoint along with their payload size, JSON
+# serialisation time, how each cache entry they served was found (fresh,
+# scraped inline, stale or not modified), and how many are in flight.
+#
+# Observations go into histograms with fixed, exponentially spaced buckets:
+# recording one is a bisect and two additions under a lock, and workers
+# merge by adding bucket counts. Each worker publishes its counts to the
+# shared cache every few seconds; `/api/self` adds up the latest of all live
+# workers, as JSON with estimated percentiles, or with `?format=prometheus`
+# in the Prometheus text format.
+#
+# With `--profiling`, `/api/self/profile?seconds=10` samples the stacks of
+# every thread in the worker that answers and returns them in the collapsed
+# format flame graph tools read (`flamegraph.pl`, speedscope).
+#
+
+import bisect
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, g, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+# Publish this worker's counts to the shared cache at most this often (seconds)
+PUBLISH_INTERVAL = 5.0
+# Leave out workers that haven't published for this long (seconds), e.g. ones that exited
+WORKER_STALE_AFTER = 60.0
+MAX_PROFILE_SECONDS = 60.0
+
+SECONDS_BUCKETS = tuple(0.0001 * 2 ** i for i in range(18))  # 100µs to 13s
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B to 64 MiB
+
+# name: (type, help, buckets)
+FAMILIES = {
+    'stage_seconds': ('histogram', "Time spent in each stage of scraping and storing stats", SECONDS_BUCKETS),
+    'request_seconds': ('histogram', "Time to answer requests, per endpoint", SECONDS_BUCKETS),
+    'serialize_seconds': ('histogram', "Time spent encoding JSON responses, per endpoint", SECONDS_BUCKETS),
+    'response_bytes': ('histogram', "Size of response bodies, per endpoint", BYTES_BUCKETS),
+    'requests_total': ('counter', "Requests answered, per endpoint and status", None),
+    'cache_results_total': ('counter', "Cache entries served fresh (hit), after an inline scrape (miss), stale while "
+                                       "the scraper backs off (stale) or not modified, per endpoint and entry", None),
+    'scrapes_total': ('counter', "Scrapes of Knot Resolver, per status", None),
+}
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class SelfMetrics:
+    """This worker's histograms and counters."""
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> [counts..., sum]
+        self.counters = Counter()  # (name, labels) -> value
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        buckets = FAMILIES[name][2]
+        key = (name, label_key(labels))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += amount
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "time": time.time(),
+                "in_flight": self.in_flight,
+                "histograms": [[name, dict(labels), counts[:]] for (name, labels), counts in self.histograms.items()],
+                "counters": [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+            }
+
+    def publish(self, cache):
+        """Stores this worker's counts in the shared cache as `self.<pid>`."""
+        cache.put(f"self.{os.getpid()}", json.dumps(self.snapshot(), separators=(',', ':')).encode(), status=200)
+
+    def run_publisher(self, cache):
+        """Publishes every PUBLISH_INTERVAL seconds, so idle workers stay in the merged view; one thread per worker."""
+        while True:
+            time.sleep(PUBLISH_INTERVAL)
+            try:
+                self.publish(cache)
+            except OSError as e:
+                logger.warning(f"Failed to publish self-metrics: {e}")
+
+
+# The metrics of this worker process
+self_metrics = SelfMetrics()
+
+
+def merged_snapshots(cache):
+    """Returns ([worker snapshot], {(name, labels): counts}, {(name, labels): value}) over all live workers."""
+    self_metrics.publish(cache)
+    workers, histograms, counters = [], {}, Counter()
+    for entry_name in sorted(os.listdir(cache.directory)):
+        if not entry_name.startswith('self.') or '.tmp.' in entry_name:
+            continue
+        entry = cache.get(entry_name)
+        if entry is None:
+            continue
+        if time.time() - entry.meta['updated'] > WORKER_STALE_AFTER:
+            # A worker that has exited
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(cache.path(entry_name))
+            continue
+        snapshot = json.loads(entry.body)
+        workers.append(snapshot)
+        for name, labels, counts in snapshot['histograms']:
+            key = (name, label_key(labels))
+            total = histograms.setdefault(key, [0] * len(counts))
+            for index, count in enumerate(counts):
+                total[index] += count
+        for name, labels, value in snapshot['counters']:
+            counters[(name, label_key(labels))] += value
+    return workers, histograms, counters
+
+
+def estimate_percentile(buckets, counts, pct):
+    """Estimates a percentile from bucket counts, interpolating within the bucket it falls in."""
+    total = sum(counts)
+    if not total:
+        return None
+    target = total * pct / 100.0
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if count and cumulative + count >= target:
+            low = buckets[index - 1] if index else 0.0
+            high = buckets[index] if index < len(buckets) else buckets[-1] * 2
+            return low + (high - low) * (target - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def report(cache):
+    """Returns the merged metrics of all workers as a JSON-ready dict."""
+    workers, histograms, counters = merged_snapshots(cache)
+    histogram_rows = []
+    for (name, labels), counts in sorted(histograms.items()):
+        buckets = FAMILIES[name][2]
+        bucket_counts, total = counts[:-1], counts[-1]
+        observations = sum(bucket_counts)
+        row = {"name": name, "labels": dict(labels), "count": observations, "sum": round(total, 6),
+               "mean": round(total / observations, 6) if observations else None}
+        for pct in (50, 90, 99):
+            value = estimate_percentile(buckets, bucket_counts, pct)
+            row[f"p{pct}"] = None if value is None else round(value, 6)
+        histogram_rows.append(row)
+    return {
+        "workers": [{"pid": worker['pid'], "in_flight": worker['in_flight'], "updated": round(worker['time'], 3)}
+                    for worker in workers],
+        "in_flight": sum(worker['in_flight'] for worker in workers),
+        "histograms": histogram_rows,
+        "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(counters.items())],
+    }
+
+
+def prometheus_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def prometheus_text(cache):
+    """Returns the merged metrics of all workers in the Prometheus text exposition format."""
+    workers, histograms, counters = merged_snapshots(cache)
+    lines = [
+        "# HELP knotstats_workers Worker processes reporting metrics",
+        "# TYPE knotstats_workers gauge",
+        f"knotstats_workers {len(workers)}",
+        "# HELP knotstats_requests_in_flight Requests being answered",
+        "# TYPE knotstats_requests_in_flight gauge",
+        f"knotstats_requests_in_flight {sum(worker['in_flight'] for worker in workers)}",
+    ]
+    for name, (kind, description, buckets) in FAMILIES.items():
+        metric = f"knotstats_{name}"
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"]
+        if kind == 'counter':
+            for (family, labels), value in sorted(counters.items()):
+                if family == name:
+                    lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+            continue
+        for (family, labels), counts in sorted(histograms.items()):
+            if family != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{prometheus_labels(labels, le=f'{bound:g}')} {cumulative}")
+            lines.append(f"{metric}_bucket{prometheus_labels(labels, le='+Inf')} {sum(counts[:-1])}")
+            lines.append(f"{metric}_sum{prometheus_labels(labels)} {counts[-1]:.6f}")
+            lines.append(f"{metric}_count{prometheus_labels(labels)} {sum(counts[:-1])}")
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in this process, one profile at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, interval):
+        """Returns collapsed stacks, `thread;outer;...;inner count` per line, most frequent first.
+
+        Raises RuntimeError if a profile is already running.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running in this worker")
+        try:
+            own = threading.get_ident()
+            samples = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    samples[';'.join([names.get(ident, str(ident)), *reversed(stack)])] += 1
+                time.sleep(interval)
+        finally:
+            self.lock.release()
+        return ''.join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def register_self_metrics(app, cache, profiling=False):
+    """Instruments a Flask app and adds /api/self, and /api/self/profile with profiling."""
+    profiler = SamplingProfiler() if profiling else None
+
+    json_provider = getattr(app, 'json', None)
+    if json_provider is not None and hasattr(json_provider, 'dumps'):
+        dumps = json_provider.dumps
+
+        def timed_dumps(obj, **kwargs):
+            with self_metrics.timer('serialize_seconds', endpoint=request.endpoint or 'none'):
+                return dumps(obj, **kwargs)
+        json_provider.dumps = timed_dumps
+
+    @app.before_request
+    def start_request_timer():
+        g.self_metrics_started = time.perf_counter()
+        with self_metrics.lock:
+            self_metrics.in_flight += 1
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'none'
+        self_metrics.observe('request_seconds', time.perf_counter() - g.self_metrics_started, endpoint=endpoint)
+        if response.content_length is not None:
+            self_metrics.observe('response_bytes', response.content_length, endpoint=endpoint)
+        self_metrics.increment('requests_total', endpoint=endpoint, status=str(response.status_code))
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        if 'self_metrics_started' in g:
+            with self_metrics.lock:
+                self_metrics.in_flight -= 1
+
+    @app.route('/api/self')
+    def get_self_metrics():
+        """Returns the backend's own metrics, merged over all workers; ?format=prometheus for Prometheus."""
+        if request.args.get('format') == 'prometheus':
+            return Response(prometheus_text(cache), mimetype='text/plain; version=0.0.4')
+        return jsonify(report(cache))
+
+    @app.route('/api/self/profile')
+    def get_profile():
+        """Samples this worker's threads for ?seconds= (default 10) every ?interval= ms (default 5)."""
+        if profiler is None:
+            return jsonify({"error": "Profiling is off; start the dashboard with --profiling."}), 404
+        try:
+            seconds = min(float(request.args.get('seconds', 10)), MAX_PROFILE_SECONDS)
+            interval = max(float(request.args.get('interval', 5)), 1) / 1000
+        except ValueError:
+            return jsonify({"error": "seconds and interval must be numbers"}), 400
+        try:
+            stacks = profiler.profile(seconds, interval)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 409
+        return Response(stacks, mimetype='text/plain', headers={'X-Profile-Worker': str(os.getpid())})
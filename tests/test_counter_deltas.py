@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import unittest
+
+spec = importlib.util.spec_from_file_location(
+    'knotstats_v6', os.path.join(os.path.dirname(__file__), '..', 'knotstats-v6.py'))
+knotstats_v6 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(knotstats_v6)
+
+
+class CounterDeltasTest(unittest.TestCase):
+    def test_appearing_counter_is_a_baseline(self):
+        deltas = knotstats_v6.CounterDeltas()
+        deltas.update({'a': {'answer': {'total': 5}}}, 0)
+        elapsed, result = deltas.update({'a': {'answer': {'total': 7, 'stale': 1}}}, 1)
+        self.assertEqual(elapsed, 1)
+        self.assertEqual(result, {'a': {('answer', 'total'): 2}})
+        _, result = deltas.update({'a': {'answer': {'total': 8, 'stale': 4}}}, 2)
+        self.assertEqual(result, {'a': {('answer', 'total'): 1, ('answer', 'stale'): 3}})
+
+    def test_disappearing_counter_is_left_out(self):
+        deltas = knotstats_v6.CounterDeltas()
+        deltas.update({'a': {'answer': {'total': 5, 'stale': 1}}}, 0)
+        _, result = deltas.update({'a': {'answer': {'total': 7}}}, 1)
+        self.assertEqual(result, {'a': {('answer', 'total'): 2}})
+
+    def test_counter_going_backwards_counts_from_zero(self):
+        deltas = knotstats_v6.CounterDeltas()
+        deltas.update({'a': {'answer': {'total': 50}}}, 0)
+        _, result = deltas.update({'a': {'answer': {'total': 3}}}, 1)
+        self.assertEqual(result, {'a': {('answer', 'total'): 3}})
+
+
+if __name__ == '__main__':
+    unittest.main()